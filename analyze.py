@@ -0,0 +1,338 @@
+"""Threshold tuning for secrets.VALUES_FOR_SUBREDDIT.
+
+Loads engagement history into flat column arrays with one row per sample: which image it
+belongs to, the image's subreddit, when it was posted, when it was sampled, its score and how
+many polls of it came before (what Image.engagement_length said when the sample was written,
+polls whose sample wasn't written included; each sample carries it). History comes from
+a parallel scan of meme-metadata (plus the engagement table when samples live there), a JSONL
+export of those items (`python analyze.py export`), or backfill chunks, which have one sample per
+post and no poll count (their age in hours stands in for it).
+
+    python analyze.py export history.jsonl
+    python analyze.py percentiles --source history.jsonl
+    python analyze.py simulate --source history.jsonl --scale 0.5 --scale 1 --scale 2
+
+Everything after loading is whole-array numpy, so a million samples take well under a second.
+Only numpy's array code is used here: np.random would import the stdlib `secrets`, which our own
+secrets.py shadows."""
+import json
+import os
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+#pypi
+import click
+import numpy as np
+#local modules
+import clients
+import secrets
+from engagement_store import ENGAGEMENT_TABLE, DynamoEngagementStore
+from image import CURRENT_TABLE
+
+DEFAULT_PERCENTILES = (50, 75, 90, 95, 99)
+HOUR = 60 * 60
+
+
+class History():
+    """Column arrays of engagement samples, built row by row then frozen into numpy with finish()"""
+    def __init__(self):
+        self.image_ids = [] # image index -> id
+        self.subreddits = [] # code -> name
+        self._subreddit_codes = {}
+        self._image_index = {} # id -> image index
+        self.image_subreddit = array('H')
+        self.image_created = array('d')
+        self.image_posted = array('b')
+        self.sample_image = array('q')
+        self.sample_ts = array('d')
+        self.sample_score = array('d')
+        self.sample_number = array('q') # polls before the sample, -1 when unknown
+        self._lock = threading.Lock()
+
+    def add_image(self, image_id, subreddit, created, posted=False):
+        with self._lock:
+            index = self._image_index.get(image_id)
+            if index is not None:
+                return index
+            code = self._subreddit_codes.get(subreddit)
+            if code is None:
+                code = self._subreddit_codes[subreddit] = len(self.subreddits)
+                self.subreddits.append(subreddit)
+            index = self._image_index[image_id] = len(self.image_ids)
+            self.image_ids.append(image_id)
+            self.image_subreddit.append(code)
+            self.image_created.append(created)
+            self.image_posted.append(bool(posted))
+            return index
+
+    def image_index(self, image_id):
+        return self._image_index.get(image_id)
+
+    def add_samples(self, index, timestamps, scores, numbers=None):
+        """ numbers are the samples' poll numbers, None when they aren't known """
+        with self._lock:
+            self.sample_image.extend([index] * len(timestamps))
+            self.sample_ts.extend(timestamps)
+            self.sample_score.extend(scores)
+            self.sample_number.extend([-1] * len(timestamps) if numbers is None else numbers)
+
+    def add_item(self, item):
+        """ A meme-metadata item in dynamo's JSON format, with the legacy engagement lists or just the latest sample """
+        index = self.add_image(item['id']['S'], item['community']['S'], float(item['created']['N']),
+            item.get('posted', {}).get('BOOL', False))
+        if 'engagement' in item:
+            engagement = item['engagement']['M']
+            timestamps = [float(v['N']) for v in engagement['timestamps']['L']]
+            scores = [float(v['N']) for v in engagement['scores']['L']]
+            polls = [int(v['N']) for v in engagement.get('polls', {'L': []})['L']]
+            # samples from before polls were kept were written on every poll
+            self.add_samples(index, timestamps, scores, list(range(len(timestamps) - len(polls))) + polls)
+        elif 'last_sampled' in item:
+            # the rest of the series is in the engagement table, the latest sample was written as poll num_polls - 1
+            self.add_samples(index, [float(item['last_sampled']['N'])], [float(item['current_score']['N'])],
+                [int(item.get('num_polls', {'N': '1'})['N']) - 1])
+
+    def finish(self):
+        return Columns(self)
+
+
+class Columns():
+    def __init__(self, history):
+        self.subreddits = list(history.subreddits)
+        self.image_ids = history.image_ids
+        self.image_subreddit = np.frombuffer(history.image_subreddit, dtype=np.uint16).astype(np.int64)
+        self.image_created = np.frombuffer(history.image_created, dtype=np.float64)
+        self.image_posted = np.frombuffer(history.image_posted, dtype=np.int8).astype(bool)
+        self.sample_image = np.frombuffer(history.sample_image, dtype=np.int64)
+        self.sample_ts = np.frombuffer(history.sample_ts, dtype=np.float64)
+        self.sample_score = np.frombuffer(history.sample_score, dtype=np.float64)
+        self.sample_subreddit = self.image_subreddit[self.sample_image]
+        age = self.sample_ts - self.image_created[self.sample_image]
+        self.sample_age_hours = np.maximum(age // HOUR, 0).astype(np.int64)
+        self.sample_rate = self.sample_score / np.maximum(age, 1e-9) # ups = upvotes per second
+        number = np.frombuffer(history.sample_number, dtype=np.int64)
+        self.sample_number = np.where(number < 0, self.sample_age_hours, number)
+
+    def __len__(self):
+        return len(self.sample_ts)
+
+
+def scan_table(table, on_item, client=None, segments=8, projection=None):
+    """ Parallel scan, on_item is called from the segment threads """
+    client = client or clients.dynamodb()
+
+    def scan_segment(segment):
+        kwargs = dict(TableName=table, Segment=segment, TotalSegments=segments)
+        if projection:
+            kwargs['ProjectionExpression'] = projection
+        count = 0
+        for page in client.get_paginator('scan').paginate(**kwargs):
+            for item in page['Items']:
+                on_item(item)
+                count += 1
+        return count
+
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        return sum(pool.map(scan_segment, range(segments)))
+
+
+def load_dynamo(segments=8, engagement_table=None, client=None):
+    history = History()
+    scan_table(CURRENT_TABLE, history.add_item, client, segments)
+    if engagement_table:
+        # the metadata items only held the latest sample, replace it with the full series
+        history = _with_engagement_table(history, engagement_table, client, segments)
+    return history.finish()
+
+
+def _with_engagement_table(metadata_history, engagement_table, client, segments):
+    history = History()
+    for index, image_id in enumerate(metadata_history.image_ids):
+        history.add_image(image_id, metadata_history.subreddits[metadata_history.image_subreddit[index]],
+            metadata_history.image_created[index], metadata_history.image_posted[index])
+    buckets = {} # image index -> [(bucket, t, s, p)], buckets arrive in any order
+
+    def on_item(item):
+        index = history.image_index(item['id']['S'])
+        if index is None:
+            return
+        t, s, _, p = DynamoEngagementStore.decode_item(item)
+        with history._lock:
+            buckets.setdefault(index, []).append((int(item['bucket']['N']), t, s, p))
+
+    scan_table(engagement_table, on_item, client, segments)
+    # images with nothing in the engagement table (legacy lists in the item) keep what the item had
+    keep = ~np.isin(np.frombuffer(metadata_history.sample_image, dtype=np.int64), np.fromiter(buckets, dtype=np.int64))
+    for name, dtype in (('sample_image', np.int64), ('sample_ts', np.float64), ('sample_score', np.float64), ('sample_number', np.int64)):
+        getattr(history, name).frombytes(np.frombuffer(getattr(metadata_history, name), dtype=dtype)[keep].tobytes())
+    for index, parts in buckets.items():
+        parts.sort(key=lambda part: part[0])
+        history.add_samples(index, [ts for part in parts for ts in part[1]], [score for part in parts for score in part[2]],
+            [poll for part in parts for poll in part[3]])
+    return history
+
+
+def load_export(path):
+    """ One dynamo JSON item per line, as written by `analyze.py export` """
+    history = History()
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                history.add_item(json.loads(line))
+    return history.finish()
+
+
+def load_backfill(output_dir):
+    import backfill
+    history = History()
+    for row in backfill.read_chunks(output_dir):
+        index = history.add_image(row['id'], row['subreddit'], float(row['created']))
+        history.add_samples(index, [float(row['fetched_at'])], [float(row['votes'])])
+    return history.finish()
+
+
+def load(source, **kwargs):
+    if source == 'dynamo':
+        return load_dynamo(**kwargs)
+    if os.path.isdir(source):
+        return load_backfill(source)
+    return load_export(source)
+
+
+def group_percentiles(keys, values, percentiles=DEFAULT_PERCENTILES):
+    """ Percentiles of values within each distinct row of keys (a 2d int array), all groups at once.
+    Returns (group keys, counts, percentile matrix), using the nearest-rank-below method. """
+    order = np.lexsort((values,) + tuple(keys[:, i] for i in reversed(range(keys.shape[1]))))
+    sorted_keys, sorted_values = keys[order], values[order]
+    change = np.ones(len(order), dtype=bool)
+    change[1:] = np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)
+    starts = np.flatnonzero(change)
+    counts = np.diff(np.append(starts, len(order)))
+    q = np.asarray(percentiles, dtype=np.float64) / 100
+    positions = starts[:, None] + np.floor(q[None, :] * (counts[:, None] - 1)).astype(np.int64)
+    return sorted_keys[starts], counts, sorted_values[positions]
+
+
+def rate_percentiles(columns, percentiles=DEFAULT_PERCENTILES, max_hours=48):
+    """ Upvote rate percentiles per (subreddit, hour since posting) """
+    keep = (columns.sample_age_hours < max_hours) & np.isfinite(columns.sample_rate)
+    keys = np.stack([columns.sample_subreddit[keep], columns.sample_age_hours[keep]], axis=1)
+    return group_percentiles(keys, columns.sample_rate[keep], percentiles)
+
+
+def threshold_table(subreddits, values_for_subreddit=None):
+    """ Pads every subreddit's VALUES_FOR_SUBREDDIT into one (subreddits x max_len) matrix, plus each real length """
+    if values_for_subreddit is None:
+        values_for_subreddit = secrets.VALUES_FOR_SUBREDDIT
+    values = [values_for_subreddit.get(subreddit, []) for subreddit in subreddits]
+    lengths = np.array([len(v) for v in values], dtype=np.int64)
+    table = np.full((len(values), max(lengths.max(initial=0), 1)), np.inf)
+    for i, v in enumerate(values):
+        table[i, :len(v)] = v
+    return table, lengths
+
+
+def score_arrays(votes, created, n, subreddit_codes, table, lengths, now):
+    """ scoring.score for whole arrays at once. votes/created/n are per-sample arrays, subreddit_codes
+    index rows of the threshold table. Returns (passes, ups_ratio, threshold). """
+    ups_ratio = votes / np.maximum(now - created, 1e-9) # ups = upvotes per second
+    # first X hours of seeing this post (if n < X)
+    in_window = n < lengths[subreddit_codes]
+    columns = np.clip(n - 1, 0, table.shape[1] - 1)
+    threshold = table[subreddit_codes, columns]
+    passes = in_window & (ups_ratio > threshold)
+    return passes, ups_ratio, threshold
+
+
+def simulate(columns, values_for_subreddit):
+    """ Which images a threshold vector per subreddit would have posted, replaying every sample through
+    score_arrays. Returns (triggered per image, index of the sample that triggered it or -1). """
+    # subreddits without values get an empty row, which never passes
+    table, lengths = threshold_table(columns.subreddits, values_for_subreddit)
+    # a sample at time t is scored with the polls before it, and its own age
+    passes, _, _ = score_arrays(columns.sample_score, columns.image_created[columns.sample_image],
+        columns.sample_number, columns.sample_subreddit, table, lengths, columns.sample_ts)
+    triggered = np.zeros(len(columns.image_ids), dtype=bool)
+    triggered[columns.sample_image[passes]] = True
+    first = np.full(len(columns.image_ids), len(columns), dtype=np.int64)
+    np.minimum.at(first, columns.sample_image[passes], np.flatnonzero(passes))
+    first[first == len(columns)] = -1
+    return triggered, first
+
+
+def posts_per_day(columns, triggered):
+    """ Triggered images per subreddit per day of history """
+    days = max((columns.sample_ts.max() - columns.sample_ts.min()) / (24 * HOUR), 1.0) if len(columns) else 1.0
+    counts = np.bincount(columns.image_subreddit[triggered], minlength=len(columns.subreddits))
+    return {subreddit: float(counts[code] / days) for code, subreddit in enumerate(columns.subreddits)}
+
+
+def scaled(values_for_subreddit, factor):
+    return {subreddit: [value * factor for value in values] for subreddit, values in values_for_subreddit.items()}
+
+
+@click.group()
+def cli():
+    pass
+
+source_option = click.option('--source', default='dynamo',
+    help="'dynamo' to scan the tables, a JSONL export file or a backfill directory")
+engagement_option = click.option('--engagement-table', is_flag=True, help='read the sample series from {}'.format(ENGAGEMENT_TABLE))
+segments_option = click.option('--segments', default=8, help='parallel scan segments')
+
+def load_from_options(source, engagement_table, segments):
+    if source == 'dynamo':
+        return load_dynamo(segments, ENGAGEMENT_TABLE if engagement_table else None)
+    return load(source)
+
+@cli.command()
+@click.argument('path', type=click.Path(dir_okay=False))
+@segments_option
+def export(path, segments):
+    """ Writes every meme-metadata item to a JSONL file for offline analysis """
+    lock = threading.Lock()
+    with open(path, 'w') as f:
+        def write(item):
+            line = json.dumps(item) + '\n'
+            with lock:
+                f.write(line)
+        print('{} items exported'.format(scan_table(CURRENT_TABLE, write, segments=segments)))
+
+@cli.command()
+@source_option
+@engagement_option
+@segments_option
+@click.option('--max-hours', default=24, help='hours since posting to report')
+def percentiles(source, engagement_table, segments, max_hours):
+    """ Upvotes/s percentiles by subreddit and hour since posting """
+    columns = load_from_options(source, engagement_table, segments)
+    keys, counts, values = rate_percentiles(columns, max_hours=max_hours)
+    print('{:<20} {:>4} {:>8} '.format('subreddit', 'hour', 'samples') + ' '.join('{:>9}'.format('p{}'.format(p)) for p in DEFAULT_PERCENTILES))
+    for (code, hour), count, row in zip(keys, counts, values):
+        print('{:<20} {:>4} {:>8} '.format(columns.subreddits[code], hour, count) + ' '.join('{:>9.4f}'.format(v) for v in row))
+
+@cli.command('simulate')
+@source_option
+@engagement_option
+@segments_option
+@click.option('--scale', 'scales', multiple=True, type=float, help='also try the current thresholds times this factor')
+@click.option('--values', 'values_path', default=None, type=click.Path(exists=True),
+    help='JSON file with a list of {subreddit: [thresholds]} to try')
+def simulate_command(source, engagement_table, segments, scales, values_path):
+    """ How many posts each threshold vector would have triggered, per subreddit and per day """
+    columns = load_from_options(source, engagement_table, segments)
+    candidates = [('current', secrets.VALUES_FOR_SUBREDDIT)]
+    candidates += [('current x{}'.format(factor), scaled(secrets.VALUES_FOR_SUBREDDIT, factor)) for factor in scales]
+    if values_path:
+        with open(values_path) as f:
+            candidates += [('file #{}'.format(i), values) for i, values in enumerate(json.load(f))]
+    print('{} samples of {} images'.format(len(columns), len(columns.image_ids)))
+    for name, values in candidates:
+        triggered, _ = simulate(columns, values)
+        per_day = posts_per_day(columns, triggered)
+        print('{}: {} images triggered'.format(name, int(triggered.sum())))
+        for subreddit, rate in sorted(per_day.items()):
+            print('    {:<20} {:>8.2f}/day'.format(subreddit, rate))
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,208 @@
+"""Historical backfill: walks top/new listings for many subreddits and writes the posts to chunked files.
+
+Nothing goes to S3, DynamoDB or the posting API. Each (subreddit, listing, time filter) is a job
+that follows reddit's `after` cursor page by page. Posts are projected to PostRecord fields and
+appended to the current chunk (JSONL, or Parquet when pyarrow is installed); a chunk is closed at
+a page boundary once it holds chunk_rows posts, and only then is the checkpoint written. So the
+checkpoint always matches the closed chunks, an interrupted job resumes from the cursor after its
+last closed chunk, and at most one chunk and one page are ever held.
+
+Media isn't fetched during the walk. download_media reads the chunks back afterwards and fetches
+the images into a directory, skipping any it already has."""
+import glob
+import json
+import os
+import time
+#pypi (optional) - without pyarrow chunks are written as JSONL
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+#local modules
+from downloader import Downloader
+from image import can_download_post
+from records import PostRecord
+from reddit_scraper import get_listing_page
+
+DEFAULT_CHUNK_ROWS = 10000
+PAGE_SIZE = 100
+CHECKPOINT_FILE = 'checkpoint.json'
+TMP_SUFFIX = '.part'
+# reddit stops paging a listing after about 1000 posts, time filters are what get further back
+DEFAULT_TIME_FILTERS = ('hour', 'day', 'week', 'month', 'year', 'all')
+
+
+def job_key(subreddit, listing, time_filter):
+    return '{}/{}/{}'.format(subreddit, listing, time_filter or '-')
+
+
+def jobs_for(subreddits, listings, time_filters):
+    for subreddit in subreddits:
+        for listing in listings:
+            # only top (and controversial) take a time filter
+            for time_filter in (time_filters if listing in ('top', 'controversial') else [None]):
+                yield subreddit, listing, time_filter
+
+
+def _write_json(path, value):
+    tmp_path = path + TMP_SUFFIX
+    with open(tmp_path, 'w') as f:
+        json.dump(value, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+class Checkpoint():
+    """Per job progress: the cursor to continue from, pages/rows so far and whether the job is done"""
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, CHECKPOINT_FILE)
+        self.state = {'chunks': 0, 'jobs': {}}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.state = json.load(f)
+
+    def job(self, key):
+        return self.state['jobs'].setdefault(key, {'after': None, 'pages': 0, 'rows': 0, 'done': False})
+
+    @property
+    def chunks(self):
+        return self.state['chunks']
+
+    def save(self, chunks):
+        self.state['chunks'] = chunks
+        _write_json(self.path, self.state)
+
+
+class ChunkWriter():
+    """Rows go into part-<n>.jsonl / .parquet, each chunk only gets its final name once it's closed"""
+    def __init__(self, output_dir, start_index=0, fmt='jsonl'):
+        if fmt == 'parquet' and pyarrow is None:
+            raise ValueError('parquet output needs pyarrow installed')
+        self.output_dir = output_dir
+        self.fmt = fmt
+        self.index = start_index
+        self.rows = 0
+        self._file = None
+        self._buffer = [] # parquet only, one chunk at most
+        # anything left open by an interrupted run isn't covered by the checkpoint
+        for leftover in glob.glob(os.path.join(output_dir, 'part-*' + TMP_SUFFIX)):
+            os.remove(leftover)
+
+    def _path(self):
+        return os.path.join(self.output_dir, 'part-{:05d}.{}'.format(self.index, self.fmt))
+
+    def write(self, row):
+        if self.fmt == 'parquet':
+            self._buffer.append(row)
+        else:
+            if self._file is None:
+                self._file = open(self._path() + TMP_SUFFIX, 'w')
+            self._file.write(json.dumps(row) + '\n')
+        self.rows += 1
+
+    def close_chunk(self):
+        """ Gives the open chunk its final name, returns how many chunks have been closed """
+        if self.rows == 0:
+            return self.index
+        if self.fmt == 'parquet':
+            pyarrow.parquet.write_table(pyarrow.Table.from_pylist(self._buffer), self._path() + TMP_SUFFIX)
+            self._buffer = []
+        else:
+            self._file.close()
+            self._file = None
+        os.replace(self._path() + TMP_SUFFIX, self._path())
+        self.index += 1
+        self.rows = 0
+        return self.index
+
+
+def project(post, subreddit, listing, time_filter, fetched_at):
+    row = PostRecord.from_post(post, subreddit).as_dict()
+    row.update(name=post.get('name'), listing=listing, time_filter=time_filter, fetched_at=fetched_at)
+    return row
+
+
+def run_backfill(subreddits, output_dir, listings=('top', 'new'), time_filters=DEFAULT_TIME_FILTERS,
+        chunk_rows=DEFAULT_CHUNK_ROWS, max_pages=None, fmt='jsonl', fetch_page=get_listing_page):
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = Checkpoint(output_dir)
+    writer = ChunkWriter(output_dir, checkpoint.chunks, fmt)
+    pending = {} # job key -> progress since the last closed chunk
+
+    def close_chunk():
+        chunks = writer.close_chunk()
+        for key, progress in pending.items():
+            checkpoint.job(key).update(progress)
+        pending.clear()
+        checkpoint.save(chunks)
+
+    for subreddit, listing, time_filter in jobs_for(subreddits, listings, time_filters):
+        key = job_key(subreddit, listing, time_filter)
+        job = dict(checkpoint.job(key))
+        if job['done']:
+            continue
+        print('backfilling {} from {}'.format(key, job['after'] or 'the start'))
+        while max_pages is None or job['pages'] < max_pages:
+            params = {'limit': PAGE_SIZE}
+            if time_filter:
+                params['t'] = time_filter
+            if job['after']:
+                params['after'] = job['after']
+            page = fetch_page(subreddit, listing, params)['data']
+            fetched_at = time.time()
+            for child in page['children']:
+                post = child['data']
+                if can_download_post(post, subreddit):
+                    writer.write(project(post, subreddit, listing, time_filter, fetched_at))
+                    job['rows'] += 1
+            job['pages'] += 1
+            job['after'] = page.get('after')
+            job['done'] = not job['after']
+            pending[key] = dict(job)
+            if writer.rows >= chunk_rows:
+                close_chunk()
+            if job['done']:
+                break
+        print('{}: {} posts over {} pages'.format(key, job['rows'], job['pages']))
+    close_chunk()
+    return checkpoint
+
+
+def read_chunks(output_dir):
+    """ Yields the rows of every closed chunk, one chunk in memory at a time """
+    for path in sorted(glob.glob(os.path.join(output_dir, 'part-*.*'))):
+        if path.endswith(TMP_SUFFIX):
+            continue
+        if path.endswith('.parquet'):
+            if pyarrow is None:
+                raise ValueError('{} needs pyarrow to read'.format(path))
+            yield from pyarrow.parquet.read_table(path).to_pylist()
+        else:
+            with open(path) as f:
+                for line in f:
+                    yield json.loads(line)
+
+
+def download_media(output_dir, media_dir, downloader=None, batch_size=1000):
+    """ Fetches the image of every backfilled post into media_dir/<id>, skipping files already there """
+    os.makedirs(media_dir, exist_ok=True)
+    downloader = downloader or Downloader()
+    downloaded = 0
+    batch = []
+
+    def flush():
+        nonlocal downloaded
+        downloaded += sum(downloader.download_all(batch))
+        batch.clear()
+
+    for row in read_chunks(output_dir):
+        path = os.path.join(media_dir, row['id'])
+        if os.path.exists(path):
+            continue
+        batch.append((row['url'], path))
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    for host, stats in downloader.report().items():
+        print(host, stats)
+    return downloaded
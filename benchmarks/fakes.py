@@ -0,0 +1,291 @@
+"""In-process stand-ins for DynamoDB, S3 and Reddit, plus a local HTTP server for images and the posting API.
+
+Every fake counts its calls and can sleep a configurable latency per call, so a benchmark run can
+show round trips per image and how the pipeline behaves when the services are slow."""
+import collections
+import json
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class CallCounter():
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    @property
+    def total(self):
+        return sum(self.calls.values())
+
+
+class _Exceptions():
+    class ProvisionedThroughputExceededException(Exception):
+        pass
+
+
+class FakeDynamoDB(CallCounter):
+    """Dict backed dynamo client covering the calls the scraper makes.
+
+    update_item understands top level `SET a = :v` and `ADD a :v` clauses, which is enough for
+    current_score/posted/num_polls/posts_today; nested paths and list_append are only counted."""
+    exceptions = _Exceptions
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.tables = collections.defaultdict(dict)
+
+    @staticmethod
+    def _key(key):
+        return tuple(sorted((name, list(value.values())[0]) for name, value in key.items()))
+
+    def _item_key(self, table, item):
+        key_names = ('account',) if table == 'account-state' else ('id', 'bucket')
+        return self._key({name: item[name] for name in key_names if name in item})
+
+    def get_item(self, TableName, Key, **kwargs):
+        self.call('get_item')
+        item = self.tables[TableName].get(self._key(Key))
+        return {'Item': item} if item is not None else {}
+
+    def batch_get_item(self, RequestItems):
+        self.call('batch_get_item')
+        responses = {}
+        for table, request in RequestItems.items():
+            items = (self.tables[table].get(self._key(key)) for key in request['Keys'])
+            responses[table] = [item for item in items if item is not None]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def put_item(self, TableName, Item, **kwargs):
+        self.call('put_item')
+        self.tables[TableName][self._item_key(TableName, Item)] = Item
+        return {}
+
+    def batch_write_item(self, RequestItems):
+        self.call('batch_write_item')
+        for table, requests in RequestItems.items():
+            for request in requests:
+                item = request['PutRequest']['Item']
+                self.tables[table][self._item_key(table, item)] = item
+        return {'UnprocessedItems': {}}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues=None, **kwargs):
+        self.call('update_item')
+        values = ExpressionAttributeValues or {}
+        item = self.tables[TableName].setdefault(self._key(Key), dict(Key))
+        for name, placeholder in re.findall(r'(?:SET|,)\s*(\w+)\s*=\s*(:\w+)\b(?!\s*\()', UpdateExpression):
+            item[name] = values[placeholder]
+        for name, placeholder in re.findall(r'ADD\s+(\w+)\s+(:\w+)', UpdateExpression):
+            current = float(item.get(name, {'N': '0'})['N'])
+            item[name] = {'N': str(int(current + float(values[placeholder]['N'])))}
+        return {}
+
+    def query(self, TableName, ExpressionAttributeValues, **kwargs):
+        self.call('query')
+        image_id = ExpressionAttributeValues[':id']['S']
+        items = [item for item in self.tables[TableName].values() if item.get('id', {}).get('S') == image_id]
+        return {'Items': items}
+
+    def scan(self, TableName, Segment=0, TotalSegments=1, **kwargs):
+        self.call('scan')
+        items = list(self.tables[TableName].values())
+        return {'Items': items[Segment::TotalSegments]}
+
+    def get_paginator(self, operation):
+        fake = self
+        class Paginator():
+            def paginate(self, **kwargs):
+                yield getattr(fake, operation)(**kwargs)
+        return Paginator()
+
+
+class FakeS3(CallCounter):
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.objects = {}
+        self.tags = {}
+        self.bytes_uploaded = 0
+
+    class _NoSuchKey(Exception):
+        response = {'Error': {'Code': '404'}}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None, **kwargs):
+        self.call('upload_fileobj')
+        data = Fileobj.read()
+        self.bytes_uploaded += len(data)
+        self.objects[(Bucket, Key)] = data
+        if ExtraArgs and 'Tagging' in ExtraArgs:
+            self.tags[(Bucket, Key)] = ExtraArgs['Tagging']
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.call('put_object')
+        data = Body.read() if hasattr(Body, 'read') else Body
+        self.bytes_uploaded += len(data)
+        self.objects[(Bucket, Key)] = data
+        if 'Tagging' in kwargs:
+            self.tags[(Bucket, Key)] = kwargs['Tagging']
+        return {}
+
+    def put_object_tagging(self, Bucket, Key, Tagging, **kwargs):
+        self.call('put_object_tagging')
+        self.tags[(Bucket, Key)] = Tagging
+        return {}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.call('head_object')
+        if (Bucket, Key) not in self.objects:
+            raise self._NoSuchKey()
+        return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        self.call('download_fileobj')
+        if (Bucket, Key) not in self.objects:
+            raise self._NoSuchKey()
+        Fileobj.write(self.objects[(Bucket, Key)])
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        self.call('download_file')
+        if (Bucket, Key) not in self.objects:
+            raise self._NoSuchKey()
+        with open(Filename, 'wb') as f:
+            f.write(self.objects[(Bucket, Key)])
+
+
+class FakeResponse():
+    def __init__(self, status_code, body, headers=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.text = json.dumps(body)
+        self.headers = headers or {}
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+class FakeRedditSession(CallCounter):
+    """Serves the oauth token and listing pages out of a list of recorded listing JSON pages.
+
+    The rate limit headers claim a budget big enough that RateLimitBudget never paces the
+    benchmark; against reddit's real 600 per 600s every page would wait about a second."""
+    def __init__(self, pages, latency=0.0, ratelimit_remaining=1000000, ratelimit_reset=600):
+        super().__init__(latency)
+        self.pages = pages
+        self.headers = {}
+        self.ratelimit_headers = {'X-Ratelimit-Remaining': str(ratelimit_remaining), 'X-Ratelimit-Reset': str(ratelimit_reset)}
+
+    def post(self, url, **kwargs):
+        self.call('access_token')
+        return FakeResponse(200, {'access_token': 'benchmark-token', 'expires_in': 3600})
+
+    def get(self, url, params=None, **kwargs):
+        self.call('listing')
+        after = (params or {}).get('after')
+        index = int(after.split('_')[1]) if after else 0
+        page = self.pages[index]
+        return FakeResponse(200, page, dict(self.ratelimit_headers))
+
+
+def make_png(seed, size=64):
+    """ Small random greyscale PNG (no Pillow needed), different seeds give perceptually different images """
+    rng = random.Random(seed)
+    rows = b''.join(b'\x00' + bytes(rng.randrange(256) for _ in range(size)) for _ in range(size))
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 0, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+def make_listing_pages(base_url, subreddit, num_posts, page_size=25, now=None):
+    """ Listing JSON shaped like reddit's, every post pointing at an image on the local server """
+    now = time.time() if now is None else now
+    posts = []
+    for i in range(num_posts):
+        posts.append({'data': {
+            'title': 'benchmark meme {}'.format(i),
+            'url': '{}/img/{}.png'.format(base_url, i),
+            'score': 1000 + 37 * i,
+            'num_comments': 10 + i,
+            'created_utc': now - 600 - 60 * i,
+            'subreddit_subscribers': 1000000,
+            'subreddit': subreddit,
+            'thumbnail': 'https://b.thumbs.redditmedia.com/{}.jpg'.format(i),
+            'preview': {'images': []},
+            'secure_media': None,
+        }})
+    pages = []
+    for start in range(0, max(num_posts, 1), page_size):
+        index = len(pages)
+        has_more = start + page_size < num_posts
+        pages.append({'data': {
+            'children': posts[start:start + page_size],
+            'after': 't3_{}'.format(index + 1) if has_more else None,
+        }})
+    return pages
+
+
+class LocalServer():
+    """Threaded HTTP server for /img/<n>.png and the posting API, with optional per-request latency"""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.counter = CallCounter()
+        self.bytes_served = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                server.counter.call('image')
+                if server.latency:
+                    time.sleep(server.latency)
+                match = re.match(r'/img/(\d+)\.png$', self.path)
+                if not match:
+                    return self._reply(404, b'', 'text/plain')
+                body = make_png(int(match.group(1)))
+                server.bytes_served += len(body)
+                self._reply(200, body, 'image/png')
+
+            def do_POST(self):
+                server.counter.call('post')
+                if server.latency:
+                    time.sleep(server.latency)
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self._reply(200, b'{}', 'application/json')
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,199 @@
+"""Offline end-to-end benchmark of RedditScraper.scrape_and_store.
+
+    python -m benchmarks.run --posts 100 --aws-latency 0.02 --http-latency 0.05 --runs 2
+
+Reddit, DynamoDB and S3 are in-process fakes (benchmarks/fakes.py), images and the posting API
+are served by a local HTTP server. The first run sees every post as new, later runs see them
+as already stored. Prints wall time, time per pipeline stage and service calls per image;
+--max-aws-calls-per-image makes it exit non-zero so CI catches round trip regressions."""
+import collections
+import functools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import click
+
+SUBREDDIT = 'benchmark'
+LOCAL_HOST_RATE = 10000
+
+
+def install_secrets(api_url):
+    # the real secrets.py isn't around in CI, and the benchmark shouldn't depend on its values anyway
+    stand_in = types.ModuleType('secrets')
+    # keep the stdlib's token_* helpers in case anything imported later relies on them
+    import secrets
+    stand_in.__dict__.update({name: value for name, value in vars(secrets).items() if not name.startswith('__')})
+    stand_in.CLIENT_ID = 'benchmark'
+    stand_in.CLIENT_SECRET = 'benchmark'
+    stand_in.USERNAME = 'benchmark'
+    stand_in.PASSWORD = 'benchmark'
+    stand_in.API_URL = api_url
+    # generated posts run from ~1.7 down to ~0.8 upvotes/s, so only the top of the listing gets posted
+    stand_in.VALUES_FOR_SUBREDDIT = {SUBREDDIT: [1.2, 1.0, 0.8, 0.6, 0.4]}
+    stand_in.BANNED_PAGE_WORDS = {SUBREDDIT: ['nsfw']}
+    stand_in.HASHTAGS_FOR_SUBREDDIT = {SUBREDDIT: '#benchmark'}
+    stand_in.ACCOUNT_NAME_FOR_SUBREDDIT = {SUBREDDIT: 'benchmark'}
+    stand_in.ACCOUNT_PASSWORD_FOR_SUBREDDIT = {SUBREDDIT: 'benchmark'}
+    sys.modules['secrets'] = stand_in
+
+
+class StageTimer():
+    """Wraps functions in place and adds up the time spent in each (summed across threads)"""
+    def __init__(self):
+        self.seconds = collections.Counter()
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+        timer = self
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                with timer._lock:
+                    timer.seconds[stage] += time.perf_counter() - start
+                    timer.calls[stage] += 1
+        setattr(owner, name, timed)
+
+    def reset(self):
+        self.seconds.clear()
+        self.calls.clear()
+
+
+def instrument(timer):
+    import image
+    import metadata_cache
+    import phash
+    import posting_queue
+    import processing
+    import reddit_scraper
+    import write_buffer
+    timer.wrap(reddit_scraper.RedditScraper, 'get_listing_page', 'listing fetch')
+    timer.wrap(metadata_cache.MetadataCache, 'prefetch', 'metadata lookup')
+    timer.wrap(reddit_scraper.ScrapeRun, 'download', 'download')
+    timer.wrap(phash.PhashIndex, 'claim', 'dedup')
+    timer.wrap(reddit_scraper, 'score_batch', 'scoring')
+    timer.wrap(processing.Processor, 'process', 'processing')
+    timer.wrap(image.Image, '_ingest', 's3 upload')
+    timer.wrap(image.Image, '_put_dynamodb', 'db write')
+    timer.wrap(image.Image, 'update_image', 'db write')
+    timer.wrap(image.Image, 'post_to_instagram', 'post enqueue')
+    timer.wrap(posting_queue.PostingQueue, '_post', 'post (worker)')
+    timer.wrap(write_buffer.WriteBuffer, 'close', 'db flush')
+
+
+def load_pages(path):
+    with open(path) as f:
+        recorded = json.load(f)
+    # either a single listing response or a list of pages
+    return recorded if isinstance(recorded, list) else [recorded]
+
+
+@click.command()
+@click.option('--posts', default=100, help='number of posts in the generated listing')
+@click.option('--listing', 'listing_path', default=None, type=click.Path(exists=True),
+    help='recorded listing JSON (one response or a list of pages) instead of a generated one')
+@click.option('--runs', default=2, help='scrape_and_store runs, the first sees everything as new')
+@click.option('--aws-latency', default=0.0, help='seconds added to every dynamo/s3 call')
+@click.option('--reddit-latency', default=0.0, help='seconds added to every reddit call')
+@click.option('--http-latency', default=0.0, help='seconds added to every image/posting request')
+@click.option('--in-memory', is_flag=True)
+@click.option('--json-output', is_flag=True, help='print the report as JSON')
+@click.option('--max-aws-calls-per-image', default=None, type=float, help='fail if any run goes over this')
+def main(posts, listing_path, runs, aws_latency, reddit_latency, http_latency, in_memory, json_output, max_aws_calls_per_image):
+    from benchmarks import fakes
+
+    with fakes.LocalServer(http_latency) as server, tempfile.TemporaryDirectory() as workdir:
+        install_secrets(server.url)
+        import clients
+        import image
+        import phash
+        import posting_queue
+        import reddit_scraper
+        import seen_index
+        from downloader import Downloader
+
+        # keep the per-subreddit state (image cache, indexes) out of the repo
+        reddit_scraper.get_current_dir = lambda: workdir
+        image.get_current_dir = lambda: workdir
+        os.makedirs(os.path.join(workdir, SUBREDDIT), exist_ok=True)
+        phash._shared_indexes.clear()
+        seen_index._shared_indexes.clear()
+        posting_queue._shared_queues.clear()
+
+        pages = load_pages(listing_path) if listing_path else fakes.make_listing_pages(server.url, SUBREDDIT, posts)
+        num_posts = sum(len(page['data']['children']) for page in pages)
+        dynamodb = fakes.FakeDynamoDB(aws_latency)
+        dynamodb.tables['account-state'][dynamodb._key({'account': {'S': 'benchmark'}})] = {
+            'account': {'S': 'benchmark'}, 'posts_today': {'N': '0'}}
+        s3 = fakes.FakeS3(aws_latency)
+        reddit = fakes.FakeRedditSession(pages, reddit_latency)
+        clients.reset()
+        clients.install('dynamodb', dynamodb)
+        clients.install('s3', s3)
+        clients.install('reddit', reddit)
+
+        timer = StageTimer()
+        instrument(timer)
+        # the image host is local, so the per-host token bucket (2 req/s by default) would be all the download stage measures
+        downloader = Downloader(host_rate=LOCAL_HOST_RATE, host_burst=LOCAL_HOST_RATE)
+        scraper = reddit_scraper.RedditScraper(SUBREDDIT, max_pages=len(pages), page_size=100, in_memory=in_memory,
+            downloader=downloader)
+        # same as running build-index against the (empty) table before the first scrape
+        seen_index.build_from_table(scraper.seen_index, dynamodb)
+
+        reports = []
+        failed = False
+        for run in range(runs):
+            timer.reset()
+            counters = [dynamodb, s3, reddit, server.counter]
+            before = [collections.Counter(counter.calls) for counter in counters]
+            start = time.perf_counter()
+            images = scraper.scrape_and_store()
+            # posts go out on the worker thread, count them as part of the run
+            scraper.posting_queue.drain()
+            wall = time.perf_counter() - start
+            calls = {name: dict(counter.calls - previous) for name, counter, previous
+                in zip(['dynamodb', 's3', 'reddit', 'http'], counters, before)}
+            aws_calls = sum(calls['dynamodb'].values()) + sum(calls['s3'].values())
+            per_image = aws_calls / max(len(images), 1)
+            reports.append({
+                'run': run + 1,
+                'posts': num_posts,
+                'images': len(images),
+                'wall_s': round(wall, 3),
+                'stages_s': {stage: round(seconds, 3) for stage, seconds in timer.seconds.most_common()},
+                'calls': calls,
+                'aws_calls_per_image': round(per_image, 2),
+                'http_calls_per_image': round(sum(calls['http'].values()) / max(len(images), 1), 2),
+            })
+            if max_aws_calls_per_image is not None and per_image > max_aws_calls_per_image:
+                failed = True
+        scraper.posting_queue.stop()
+
+    if json_output:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            print('run {run}: {images}/{posts} images in {wall_s}s, {aws_calls_per_image} aws calls/image, '
+                '{http_calls_per_image} http calls/image'.format(**report))
+            for stage, seconds in report['stages_s'].items():
+                print('    {:<16} {:>8.3f}s'.format(stage, seconds))
+            for service, service_calls in report['calls'].items():
+                print('    {:<16} {}'.format(service, service_calls))
+    if failed:
+        print('aws calls per image went over {}'.format(max_aws_calls_per_image))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
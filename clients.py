@@ -0,0 +1,108 @@
+"""Shared AWS clients and HTTP sessions.
+
+Everything in the scraper should get its clients from here so that credentials are resolved,
+connection pools are built and TLS handshakes happen once per process instead of per call.
+boto3 clients are thread-safe once created, boto3 sessions are not, so creation is done under a lock."""
+import threading
+#pypi
+import boto3
+import requests
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+#local modules
+import metrics
+
+USER_AGENT_STR = 'request:from:meme:scraper:project:by:evan'
+
+# enough for the downloader/write buffer thread pools to all hold a connection
+MAX_POOL_CONNECTIONS = 32
+
+AWS_CONFIG = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    retries={
+        'max_attempts': 6,
+        'mode': 'adaptive',
+    },
+)
+
+# s3 uploads/downloads above the threshold go as concurrent multipart/ranged requests
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+)
+
+_lock = threading.Lock()
+_boto_session = None
+_aws_clients = {}
+_http_sessions = {}
+
+
+def aws_client(service):
+    global _boto_session
+    with _lock:
+        if service not in _aws_clients:
+            if _boto_session is None:
+                _boto_session = boto3.session.Session()
+            client = _boto_session.client(service, config=AWS_CONFIG)
+            _aws_clients[service] = metrics.instrument_boto_client(client, service)
+        return _aws_clients[service]
+
+
+def dynamodb():
+    return aws_client('dynamodb')
+
+
+def s3():
+    return aws_client('s3')
+
+
+def _build_http_session(retry_statuses):
+    session = requests.Session()
+    # connection level retries only for idempotent requests - posting does its own thing
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=retry_statuses, allowed_methods=['GET', 'HEAD'])
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=MAX_POOL_CONNECTIONS, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['User-Agent'] = USER_AGENT_STR
+    return session
+
+
+def http_session(name):
+    with _lock:
+        if name not in _http_sessions:
+            # the image downloader handles 429/5xx itself so it can back off per host
+            retry_statuses = [] if name == 'images' else [502, 503, 504]
+            _http_sessions[name] = metrics.instrument_http_session(_build_http_session(retry_statuses), name)
+        return _http_sessions[name]
+
+
+def reddit_session():
+    return http_session('reddit')
+
+
+def image_session():
+    return http_session('images')
+
+
+def posting_session():
+    return http_session('posting')
+
+
+def install(name, client):
+    """ Swaps in a client/session under a service or session name, e.g. install('dynamodb', fake) for benchmarks """
+    with _lock:
+        if name in ('reddit', 'images', 'posting'):
+            _http_sessions[name] = client
+        else:
+            _aws_clients[name] = client
+
+
+def reset():
+    global _boto_session
+    with _lock:
+        _aws_clients.clear()
+        _http_sessions.clear()
+        _boto_session = None
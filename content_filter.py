@@ -0,0 +1,130 @@
+import threading
+import time
+from urllib.parse import urlparse
+#local modules
+import metrics
+import secrets
+
+# links that aren't a single still image we can download
+BLOCKED_URL_PREFIXES = [
+    "https://www.reddit.com/r/",
+    "https://v.redd.it/",
+    "https://www.youtube.com/",
+]
+# matched as plain suffixes of the url, like the old endswith checks
+BLOCKED_URL_SUFFIXES = ['gif', 'gifv']
+
+_END = object()
+
+
+class PrefixTrie():
+    """Character trie, so testing a url against every blocked prefix is one walk over the url"""
+    def __init__(self, prefixes=()):
+        self.root = {}
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[_END] = prefix
+
+    def match(self, s):
+        """ Returns the blocked prefix s starts with, or None """
+        node = self.root
+        for char in s:
+            if _END in node:
+                return node[_END]
+            node = node.get(char)
+            if node is None:
+                return None
+        return node.get(_END)
+
+
+class ContentFilter():
+    """One subreddit's download and posting rules, compiled once into set/trie lookups.
+
+    Runs on the raw listing dicts so rejected posts never become Image objects, and keeps
+    a hit count per rule plus the time spent filtering."""
+    def __init__(self, subreddit=None):
+        self.subreddit = subreddit
+        self.prefixes = PrefixTrie(BLOCKED_URL_PREFIXES + getattr(secrets, 'BLOCKED_URL_PREFIXES', []))
+        self.suffixes = frozenset(BLOCKED_URL_SUFFIXES)
+        self.suffix_lengths = sorted({len(suffix) for suffix in self.suffixes})
+        self.domains = frozenset(getattr(secrets, 'BLOCKED_DOMAINS', []))
+        # the nested loop in should_post_to_instagram compared whole lowercased words, so a set does the same job.
+        # subreddits that are only downloaded (e.g. backfilled) have no posting rules in secrets
+        self.banned_words = frozenset(getattr(secrets, 'BANNED_PAGE_WORDS', {}).get(subreddit, []))
+        self.hits = {}
+        self.checked = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def rejection(self, post_json):
+        """ Name of the first rule that rejects the post, or None if it's a downloadable image """
+        # images seem to be the only form of media that uses the thumbnail tag
+        if post_json["thumbnail"] == "":
+            return 'no_thumbnail'
+        if "preview" not in post_json:
+            return 'no_preview'
+        url = post_json["url"]
+        if self.prefixes.match(url) is not None:
+            return 'blocked_prefix'
+        for length in self.suffix_lengths:
+            if url[-length:] in self.suffixes:
+                return 'blocked_suffix'
+        if self.domains and urlparse(url).netloc in self.domains:
+            return 'blocked_domain'
+        secure_media = post_json["secure_media"]
+        if secure_media is not None and "reddit_video" in secure_media:
+            return 'reddit_video'
+        return None
+
+    def is_downloadable(self, post_json):
+        start = time.perf_counter()
+        rule = self.rejection(post_json)
+        elapsed = time.perf_counter() - start
+        metrics.observe('stage_seconds', elapsed, stage='filter')
+        if rule is not None:
+            metrics.incr('filter_rejections_total', rule=rule)
+        with self._lock:
+            self.checked += 1
+            self.seconds += elapsed
+            if rule is not None:
+                self.hits[rule] = self.hits.get(rule, 0) + 1
+        return rule is None
+
+    def banned_word(self, title):
+        if not self.banned_words:
+            return None
+        for word in title.split(" "):
+            if word.lower() in self.banned_words:
+                return word
+        return None
+
+    def has_banned_words(self, title):
+        word = self.banned_word(title)
+        if word is not None:
+            with self._lock:
+                self.hits['banned_word'] = self.hits.get('banned_word', 0) + 1
+        return word is not None
+
+    def report(self):
+        with self._lock:
+            return {
+                'checked': self.checked,
+                'rejected': dict(self.hits),
+                'us_per_post': round(1e6 * self.seconds / self.checked, 2) if self.checked else 0,
+            }
+
+
+_filters = {}
+_filters_lock = threading.Lock()
+
+def get_filter(subreddit=None):
+    """ Compiled filter for a subreddit, built on first use and shared afterwards """
+    with _filters_lock:
+        if subreddit not in _filters:
+            _filters[subreddit] = ContentFilter(subreddit)
+        return _filters[subreddit]
@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+#pypi
+import requests
+#local modules
+import clients
+import metrics
+
+# requests per second we allow against each image host before any feedback from the host
+DEFAULT_HOST_RATE = 2.0
+DEFAULT_HOST_BURST = 4
+MIN_HOST_RATE = 0.1
+MAX_ATTEMPTS = 4
+CHUNK_SIZE = 64 * 1024
+
+
+class TokenBucket():
+    """Token bucket rate limiter. Rate is adjusted up and down by the downloader as a host responds."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.max_rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def throttled(self, retry_after=None):
+        # multiplicative decrease, and respect Retry-After if the host sent one
+        with self._lock:
+            self.rate = max(MIN_HOST_RATE, self.rate / 2)
+            self.tokens = 0
+            if retry_after:
+                self.blocked_until = time.monotonic() + retry_after
+
+    def succeeded(self):
+        # additive increase back towards the configured rate
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+
+class HostStats():
+    """Per host counters, updated from every download thread so only through add()"""
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.bytes = 0
+        self.latency = 0.0 # total seconds spent in requests
+        self._lock = threading.Lock()
+
+    def add(self, requests=0, errors=0, throttled=0, size=0, latency=0.0):
+        with self._lock:
+            self.requests += requests
+            self.errors += errors
+            self.throttled += throttled
+            self.bytes += size
+            self.latency += latency
+
+    def report(self):
+        with self._lock:
+            return self._report()
+
+    def _report(self):
+        mean_latency = self.latency / self.requests if self.requests else 0
+        throughput = self.bytes / self.latency if self.latency else 0
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'throttled': self.throttled,
+            'bytes': self.bytes,
+            'mean_latency_s': round(mean_latency, 3),
+            'throughput_kBps': round(throughput / 1024, 1),
+        }
+
+
+def parse_retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class Downloader():
+    """Concurrent image downloader: pooled keep-alive session, bounded worker pool, per-host token buckets"""
+    def __init__(self, max_workers=8, host_rate=DEFAULT_HOST_RATE, host_burst=DEFAULT_HOST_BURST, session=None):
+        self.max_workers = max_workers
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.session = session or clients.image_session()
+        self._buckets = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _host(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.host_rate, self.host_burst)
+                self._stats[host] = HostStats()
+            return host, self._buckets[host], self._stats[host]
+
+    @metrics.timed('download')
+    def download(self, url, filename=None, fileobj=None, digest=None):
+        """ Downloads url to filename (or into a writable fileobj), returns True on success. Safe to call from many threads.
+        A digest (e.g. hashlib.sha256()) is fed the content as it streams, only retried statuses come before the body. """
+        host, bucket, stats = self._host(url)
+        for attempt in range(MAX_ATTEMPTS):
+            bucket.acquire()
+            start = time.monotonic()
+            try:
+                with self.session.get(url, stream=True, timeout=(5, 30)) as response:
+                    if response.status_code == 429 or response.status_code >= 500:
+                        stats.add(throttled=1)
+                        metrics.incr('retries_total', service='images', host=host)
+                        bucket.throttled(parse_retry_after(response))
+                        continue
+                    response.raise_for_status()
+                    if fileobj is not None:
+                        size = self._copy(response, fileobj, digest)
+                    else:
+                        size = self._write(response, filename, digest)
+            except requests.RequestException as e:
+                stats.add(errors=1)
+                metrics.incr('errors_total', service='images', host=host)
+                print('download failed ({}): {}'.format(url, e))
+                return False
+            finally:
+                stats.add(requests=1, latency=time.monotonic() - start)
+            stats.add(size=size)
+            metrics.incr('bytes_total', size, service='images', direction='down')
+            bucket.succeeded()
+            return True
+        stats.add(errors=1)
+        metrics.incr('errors_total', service='images', host=host)
+        print('giving up on {} after {} attempts'.format(url, MAX_ATTEMPTS))
+        return False
+
+    def _write(self, response, filename, digest=None):
+        # write next to the target and rename so a failed download never leaves a partial image
+        tmp_filename = filename + '.part'
+        with open(tmp_filename, 'wb') as f:
+            size = self._copy(response, f, digest)
+        os.replace(tmp_filename, filename)
+        return size
+
+    def _copy(self, response, fileobj, digest=None):
+        size = 0
+        for chunk in response.iter_content(CHUNK_SIZE):
+            fileobj.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+            size += len(chunk)
+        return size
+
+    def download_all(self, jobs):
+        """ jobs is an iterable of (url, filename), returns a list of bools in the same order """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(lambda job: self.download(*job), jobs))
+
+    def report(self):
+        with self._lock:
+            return {host: stats.report() for host, stats in self._stats.items()}
@@ -0,0 +1,199 @@
+"""Engagement time series kept outside the meme-metadata item.
+
+Samples are grouped into one item (or file) per image per time bucket, so nothing grows without
+bound, and appends never need a read first.
+
+Dynamo table layout (ENGAGEMENT_TABLE): hash key `id` (S), range key `bucket` (N, bucket start
+in epoch seconds). Attributes: `o` = every sample's offset in seconds from the bucket start, `v`/`n`
+= its score and comment count, `p` = how many polls of the post came before it (the n its posting
+threshold was picked with, which counts polls whose sample wasn't written). Each sample stands on its own, so a lost or reordered write only
+costs that sample; offsets stay under BUCKET_SECONDS, which keeps dynamo's variable length number
+encoding small.
+
+Plain Python on purpose, this is on the scrape path and numpy can't be imported there (see scoring.py)."""
+import os
+import struct
+import threading
+#local modules
+import clients
+
+ENGAGEMENT_TABLE = 'meme-engagement'
+BUCKET_SECONDS = 24 * 60 * 60
+
+
+def bucket_start(ts, bucket_seconds=BUCKET_SECONDS):
+    return int(ts // bucket_seconds) * bucket_seconds
+
+
+def delta_encode(values):
+    return [b - a for a, b in zip(values[:1] + values[:-1], values)]
+
+
+def delta_decode(base, deltas):
+    values = []
+    for delta in deltas:
+        base += delta
+        values.append(base)
+    return values
+
+
+def thin(timestamps, older_than, resolution):
+    """ Mask keeping every sample newer than older_than, and the first sample of each resolution-second slot before that """
+    keep = []
+    previous_slot = None
+    for ts in timestamps:
+        slot = int(ts // resolution)
+        keep.append(ts >= older_than or slot != previous_slot)
+        previous_slot = slot
+    return keep
+
+
+def _numbers(item, name):
+    return [float(v['N']) for v in item[name]['L']]
+
+
+def _number_list(values):
+    return {'L': [{'N': str(int(v))} for v in values]}
+
+
+class DynamoEngagementStore():
+    """Engagement samples in their own dynamo table, one item per (id, day)"""
+    def __init__(self, client=None, table=ENGAGEMENT_TABLE, bucket_seconds=BUCKET_SECONDS, write_buffer=None):
+        self.client = client or clients.dynamodb()
+        self.table = table
+        self.bucket_seconds = bucket_seconds
+        self.write_buffer = write_buffer
+
+    def append(self, image_id, ts, score, comments, poll):
+        ts = int(ts)
+        bucket = bucket_start(ts, self.bucket_seconds)
+        update = dict(
+            TableName=self.table,
+            Key={'id': {'S': image_id}, 'bucket': {'N': str(bucket)}},
+            UpdateExpression="""SET o = list_append(if_not_exists(o, :empty), :o),
+                v = list_append(if_not_exists(v, :empty), :v),
+                n = list_append(if_not_exists(n, :empty), :n),
+                p = list_append(if_not_exists(p, :empty), :p)""",
+            ExpressionAttributeValues={
+                ':o': _number_list([ts - bucket]),
+                ':v': _number_list([score]),
+                ':n': _number_list([comments]),
+                ':p': _number_list([poll]),
+                ':empty': {'L': []},
+            }
+        )
+        if self.write_buffer is not None:
+            self.write_buffer.update(**update)
+        else:
+            self.client.update_item(**update)
+
+    def _buckets(self, image_id):
+        paginator = self.client.get_paginator('query')
+        pages = paginator.paginate(
+            TableName=self.table,
+            KeyConditionExpression='id = :id',
+            ExpressionAttributeValues={':id': {'S': image_id}},
+            ConsistentRead=False
+        )
+        for page in pages:
+            for item in page['Items']:
+                yield item
+
+    @staticmethod
+    def decode_item(item):
+        """ (timestamps, scores, comments, polls) lists for one bucket item, oldest first """
+        bucket = float(item['bucket']['N'])
+        samples = sorted(zip([bucket + o for o in _numbers(item, 'o')], _numbers(item, 'v'), _numbers(item, 'n'),
+            [int(p) for p in _numbers(item, 'p')]))
+        return [[sample[i] for sample in samples] for i in range(4)]
+
+    def read(self, image_id):
+        """ (timestamps, scores, comments, polls) lists for every sample of an image, oldest first """
+        columns = ([], [], [], [])
+        for item in sorted(self._buckets(image_id), key=lambda item: int(item['bucket']['N'])):
+            for column, values in zip(columns, self.decode_item(item)):
+                column.extend(values)
+        return columns
+
+    def downsample(self, image_id, older_than, resolution=60 * 60):
+        """ Rewrites buckets before older_than keeping one sample per resolution seconds """
+        for item in self._buckets(image_id):
+            bucket = int(item['bucket']['N'])
+            if bucket + self.bucket_seconds > older_than:
+                continue
+            t, s, c, p = self.decode_item(item)
+            keep = thin(t, older_than, resolution)
+            if all(keep):
+                continue
+            item.update({
+                'o': _number_list([ts - bucket for ts, k in zip(t, keep) if k]),
+                'v': _number_list([v for v, k in zip(s, keep) if k]),
+                'n': _number_list([v for v, k in zip(c, keep) if k]),
+                'p': _number_list([v for v, k in zip(p, keep) if k]),
+            })
+            self.client.put_item(TableName=self.table, Item=item)
+
+
+# one base record (ts, score, comments, poll) per file, then one delta record per sample after it
+BASE_RECORD = struct.Struct('<dqqq')
+DELTA_RECORD = struct.Struct('<IiiI')
+
+
+class LocalEngagementStore():
+    """Stand-in for the dynamo table: an append-only binary file of delta records per image"""
+    def __init__(self, root):
+        self.root = root
+        self._last = {} # id -> last (ts, score, comments, poll) written
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, image_id):
+        return os.path.join(self.root, image_id + '.eng')
+
+    def append(self, image_id, ts, score, comments, poll):
+        with self._lock:
+            last = self._last.get(image_id)
+            if last is None and os.path.exists(self.path(image_id)):
+                last = tuple(column[-1] for column in self._read(image_id))
+            if last is None:
+                record = BASE_RECORD.pack(ts, score, comments, poll)
+            else:
+                record = DELTA_RECORD.pack(max(0, int(round(ts - last[0]))), score - last[1], comments - last[2], max(0, poll - last[3]))
+                ts = last[0] + max(0, int(round(ts - last[0])))
+                poll = max(poll, last[3])
+            with open(self.path(image_id), 'ab') as f:
+                f.write(record)
+            self._last[image_id] = (ts, score, comments, poll)
+
+    def _read(self, image_id):
+        with open(self.path(image_id), 'rb') as f:
+            data = f.read()
+        base = BASE_RECORD.unpack_from(data)
+        # a record cut short by a crash mid-append is dropped
+        end = BASE_RECORD.size + (len(data) - BASE_RECORD.size) // DELTA_RECORD.size * DELTA_RECORD.size
+        deltas = list(DELTA_RECORD.iter_unpack(data[BASE_RECORD.size:end]))
+        return tuple(delta_decode(float(base[i]) if i == 0 else base[i], [0] + [delta[i] for delta in deltas]) for i in range(4))
+
+    def read(self, image_id):
+        with self._lock:
+            if not os.path.exists(self.path(image_id)):
+                return [], [], [], []
+            return self._read(image_id)
+
+    def downsample(self, image_id, older_than, resolution=60 * 60):
+        with self._lock:
+            if not os.path.exists(self.path(image_id)):
+                return
+            columns = self._read(image_id)
+            keep = thin(columns[0], older_than, resolution)
+            if all(keep):
+                return
+            t, s, c, p = ([v for v, k in zip(column, keep) if k] for column in columns)
+            records = [BASE_RECORD.pack(t[0], s[0], c[0], p[0])]
+            for dt, ds, dc, dp in zip(delta_encode(t)[1:], delta_encode(s)[1:], delta_encode(c)[1:], delta_encode(p)[1:]):
+                records.append(DELTA_RECORD.pack(int(dt), ds, dc, dp))
+            tmp_path = self.path(image_id) + '.part'
+            with open(tmp_path, 'wb') as f:
+                f.write(b''.join(records))
+            os.replace(tmp_path, self.path(image_id))
+            self._last[image_id] = (t[-1], s[-1], c[-1], p[-1])
@@ -1,24 +1,65 @@
+import contextlib
 import hashlib
+import io
 import os
 import time
-import requests
-import wget
-#pypi
-import boto3
+from urllib.parse import urlencode
 #local modules
+import clients
+import content_filter
+import metrics
+import phash
+import posting_queue
+import processing
 import secrets
+import seen_index
+from downloader import Downloader
 
 CURRENT_BUCKET = 'reddit-memes'
 CURRENT_TABLE = 'meme-metadata'
+CONTENT_PREFIX = 'content'
+HASH_CHUNK_SIZE = 1024 * 1024
 
 # duplicate from reddit_scraper
 def get_current_dir():
     current_dir, executing_file = os.path.split(os.path.abspath(__file__))
     return current_dir
 
+_default_downloader = None
+
+def get_default_downloader():
+    global _default_downloader
+    if _default_downloader is None:
+        _default_downloader = Downloader()
+    return _default_downloader
+
+def image_id_for_url(url):
+    return hashlib.md5(url.encode()).hexdigest()
+
+def content_key(sha256):
+    """ Objects are stored under the sha256 of their bytes, so the same image posted under different urls is stored once """
+    return "{}/{}".format(CONTENT_PREFIX, sha256)
+
+def content_index():
+    """ Content hashes we've already stored, shared by every Image in the process """
+    return seen_index.shared_index(os.path.join(get_current_dir(), 'content_hashes.idx'))
+
+def can_download_post(post_json, subreddit=None):
+    """ Works on the raw listing dict so posts can be dropped before an Image is ever built """
+    return content_filter.get_filter(subreddit).is_downloadable(post_json)
+
+def engagement_length(item):
+    """ How many times a metadata item's post has been polled, as of its last write. num_polls counts the polls
+    whose sample wasn't written too; items from before it was kept had one sample per poll. """
+    if 'num_polls' in item:
+        return int(item['num_polls']['N'])
+    if 'engagement' in item:
+        return len(item['engagement']['M']['timestamps']['L'])
+    return 0
+
 class Image():
     """Image class that stores metadata about an image and its ability to be scraped"""
-    def __init__(self, title, url, timestamp, votes, num_comments, subreddit, subreddit_size, post_json):
+    def __init__(self, title, url, timestamp, votes, num_comments, subreddit, subreddit_size, post_json, metadata_cache=None, write_buffer=None, image_cache=None, media_pool=None, engagement_store=None, posting_queue=None):
         self.title = title
         self.url = url
         self.created = timestamp
@@ -27,32 +68,120 @@ class Image():
         self.subreddit_size = subreddit_size
         self.post_json = post_json
         self.comments = num_comments
-        self.id = hashlib.md5(self.url.encode()).hexdigest()
+        self.id = image_id_for_url(self.url)
         self.posted = False
-        self.in_db = self._is_in_db()
+        self.metadata_cache = metadata_cache
+        self.saved_calls = 0 # get_item calls answered by the metadata cache
+        self.write_buffer = write_buffer
+        self.image_cache = image_cache
+        self.media_pool = media_pool # set when running diskless, see media.py
+        self.media = None
+        self.engagement_store = engagement_store # engagement samples go here instead of the item's lists when set
+        self.posting_queue = posting_queue # shared queue by default, see post_to_instagram
+        self.processed = None # normalized JPEG bytes, see processing.py
+        self.sha256 = None # hex digest of the original's bytes, computed while it downloads
+        self.s3_object = None # key the original was stored under, set by upload_to_s3
+        self.processed_s3_key = None
+        self.skipped_polls = 0 # polls since the last write whose sample wasn't written, see snapshot.py
+        self.phash = None # perceptual hash, set once the image is downloaded
+        self.caption_phash = None # perceptual hash of the caption strips, see phash.hashes
+        self._in_db = None # loaded on first use
+
+    @classmethod
+    def from_record(cls, record, **kwargs):
+        """ Builds an Image from a records.PostRecord, the raw post_json is not kept around """
+        return cls(
+            record.title,
+            record.url,
+            record.created,
+            record.votes,
+            record.comments,
+            record.subreddit,
+            record.subreddit_size,
+            None,
+            **kwargs
+        )
+
+    @property
+    def in_db(self):
+        if self._in_db is None:
+            self._in_db = self._is_in_db()
+        return self._in_db
 
     def can_download(self):
-        is_reddit_video = self.post_json["secure_media"] is not None and "reddit_video" in self.post_json["secure_media"]
-        return self.post_json["thumbnail"] != "" \
-            and "preview" in self.post_json \
-            and not self.post_json["url"].startswith("https://www.reddit.com/r/") \
-            and not self.post_json["url"].startswith("https://v.redd.it/") \
-            and not self.post_json["url"].startswith("https://www.youtube.com/") \
-            and not (self.post_json["url"].endswith('gif') or self.post_json["url"].endswith('gifv')) \
-            and not is_reddit_video
-
-    def download_source(self):
+        if self.post_json is None:
+            # built from a PostRecord, which only exists for posts that passed can_download_post
+            return True
+        return can_download_post(self.post_json, self.subreddit)
+
+    def image_path(self):
+        if self.image_cache is not None:
+            return self.image_cache.path(self.id)
+        return "{dir}/{sub}/images/{f}".format(
+            dir=get_current_dir(),
+            sub=self.subreddit,
+            f=self.id)
+
+    @contextlib.contextmanager
+    def open_image(self):
+        """ Readable file object for the image, from the in-memory buffer if there is one """
+        if self.media is not None:
+            image_file = self.media.open()
+        else:
+            image_file = open(self.image_path(), 'rb')
+        try:
+            yield image_file
+        finally:
+            image_file.close()
+
+    def release_media(self):
+        self.processed = None
+        if self.media is not None:
+            self.media.close()
+            self.media = None
+
+    def download_source(self, downloader=None):
         print(self.url)
+        downloader = downloader or get_default_downloader()
+        digest = hashlib.sha256()
+        if self.media_pool is not None:
+            media = self.media_pool.buffer()
+            if not downloader.download(self.url, fileobj=media, digest=digest):
+                media.close()
+                return False
+            self.media = media.finish()
+            self.sha256 = digest.hexdigest()
+            return True
+        downloaded = downloader.download(self.url, self.image_path(), digest=digest)
+        if downloaded:
+            self.sha256 = digest.hexdigest()
+            if self.image_cache is not None:
+                self.image_cache.add(self.id)
+        return downloaded
+
+    def content_sha256(self):
+        """ The hash from the download, or read back from the file for images that came from S3 """
+        if self.sha256 is None:
+            digest = hashlib.sha256()
+            with self.open_image() as image_file:
+                for chunk in iter(lambda: image_file.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            self.sha256 = digest.hexdigest()
+        return self.sha256
+
+    def content_size(self):
+        if self.media is not None:
+            return self.media.size
+        return os.path.getsize(self.image_path())
+
+    @metrics.timed('phash')
+    def compute_phash(self):
         try:
-            current_dir = get_current_dir()
-            wget.download(self.url, out="{dir}/{sub}/images/{f}".format(
-                dir=current_dir, 
-                sub=self.subreddit, 
-                f=self.id)
-            )
+            with self.open_image() as image_file:
+                self.phash, self.caption_phash = phash.hashes(image_file)
         except Exception as e:
-            print(e)
-        time.sleep(5)
+            print('could not hash image {}: {}'.format(self.id, e))
+        return self.phash
 
     def get_tag_set(self):
         return [
@@ -70,54 +199,119 @@ class Image():
             },
         ]
 
+    def s3_key(self):
+        """ Where images were stored before content addressing, still used for items without an s3_key """
+        return "{sub}/{id}".format(sub=self.subreddit, id=self.id)
+
+    def stored_s3_key(self):
+        item = self._get_item().get('Item', {})
+        if 's3_key' in item:
+            return item['s3_key']['S']
+        return self.s3_key()
+
+    def upload_to_s3(self):
+        """ Stores the original (and the processed copy) under their content hashes, returns the original's key or None """
+        if not self.ensure_image_downloaded():
+            return None
+        tags = [(tag['Key'], tag['Value']) for tag in self.get_tag_set()]
+        self.s3_object = self._ingest(self.open_image, self.content_sha256(), self.content_size(), tags)
+        if self.processed is not None:
+            processed = self.processed
+            self.processed_s3_key = self._ingest(lambda: io.BytesIO(processed), hashlib.sha256(processed).hexdigest(),
+                len(processed), tags + [('variant', 'processed')], content_type='image/jpeg')
+        return self.s3_object
+
     def upload_image(self):
-        object_name = "{sub}/{id}".format(sub=self.subreddit, id=self.id)
-        if self.ensure_image_downloaded():
-            self._load_file_in_s3_bucket(object_name)
-            self._add_s3_tagging(object_name)
+        object_name = self.upload_to_s3()
+        if object_name is not None:
             # upload to dynamodb
             self._put_dynamodb(object_name)
 
     def update_image(self):
-        client = boto3.client('dynamodb')
-        response = client.get_item( # switch to batch get item to optimize DB calls
-            TableName=CURRENT_TABLE,
-            Key={'id': {'S': self.id}}
-        )
+        response = self._get_item()
 
         if 'Item' not in response:
             print('Image we want to update does not exist in the database yet, id=' + self.id) 
             self.upload_image()
             return
 
+        if self.engagement_store is not None:
+            self._record_engagement()
+            return
 
-        # Get size of engagement log
-        n = len(response['Item']['engagement']['M']['timestamps']['L'])
-
-        client.update_item(
-            TableName=CURRENT_TABLE,
+        # list_append instead of indexing by the log length, so the write doesn't depend on what we read
+        poll = self.engagement_length()
+        update = dict(
             Key={'id': {'S': self.id}},
             UpdateExpression=
-                """SET engagement.scores[{N}] = :s, engagement.num_comments[{N}] = :c, 
-                engagement.#ts[{N}] = :t, current_score = :s, current_num_comments = :c, posted = :p"""
-                .format(N=n),
+                """SET engagement.scores = list_append(engagement.scores, :sl),
+                engagement.num_comments = list_append(engagement.num_comments, :cl),
+                engagement.#ts = list_append(engagement.#ts, :tl),
+                engagement.polls = list_append(if_not_exists(engagement.polls, :empty), :pl),
+                current_score = :s, current_num_comments = :c, posted = :p, num_polls = :n""",
             ExpressionAttributeNames={
                 "#ts": "timestamps"
             },
             ExpressionAttributeValues={
+                ":sl": {"L": [{"N": str(self.votes)}]},
+                ":cl": {"L": [{"N": str(self.comments)}]},
+                ":tl": {"L": [{"N": str(time.time())}]},
+                ":pl": {"L": [{"N": str(poll)}]},
+                ":empty": {"L": []},
                 ":s": {"N": str(self.votes)},
                 ":c": {"N": str(self.comments)},
-                ":t": {"N": str(time.time())},
-                ":p": {"BOOL": self.posted}
+                ":p": {"BOOL": self.posted},
+                ":n": {"N": str(poll + 1)}
             }
         )
+        if self.write_buffer is not None:
+            self.write_buffer.update(**update)
+        else:
+            client = clients.dynamodb()
+            client.update_item(TableName=CURRENT_TABLE, **update)
 
-    def _is_in_db(self):
-        client = boto3.client('dynamodb')
-        response = client.get_item(
-            TableName=CURRENT_TABLE,
-            Key={'id': {'S': self.id}}
+    def _record_engagement(self):
+        """ Appends a sample to the engagement store, the metadata item only keeps the latest values and the poll count """
+        now = time.time()
+        poll = self.engagement_length()
+        self.engagement_store.append(self.id, now, self.votes, self.comments, poll)
+
+        update = dict(
+            Key={'id': {'S': self.id}},
+            UpdateExpression="SET current_score = :s, current_num_comments = :c, posted = :p, last_sampled = :t, num_polls = :n",
+            ExpressionAttributeValues={
+                ":s": {"N": str(self.votes)},
+                ":c": {"N": str(self.comments)},
+                ":p": {"BOOL": self.posted},
+                ":t": {"N": str(int(now))},
+                ":n": {"N": str(poll + 1)}
+            }
         )
+        if self.write_buffer is not None:
+            self.write_buffer.update(**update)
+        else:
+            client = clients.dynamodb()
+            client.update_item(TableName=CURRENT_TABLE, **update)
+
+    def _get_item(self):
+        """get_item on the metadata table, answered from the per-run cache when it was prefetched"""
+        if self.metadata_cache is not None and self.id in self.metadata_cache:
+            self.saved_calls += 1
+            item = self.metadata_cache.get(self.id)
+            return {'Item': item} if item is not None else {}
+
+        client = clients.dynamodb()
+        with metrics.timer('dynamodb_read'):
+            response = client.get_item(
+                TableName=CURRENT_TABLE,
+                Key={'id': {'S': self.id}}
+            )
+        if self.metadata_cache is not None:
+            self.metadata_cache.put(self.id, response.get('Item'))
+        return response
+
+    def _is_in_db(self):
+        response = self._get_item()
         # This is the condition for 'presence' in the database
         in_db = 'Item' in response
         if in_db:
@@ -125,43 +319,65 @@ class Image():
         return in_db
 
     def _image_was_posted(self):
-        client = boto3.client('dynamodb')
-        response = client.get_item(
-            TableName=CURRENT_TABLE,
-            Key={'id': {'S': self.id}}
-        )
+        response = self._get_item()
         # This is the condition for 'presence' in the database
         if 'Item' in response and 'posted' in response['Item']:
             return response['Item']['posted']['BOOL'] # god I hate dynamodb
         return False
 
     def ensure_image_downloaded(self):
-        current_dir = get_current_dir()
-        filename = "{dir}/{sub}/images/{f}".format(
-            dir=current_dir, 
-            sub=self.subreddit, 
-            f=self.id)
-        try:
-            f = open(filename, 'rb')
+        if self.media is not None:
             return True
-        except FileNotFoundError:
-            # download image from s3
-            client = boto3.client('s3')
-            current_dir = get_current_dir()
+        if self.media_pool is not None:
+            # diskless mode: pull it from s3 straight into memory
+            media = self.media_pool.buffer()
             try:
-                client.download_file(
-                    Bucket=CURRENT_BUCKET,
-                    # object name (subreddit/id - eg memes/adef1223f47bc95bc95 )
-                    Key="{}/{}".format(self.subreddit, self.id),
-                    Filename=filename
-                )
-                print("downloaded image " + self.id)
-                return True
+                clients.s3().download_fileobj(CURRENT_BUCKET, self.stored_s3_key(), media, Config=clients.TRANSFER_CONFIG)
             except:
+                media.close()
                 print('not in s3')
                 return False
+            self.media = media.finish()
+            return True
+
+        filename = self.image_path()
+        if self.image_cache is not None:
+            if self.image_cache.get(self.id):
+                return True
+        elif os.path.exists(filename):
+            return True
+
+        # download image from s3
+        client = clients.s3()
+        try:
+            client.download_file(
+                Bucket=CURRENT_BUCKET,
+                # content/<sha256>, or subreddit/id for images stored before that (eg memes/adef1223f47bc95bc95 )
+                Key=self.stored_s3_key(),
+                Filename=filename,
+                Config=clients.TRANSFER_CONFIG
+            )
+            print("downloaded image " + self.id)
+        except:
+            print('not in s3')
+            return False
+        if self.image_cache is not None:
+            self.image_cache.add(self.id)
+        return True
+
+    def has_banned_words(self):
+        # filters out all posts with banned words for a specific subreddit
+        return content_filter.get_filter(self.subreddit).has_banned_words(self.title)
+
+    def engagement_length(self):
+        """ How many times we've seen the post: the item's poll count plus the polls skipped since it was written """
+        response = self._get_item()
+        if 'Item' not in response:
+            return 1
+        return engagement_length(response['Item']) + self.skipped_polls
 
     # These requirements will change over time - see analyze.py file for testing 
+    # (scoring.score_batch runs this for a whole listing from the prefetched metadata, analyze.score_arrays is the vectorized version)
     def should_post_to_instagram(self):
         if self._image_was_posted():
             print('image was previously posted')
@@ -171,23 +387,10 @@ class Image():
         ups_ratio = self.votes / time_since_posted #  ups = upvotes per second
         print(ups_ratio)
 
-        # filters out all posts with banned words for a specific
-        for word in secrets.BANNED_PAGE_WORDS[self.subreddit]:
-            for post_word in self.title.split(" "):
-                if word == post_word.lower():
-                    return False
-
-        client = boto3.client('dynamodb')
-        response = client.get_item( # switch to batch get item to optimize DB calls
-            TableName=CURRENT_TABLE,
-            Key={'id': {'S': self.id}}
-        )
+        if self.has_banned_words():
+            return False
 
-        if 'Item' not in response:
-            n = 1
-        else:
-            # Get size of engagement log
-            n = len(response['Item']['engagement']['M']['timestamps']['L'])
+        n = self.engagement_length()
 
         # first X hours of seeing this post (if n < X)
         if n < len(secrets.VALUES_FOR_SUBREDDIT[self.subreddit]):
@@ -197,86 +400,58 @@ class Image():
 
 
     def post_to_instagram(self):
+        """ Queues the image for the posting worker (see posting_queue.py), the upload happens off the scrape loop """
         account_name = secrets.ACCOUNT_NAME_FOR_SUBREDDIT[self.subreddit]
-        account_password = secrets.ACCOUNT_PASSWORD_FOR_SUBREDDIT[self.subreddit]
-
-        client = boto3.client('dynamodb')
-        account_state = client.get_item(
-            TableName='account-state',
-            Key={'account': {'S': account_name}},
-        )
-        # We should post to the main instagram if there are fewer than 2 posts in the last 24 hours
-        # Post to my story otherwise 
-        post_to_main_insta = int(account_state['Item']['posts_today']['N']) < 2
-
-        print("posting image " + self.id)
-        # simply have to use the image path as the data for the form Image element in the post request (if this were a cURL)
-        current_dir = get_current_dir()
-        with open("{dir}/{sub}/images/{f}".format(
-            dir=current_dir, 
-            sub=self.subreddit, 
-            f=self.id), 'rb') as image_file:
-            form_file = {
-                'image': image_file
-            }
-            hashtags = secrets.HASHTAGS_FOR_SUBREDDIT[self.subreddit]
-            caption = self.title + "\n.\n.\n" + hashtags
-            payload = {
-                'caption': caption,
-                'username': account_name,
-                'password': account_password # or just give user auth_token or something
-            }
-
-            if post_to_main_insta:
-                requests.post(secrets.API_URL + '/instant', files=form_file, data=payload)
-            else:
-                requests.post(secrets.API_URL + '/instant', files=form_file, data=payload)
-                # requests.post(secrets.API_URL + '/story', files=form_file, data=payload)
-                print("would post this to story")
+        hashtags = secrets.HASHTAGS_FOR_SUBREDDIT[self.subreddit]
+        caption = self.title + "\n.\n.\n" + hashtags
+        image_bytes = self.processed
+        if image_bytes is None:
+            with self.open_image() as image_file:
+                image_bytes = image_file.read()
+            # seen images come back from S3 as the original, normalize them here (None without Pillow)
+            image_bytes = processing.try_normalize(image_bytes) or image_bytes
 
-        # update account state DDB
-        try:
-            client.update_item(
-                TableName='account-state',
-                Key={'account': {'S': account_name}},
-                UpdateExpression= "ADD posts_today :v",
-                ExpressionAttributeValues={
-                    ":v": {"N": str(1)},
-                }
-            )
-        except Exception as e: 
-            print(e)
+        queue = self.posting_queue or posting_queue.shared_queue(os.path.join(get_current_dir(), 'posting.db'))
+        print("queueing image " + self.id)
+        queue.enqueue(self.id, account_name, caption, image_bytes)
+        queue.start()
         self.posted = True # update the entry in Dynamo
 
-    def _load_file_in_s3_bucket(self, object_name):
-        client = boto3.client('s3')
-        current_dir = get_current_dir()
-        with open("{dir}/{sub}/images/{f}".format(
-            dir=current_dir, 
-            sub=self.subreddit, 
-            f=self.id), 'rb') as image_file:
-
-            client.upload_fileobj(
-                image_file,
-                CURRENT_BUCKET,
-                # object name (subreddit/id - eg memes/adef1223f47bc95bc95 )
-                Key=object_name
-            )
+    def _exists_in_s3(self, client, key):
+        try:
+            client.head_object(Bucket=CURRENT_BUCKET, Key=key)
+            return True
+        except Exception:
+            return False
 
-    def _add_s3_tagging(self, object_name):
-        client = boto3.client('s3')
-        client.put_object_tagging(
-            Bucket=CURRENT_BUCKET,
-            Key=object_name,
-            Tagging={
-                'TagSet': self.get_tag_set()
-            }
-        )
+    def _ingest(self, open_data, sha256, size, tags, content_type=None):
+        """ Stores content under its hash in one tagged PUT (concurrent multipart when it's large), returns the key.
+        Hashes in the local index are never uploaded again. Only objects big enough to go multipart are checked with a
+        HEAD first, a small one costs about as much to put again and stays a single request. """
+        key = content_key(sha256)
+        known = content_index()
+        if sha256 in known:
+            metrics.incr('s3_dedup_total', result='indexed')
+            return key
+        client = clients.s3()
+        if size >= clients.TRANSFER_CONFIG.multipart_threshold and self._exists_in_s3(client, key):
+            metrics.incr('s3_dedup_total', result='head')
+        else:
+            extra_args = {'Tagging': urlencode(tags)}
+            if content_type is not None:
+                extra_args['ContentType'] = content_type
+            with open_data() as data, metrics.timer('s3_upload'):
+                client.upload_fileobj(data, CURRENT_BUCKET, Key=key, ExtraArgs=extra_args, Config=clients.TRANSFER_CONFIG)
+            metrics.incr('s3_dedup_total', result='uploaded')
+            metrics.incr('bytes_total', size, service='s3', direction='up')
+        known.add(sha256)
+        return key
 
     def _put_dynamodb(self, object_name):
         ''' fields:
         "id": self.id # Primary Key
-        "s3_key": object_name
+        "s3_key": object_name # content/<sha256>
+        "content_sha256": self.sha256
         "s3_bucket": CURRENT_BUCKET
         "title": self.title # synonymous with caption
         "url": self.url
@@ -286,35 +461,58 @@ class Image():
             "num_comments": [],
         } 
         '''
-        client = boto3.client('dynamodb')
         print(self.id, self.posted)
-        client.put_item(
-            TableName=CURRENT_TABLE,
-            Item={
-                'community': {'S': self.subreddit},
-                'community_size': {'N': str(self.subreddit_size)},
-                'content_source': {'S': 'reddit.com'},
-                'created': {'N': str(self.created)},
-                'current_score': {'N': str(self.votes)},
-                'current_num_comments': {'N': str(self.comments)},
-                's3_key': {'S': object_name},
-                's3_bucket': {'S': CURRENT_BUCKET},
-                'image_url': {'S': self.url},
-                'id': {'S': self.id}, # Primary Key
-                'associated_text': {'S': self.title},
-                'engagement': {
-                    'M': {
-                        "timestamps": {
-                            "L": [{'N': str(time.time())}]
-                        },
-                        "scores": {
-                            "L": [{'N': str(self.votes)}]
-                        },
-                        "num_comments": {
-                            "L": [{'N': str(self.comments)}]
-                        },
-                    }
-                },
-                'posted': {'BOOL': self.posted}
-            } 
-        )
+        now = time.time()
+        item = {
+            'community': {'S': self.subreddit},
+            'community_size': {'N': str(self.subreddit_size)},
+            'content_source': {'S': 'reddit.com'},
+            'created': {'N': str(self.created)},
+            'current_score': {'N': str(self.votes)},
+            'current_num_comments': {'N': str(self.comments)},
+            's3_key': {'S': object_name},
+            's3_bucket': {'S': CURRENT_BUCKET},
+            'image_url': {'S': self.url},
+            'id': {'S': self.id}, # Primary Key
+            'associated_text': {'S': self.title},
+            'engagement': {
+                'M': {
+                    "timestamps": {
+                        "L": [{'N': str(now)}]
+                    },
+                    "scores": {
+                        "L": [{'N': str(self.votes)}]
+                    },
+                    "num_comments": {
+                        "L": [{'N': str(self.comments)}]
+                    },
+                    "polls": {
+                        "L": [{'N': '0'}]
+                    },
+                }
+            },
+            'posted': {'BOOL': self.posted},
+            'num_polls': {'N': '1'}
+        }
+        if self.engagement_store is not None:
+            # bounded item: the first sample goes to the engagement store like every later one
+            del item['engagement']
+            item['last_sampled'] = {'N': str(int(now))}
+            self.engagement_store.append(self.id, now, self.votes, self.comments, 0)
+        if self.sha256 is not None:
+            item['content_sha256'] = {'S': self.sha256}
+        if self.processed_s3_key is not None:
+            item['processed_s3_key'] = {'S': self.processed_s3_key}
+            item['processed_size'] = {'N': str(len(self.processed))}
+        if self.phash is not None:
+            item['phash'] = {'S': '{:016x}'.format(self.phash)}
+        if self.write_buffer is not None:
+            self.write_buffer.put(item)
+        else:
+            client = clients.dynamodb()
+            client.put_item(
+                TableName=CURRENT_TABLE,
+                Item=item
+            )
+        if self.metadata_cache is not None:
+            self.metadata_cache.put(self.id, item)
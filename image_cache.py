@@ -0,0 +1,99 @@
+import collections
+import os
+import threading
+
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+TMP_SUFFIX = '.part'
+
+
+class ImageCache():
+    """On-disk image cache keyed by Image.id, kept under a byte budget with LRU eviction.
+
+    Files are only ever made visible with os.replace, so a crashed download never leaves a
+    half written image behind. Recency survives restarts through file mtimes."""
+    def __init__(self, root, max_bytes=DEFAULT_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._entries = collections.OrderedDict() # id -> size, least recently used first
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(TMP_SUFFIX):
+                # leftover from an interrupted write
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, image_id, size in sorted(entries):
+            self._entries[image_id] = size
+            self.total_bytes += size
+
+    def path(self, image_id):
+        return os.path.join(self.root, image_id)
+
+    def __contains__(self, image_id):
+        with self._lock:
+            return image_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, image_id):
+        """ Returns the cached file path (and marks it as recently used), or None """
+        with self._lock:
+            if image_id not in self._entries:
+                self.misses += 1
+                return None
+            path = self.path(image_id)
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # someone deleted it behind our back
+                self.total_bytes -= self._entries.pop(image_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(image_id)
+            self.hits += 1
+            return path
+
+    def add(self, image_id):
+        """ Registers a file that was atomically written to path(image_id) """
+        size = os.path.getsize(self.path(image_id))
+        with self._lock:
+            self.total_bytes += size - self._entries.pop(image_id, 0)
+            self._entries[image_id] = size
+            self._evict()
+
+    def evict(self):
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        # never evict the most recent entry, even if it alone is over budget
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            image_id, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(image_id))
+            except FileNotFoundError:
+                pass
+
+    def report(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'files': len(self._entries),
+            'bytes': self.total_bytes,
+        }
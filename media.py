@@ -0,0 +1,92 @@
+import io
+import tempfile
+import threading
+
+DEFAULT_MEMORY_CAP = 256 * 1024 * 1024
+
+
+class MediaPool():
+    """Memory budget shared by every MediaBuffer in a run. Buffers that don't fit spill to disk."""
+    def __init__(self, max_bytes=DEFAULT_MEMORY_CAP, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.in_memory_bytes = 0
+        self.spilled = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        with self._lock:
+            if self.in_memory_bytes + size > self.max_bytes:
+                return False
+            self.in_memory_bytes += size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self.in_memory_bytes -= size
+
+    def buffer(self):
+        return MediaBuffer(self)
+
+
+class MediaBuffer():
+    """One image held as a single immutable bytes object.
+
+    open() hands out BytesIO readers over that same object, which CPython shares instead of
+    copying until someone writes to it, so S3 and the posting API read the very same bytes.
+    If the pool is out of budget the buffer spills to a temp file instead."""
+    def __init__(self, pool):
+        self.pool = pool
+        self.size = 0
+        self.data = None
+        self._chunks = []
+        self._spill = None
+        self._reserved = 0
+
+    @property
+    def spilled(self):
+        return self._spill is not None
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self._spill is not None:
+            self._spill.write(chunk)
+        elif self.pool.reserve(len(chunk)):
+            self._reserved += len(chunk)
+            self._chunks.append(chunk)
+        else:
+            self._spill_to_disk()
+            self._spill.write(chunk)
+        return len(chunk)
+
+    def _spill_to_disk(self):
+        self._spill = tempfile.NamedTemporaryFile(dir=self.pool.spill_dir)
+        for chunk in self._chunks:
+            self._spill.write(chunk)
+        self._chunks = []
+        self.pool.release(self._reserved)
+        self._reserved = 0
+        self.pool.spilled += 1
+
+    def finish(self):
+        """ Call once everything is written. Joins the chunks into the one bytes object readers share. """
+        if self._spill is None:
+            self.data = b''.join(self._chunks)
+            self._chunks = []
+        return self
+
+    def open(self):
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        # separate open file so every reader gets its own position
+        self._spill.flush()
+        return open(self._spill.name, 'rb')
+
+    def close(self):
+        self.data = None
+        self._chunks = []
+        self.pool.release(self._reserved)
+        self._reserved = 0
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
@@ -0,0 +1,65 @@
+import time
+#local modules
+import clients
+import metrics
+from image import CURRENT_TABLE
+
+# BatchGetItem hard limit on keys per request
+BATCH_GET_LIMIT = 100
+MAX_UNPROCESSED_RETRIES = 5
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class MetadataCache():
+    """Per-run cache of meme-metadata items, filled with chunked BatchGetItem calls.
+
+    Ids that were prefetched but are not in the table are remembered as missing,
+    so Image objects never need their own get_item for them."""
+    def __init__(self, client=None, table=CURRENT_TABLE):
+        self.client = client or clients.dynamodb()
+        self.table = table
+        self.reads = 0 # number of BatchGetItem requests issued
+        self._items = {} # id -> item dict, or None if known to not exist
+
+    def prefetch(self, ids):
+        # dedupe while keeping order, and skip anything we already know about
+        pending = [i for i in dict.fromkeys(ids) if i not in self._items]
+        for chunk in chunks(pending, BATCH_GET_LIMIT):
+            for image_id in chunk:
+                self._items[image_id] = None
+            keys = [{'id': {'S': image_id}} for image_id in chunk]
+            self._batch_get(keys)
+
+    def _batch_get(self, keys):
+        request = {self.table: {'Keys': keys}}
+        attempt = 0
+        while request:
+            with metrics.timer('dynamodb_read'):
+                response = self.client.batch_get_item(RequestItems=request)
+            self.reads += 1
+            for item in response.get('Responses', {}).get(self.table, []):
+                self._items[item['id']['S']] = item
+            request = response.get('UnprocessedKeys') or {}
+            if request:
+                metrics.incr('retries_total', service='dynamodb', operation='BatchGetItem')
+                attempt += 1
+                if attempt > MAX_UNPROCESSED_RETRIES:
+                    # fall back to a cache miss for whatever dynamo refused to give us
+                    for key in request.get(self.table, {}).get('Keys', []):
+                        self._items.pop(key['id']['S'], None)
+                    print('giving up on {} unprocessed keys'.format(len(request.get(self.table, {}).get('Keys', []))))
+                    return
+                time.sleep(min(0.05 * (2 ** attempt), 2))
+
+    def __contains__(self, image_id):
+        return image_id in self._items
+
+    def get(self, image_id):
+        return self._items.get(image_id)
+
+    def put(self, image_id, item):
+        self._items[image_id] = item
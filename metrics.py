@@ -0,0 +1,224 @@
+"""Process wide counters, timers and latency histograms for every pipeline stage.
+
+    with metrics.timer('s3_upload'):
+        ...
+    metrics.incr('aws_calls_total', service='s3', operation='PutObject')
+
+Exposed as Prometheus text (render_prometheus / serve) or a JSON snapshot, and profile_run runs
+one call under cProfile."""
+import bisect
+import contextlib
+import cProfile
+import functools
+import json
+import pstats
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, roughly log spaced from a fast dynamo call to a slow posting API upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+class Histogram():
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for upper, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            yield upper, total
+
+
+class Metrics():
+    def __init__(self):
+        self.counters = {} # name -> {label key: value}
+        self.histograms = {} # name -> {label key: Histogram}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, stage, **labels):
+        """ Times a block into stage_seconds{stage=...}, and counts it into stage_errors_total if it raises """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.incr('stage_errors_total', stage=stage, **labels)
+            raise
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+    def timed(self, stage):
+        """ Decorator version of timer """
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': {
+                    name: [dict(labels=dict(key), value=value) for key, value in series.items()]
+                    for name, series in self.counters.items()
+                },
+                'histograms': {
+                    name: [
+                        dict(labels=dict(key), count=h.count, sum=round(h.sum, 6),
+                            buckets={str(upper): count for upper, count in h.cumulative()})
+                        for key, h in series.items()
+                    ]
+                    for name, series in self.histograms.items()
+                },
+            }
+
+    def render_prometheus(self):
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append('# TYPE {} counter'.format(name))
+                for key, value in series.items():
+                    lines.append('{}{} {}'.format(name, _format_labels(key), value))
+            for name, series in sorted(self.histograms.items()):
+                lines.append('# TYPE {} histogram'.format(name))
+                for key, h in series.items():
+                    for upper, count in h.cumulative():
+                        lines.append('{}_bucket{} {}'.format(name, _format_labels(key, [('le', upper)]), count))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(key), h.sum))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(key), h.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def serve(self, port, host='0.0.0.0'):
+        """ Serves /metrics (Prometheus text) and /metrics.json from a daemon thread """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = registry.render_prometheus().encode(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(registry.snapshot()).encode(), 'application/json'
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+registry = Metrics()
+incr = registry.incr
+observe = registry.observe
+timer = registry.timer
+timed = registry.timed
+
+
+def profile_run(f, output_path=None, top=30):
+    """ Runs f() under cProfile, prints the top functions by cumulative time and optionally dumps the stats """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(f)
+    finally:
+        stats = pstats.Stats(profiler)
+        if output_path:
+            stats.dump_stats(output_path)
+        stats.sort_stats('cumulative').print_stats(top)
+
+
+def instrument_boto_client(client, service):
+    """ Per-service call/error/retry counters and latency from botocore's event hooks """
+    starts = threading.local()
+
+    def before_call(model, **kwargs):
+        starts.value = time.perf_counter()
+        incr('aws_calls_total', service=service, operation=model.name)
+
+    def after_call(http_response, parsed, model, **kwargs):
+        start = getattr(starts, 'value', None)
+        if start is not None:
+            observe('aws_call_seconds', time.perf_counter() - start, service=service)
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if retries:
+            incr('aws_retries_total', retries, service=service, operation=model.name)
+        if http_response.status_code >= 400:
+            incr('aws_errors_total', service=service, operation=model.name)
+
+    def after_call_error(event_name, **kwargs):
+        # this event isn't passed the operation model, the name is the last part of the event
+        incr('aws_errors_total', service=service, operation=event_name.rsplit('.', 1)[-1])
+
+    client.meta.events.register('before-call.*', before_call)
+    client.meta.events.register('after-call.*', after_call)
+    client.meta.events.register('after-call-error.*', after_call_error)
+    return client
+
+
+def instrument_http_session(session, name):
+    """ Per-session call/error/byte counters and latency through a requests response hook """
+    def on_response(response, *args, **kwargs):
+        incr('http_calls_total', service=name)
+        observe('http_call_seconds', response.elapsed.total_seconds(), service=name)
+        if response.status_code >= 400:
+            incr('http_errors_total', service=name, status=response.status_code)
+        size = response.headers.get('Content-Length')
+        if size and size.isdigit():
+            incr('http_response_bytes_total', int(size), service=name)
+    session.hooks['response'].append(on_response)
+    return session
@@ -0,0 +1,160 @@
+import os
+import threading
+#pypi (optional) - without Pillow images just aren't hashed and nothing is deduplicated
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+# reposts that were re-encoded/resized usually land within a few bits of the original
+DEFAULT_MAX_DISTANCE = 4
+# captions sit in the top and bottom fifth of most memes, where the 8x8 whole image hash barely sees them:
+# the same template with different text is often 0-4 bits apart, so a match also has to agree on those strips
+CAPTION_STRIP = 5
+CAPTION_MAX_DISTANCE = 3
+HASH_BITS = 64
+
+
+def _dhash(image, hash_size):
+    pixels = list(image.convert('L').resize((hash_size + 1, hash_size), PILImage.LANCZOS).getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def dhash(fileobj, hash_size=8):
+    """ 64 bit difference hash: is each pixel brighter than its right neighbour on a 9x8 greyscale thumbnail """
+    return hashes(fileobj, hash_size)[0]
+
+
+def hashes(fileobj, hash_size=8):
+    """ (whole image dhash, caption dhash), the caption hash being the top and bottom strips' dhashes side by side """
+    if PILImage is None:
+        return None, None
+    with PILImage.open(fileobj) as image:
+        # lets JPEG decode at reduced size, while keeping enough rows for the caption strips
+        image.draft('L', (hash_size * 32, hash_size * 32))
+        image = image.convert('L')
+        width, height = image.size
+        strip = max(1, height // CAPTION_STRIP)
+        top = _dhash(image.crop((0, 0, width, strip)), hash_size)
+        bottom = _dhash(image.crop((0, height - strip, width, height)), hash_size)
+        return _dhash(image, hash_size), (top << HASH_BITS) | bottom
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def caption_distance(a, b):
+    """ Distance of the more different of the two strips """
+    mask = (1 << HASH_BITS) - 1
+    return max(hamming(a >> HASH_BITS, b >> HASH_BITS), hamming(a & mask, b & mask))
+
+
+class MultiIndexHash():
+    """Multi-index hashing over hamming distance. The hash is split into radius + 1 bands, and anything
+    within radius has to match at least one band exactly, so a search is radius + 1 dict lookups plus
+    a hamming check of whatever shares a band instead of a walk over the stored hashes."""
+    def __init__(self, radius, bits=HASH_BITS):
+        self.radius = radius
+        count = radius + 1
+        widths = [bits // count + (1 if i < bits % count else 0) for i in range(count)]
+        self._bands = [(sum(widths[:i]), (1 << width) - 1) for i, width in enumerate(widths)] # (shift, mask)
+        self._tables = [{} for _ in self._bands] # band value -> [(hash, value)]
+        self.size = 0
+
+    def add(self, hash_value, value):
+        entry = (hash_value, value)
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            table.setdefault((hash_value >> shift) & mask, []).append(entry)
+        self.size += 1
+
+    def search(self, hash_value, radius=None):
+        """ Returns [(distance, hash, value)] for everything within radius (at most the index's), closest first """
+        radius = self.radius if radius is None else min(radius, self.radius)
+        found = {}
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            for stored, value in table.get((hash_value >> shift) & mask, ()):
+                if (stored, value) not in found:
+                    distance = hamming(hash_value, stored)
+                    if distance <= radius:
+                        found[(stored, value)] = distance
+        return sorted(((distance, stored, value) for (stored, value), distance in found.items()), key=lambda match: match[0])
+
+    def __len__(self):
+        return self.size
+
+
+class PhashIndex():
+    """Perceptual hashes of every image we've stored, backed by an append-only text file.
+
+    Each line is `<hash hex>/<caption hash hex> <image id>` and, for images that were dropped as
+    reposts, a third column with the id they duplicate."""
+    def __init__(self, path, max_distance=DEFAULT_MAX_DISTANCE, caption_distance=CAPTION_MAX_DISTANCE):
+        self.path = path
+        self.max_distance = max_distance
+        self.caption_max_distance = caption_distance
+        self.hashes = MultiIndexHash(max_distance)
+        self.captions = {} # id -> caption hash
+        self.duplicate_of = {} # id -> id of the image it reposts
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and '/' in parts[0]:
+                        hash_hex, caption_hex = parts[0].split('/')
+                        self.hashes.add(int(hash_hex, 16), parts[1])
+                        self.captions[parts[1]] = int(caption_hex, 16)
+                    elif len(parts) == 3:
+                        self.duplicate_of[parts[1]] = parts[2]
+
+    @staticmethod
+    def _line(hash_value, caption_hash, *ids):
+        return ' '.join(('{:016x}/{:032x}'.format(hash_value, caption_hash),) + ids) + '\n'
+
+    def _match(self, hash_value, caption_hash, image_id):
+        for _, _, value in self.hashes.search(hash_value):
+            if value == image_id:
+                continue
+            if caption_distance(caption_hash, self.captions[value]) > self.caption_max_distance:
+                # same template, different text
+                continue
+            return value
+        return None
+
+    def claim(self, hash_value, image_id, caption_hash):
+        """ Adds the image and returns None, or records it as a repost and returns the id it duplicates.
+        One lock for both, so two copies of a meme checked at the same time still catch each other. """
+        with self._lock:
+            original_id = self._match(hash_value, caption_hash, image_id)
+            if original_id is not None:
+                self.duplicate_of[image_id] = original_id
+                self._append(self._line(hash_value, caption_hash, image_id, original_id))
+                return original_id
+            self.hashes.add(hash_value, image_id)
+            self.captions[image_id] = caption_hash
+            self._append(self._line(hash_value, caption_hash, image_id))
+            return None
+
+    def _append(self, line):
+        with open(self.path, 'a') as f:
+            f.write(line)
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+_shared_indexes = {}
+_shared_lock = threading.Lock()
+
+def shared_index(path):
+    """ One index per file per process, so daemon scrapers don't each load their own copy """
+    with _shared_lock:
+        if path not in _shared_indexes:
+            _shared_indexes[path] = PhashIndex(path)
+        return _shared_indexes[path]
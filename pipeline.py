@@ -0,0 +1,244 @@
+"""A small staged producer/consumer pipeline.
+
+Each Stage runs its function on a pool of worker threads, reading from a bounded queue and
+writing whatever it returns into the next stage's queue, so a slow stage backs the stages before
+it up instead of letting work pile up in memory, and throughput is set by the slowest stage
+rather than the sum of all of them. A stage function returns the item to pass on, None to drop
+it, or (with batch_size) takes and returns lists. A batch is sent once it's full or batch_wait
+seconds pass without a new item; with batch_wait=None only the end of the input cuts a batch short. An exception only drops the item that raised
+it: it is counted against the stage, handed to on_drop, and every other item keeps flowing.
+cancel() stops the source and every worker at their next item."""
+import queue
+import threading
+import time
+#local modules
+import metrics
+
+DEFAULT_QUEUE_SIZE = 32
+# how often blocked workers look at the cancel flag
+POLL_SECONDS = 0.1
+_DONE = object()
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Stage():
+    def __init__(self, name, fn, workers=1, queue_size=DEFAULT_QUEUE_SIZE, batch_size=None, batch_wait=0.5):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait # seconds a partial batch waits for more items, None to wait for a full batch
+        self.input = queue.Queue(maxsize=queue_size)
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+        self._batch_lock = threading.Lock()
+
+    def report(self):
+        return {'processed': self.processed, 'dropped': self.dropped, 'errors': self.errors, 'seconds': round(self.seconds, 3)}
+
+
+class Pipeline():
+    def __init__(self, source, stages, on_drop=None):
+        """ source is an iterable of items for the first stage, on_drop(item) is called for every item that
+        doesn't make it out the end (filtered or failed), e.g. to release its buffers """
+        self.source = source
+        self.stages = stages
+        self.on_drop = on_drop
+        self.results = []
+        self.error = None # whatever stopped the pipeline, re-raised by run()
+        self._cancelled = threading.Event()
+        self._threads = []
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _put(self, target, item):
+        while True:
+            if self._cancelled.is_set():
+                raise Cancelled()
+            try:
+                target.put(item, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, stage, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._cancelled.is_set():
+                raise Cancelled()
+            wait = POLL_SECONDS if deadline is None else min(POLL_SECONDS, deadline - time.monotonic())
+            if wait <= 0:
+                raise queue.Empty()
+            try:
+                return stage.input.get(timeout=wait)
+            except queue.Empty:
+                continue
+
+    def _emit(self, index, item):
+        if index + 1 < len(self.stages):
+            self._put(self.stages[index + 1].input, item)
+        else:
+            self.results.append(item)
+
+    def _drop(self, item):
+        if self.on_drop is not None:
+            try:
+                self.on_drop(item)
+            except Exception as e:
+                print('on_drop failed: {}'.format(e))
+
+    def _next_batch(self, stage):
+        """ Up to batch_size items, [] once upstream is done. Without a batch_wait one worker fills its batch at a time,
+        so N items take ceil(N / batch_size) calls however many workers the stage has. """
+        if stage.batch_wait is not None:
+            return self._fill_batch(stage)
+        while not stage._batch_lock.acquire(timeout=POLL_SECONDS):
+            if self._cancelled.is_set():
+                raise Cancelled()
+        try:
+            return self._fill_batch(stage)
+        finally:
+            stage._batch_lock.release()
+
+    def _fill_batch(self, stage):
+        """ Takes up to batch_size items, the end marker is put back for the stage's other workers """
+        first = self._get(stage)
+        if first is _DONE:
+            stage.input.put(_DONE)
+            return []
+        batch = [first]
+        while len(batch) < stage.batch_size:
+            try:
+                item = self._get(stage, timeout=stage.batch_wait)
+            except queue.Empty:
+                break
+            if item is _DONE:
+                stage.input.put(_DONE)
+                break
+            batch.append(item)
+        return batch
+
+    def _call(self, stage, work):
+        start = time.perf_counter()
+        try:
+            return stage.fn(work), None
+        except Cancelled:
+            raise
+        except Exception as e:
+            metrics.incr('pipeline_errors_total', stage=stage.name)
+            return None, e
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe('pipeline_stage_seconds', elapsed, stage=stage.name)
+            with stage._lock:
+                stage.seconds += elapsed
+
+    def _work(self, index):
+        stage = self.stages[index]
+        while True:
+            if stage.batch_size:
+                work = self._next_batch(stage)
+                if not work:
+                    return
+            else:
+                work = self._get(stage)
+                if work is _DONE:
+                    # put it back so the stage's other workers see it too
+                    stage.input.put(_DONE)
+                    return
+            inputs = work if stage.batch_size else [work]
+            result, error = self._call(stage, work)
+            if error is not None:
+                with stage._lock:
+                    stage.errors += len(inputs)
+                print('{} failed for {} item(s): {}'.format(stage.name, len(inputs), error))
+                for item in inputs:
+                    self._drop(item)
+                continue
+            if stage.batch_size:
+                # a batch stage may pass on fewer (or different) items than it took
+                outputs = result or []
+                dropped = max(0, len(inputs) - len(outputs))
+            else:
+                outputs = [] if result is None else [result]
+                dropped = 1 - len(outputs)
+                if dropped:
+                    self._drop(work)
+            with stage._lock:
+                stage.processed += len(inputs)
+                stage.dropped += dropped
+            for item in outputs:
+                self._emit(index, item)
+
+    def _run_stage(self, index):
+        stage = self.stages[index]
+        workers = [threading.Thread(target=self._guard, args=(self._work, index), name='{}-{}'.format(stage.name, i), daemon=True)
+            for i in range(stage.workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if not self._cancelled.is_set() and index + 1 < len(self.stages):
+            self._guard(self._put, self.stages[index + 1].input, _DONE)
+
+    def _feed(self):
+        for item in self.source:
+            self._put(self.stages[0].input, item)
+        self._put(self.stages[0].input, _DONE)
+
+    def _guard(self, f, *args):
+        try:
+            f(*args)
+        except Cancelled:
+            pass
+        except Exception as e:
+            # anything escaping a stage (not an item), e.g. the source failing, stops the whole pipeline
+            if self.error is None:
+                self.error = e
+            self.cancel()
+
+    def run(self):
+        """ Runs every stage to completion (or cancellation) and returns what came out of the last stage """
+        self._threads = [threading.Thread(target=self._guard, args=(self._feed,), name='source', daemon=True)]
+        self._threads += [threading.Thread(target=self._run_stage, args=(index,), name=stage.name, daemon=True)
+            for index, stage in enumerate(self.stages)]
+        for thread in self._threads:
+            thread.start()
+        try:
+            for thread in self._threads:
+                while thread.is_alive():
+                    thread.join(POLL_SECONDS)
+        except KeyboardInterrupt:
+            self.cancel()
+            for thread in self._threads:
+                thread.join()
+            raise
+        if self._cancelled.is_set():
+            self._drain()
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+    def _drain(self):
+        for stage in self.stages:
+            while True:
+                try:
+                    item = stage.input.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not _DONE:
+                    self._drop(item)
+
+    def report(self):
+        return {stage.name: stage.report() for stage in self.stages}
@@ -0,0 +1,302 @@
+"""Posting off the scrape loop: a durable SQLite queue and a worker thread that drains it.
+
+Image.post_to_instagram only enqueues (caption, account name and the image bytes, never the
+password - that is looked up in secrets when the post is sent), so a slow posting
+API never holds up a scrape, and anything still queued when the process dies is picked up by the
+next worker. Every controller process runs its own worker on the same database, so a worker claims
+a row (pending -> sending) before posting it and only posts if the claim won; a claim left behind by
+a process that died is handed back after CLAIM_TIMEOUT.
+
+The worker keeps every account's posts_today in memory: the counts are read once per day in one
+BatchGetItem, main feed vs story is decided locally, and the increments are written back in one
+ADD per account every SYNC_INTERVAL seconds instead of a read and a write per post."""
+import datetime
+import random
+import sqlite3
+import threading
+import time
+#local modules
+import clients
+import metrics
+import secrets
+
+ACCOUNT_TABLE = 'account-state'
+# posts per day that go to the main feed, the rest go to the story
+MAIN_FEED_DAILY_LIMIT = 2
+SYNC_INTERVAL = 60
+MAX_ATTEMPTS = 6
+POLL_INTERVAL = 1.0
+POST_TIMEOUT = (10, 120)
+# longer than any one post can take with POST_TIMEOUT
+CLAIM_TIMEOUT = 15 * 60
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS posts (
+    id TEXT PRIMARY KEY,
+    account TEXT NOT NULL,
+    caption TEXT NOT NULL,
+    image BLOB,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    enqueued REAL NOT NULL,
+    claimed_at REAL,
+    error TEXT
+)"""
+
+
+def backoff(attempt):
+    # full jitter, from a few seconds up to ten minutes - the posting API is slow to recover
+    return random.uniform(0, min(5 * (2 ** attempt), 600))
+
+
+def account_password(account):
+    """ Passwords are kept in secrets by subreddit, not in the queue """
+    for subreddit, name in secrets.ACCOUNT_NAME_FOR_SUBREDDIT.items():
+        if name == account:
+            return secrets.ACCOUNT_PASSWORD_FOR_SUBREDDIT[subreddit]
+    raise KeyError('no password in secrets for account ' + account)
+
+
+def utc_day(now=None):
+    return datetime.datetime.utcfromtimestamp(time.time() if now is None else now).date()
+
+
+class AccountQuota():
+    """posts_today for every account, in memory, synced to the account-state table in batches"""
+    def __init__(self, client=None, table=ACCOUNT_TABLE):
+        self.client = client
+        self.table = table
+        self.synced_at = time.monotonic()
+        self._counts = {} # account -> posts today, as far as we know
+        self._unsynced = {} # account -> posts not written back yet
+        self._day = None
+        self._lock = threading.Lock()
+
+    def _load(self, accounts):
+        client = self.client or clients.dynamodb()
+        keys = [{'account': {'S': account}} for account in sorted(set(accounts))]
+        response = client.batch_get_item(RequestItems={self.table: {'Keys': keys}})
+        for item in response.get('Responses', {}).get(self.table, []):
+            self._counts[item['account']['S']] = int(item.get('posts_today', {'N': '0'})['N'])
+
+    def _ensure_loaded(self, account):
+        day = utc_day()
+        if day != self._day:
+            # posts_today is reset in the table at midnight, start again from what it says
+            self._counts.clear()
+            self._day = day
+            self._load(list(secrets.ACCOUNT_NAME_FOR_SUBREDDIT.values()) + [account])
+        elif account not in self._counts:
+            self._load([account])
+        self._counts.setdefault(account, 0)
+
+    def use_main_feed(self, account):
+        with self._lock:
+            self._ensure_loaded(account)
+            return self._counts[account] < MAIN_FEED_DAILY_LIMIT
+
+    def record(self, account):
+        with self._lock:
+            self._counts[account] = self._counts.get(account, 0) + 1
+            self._unsynced[account] = self._unsynced.get(account, 0) + 1
+
+    def sync(self):
+        """ One ADD per account for everything posted since the last sync """
+        with self._lock:
+            unsynced, self._unsynced = self._unsynced, {}
+            self.synced_at = time.monotonic()
+        client = self.client or clients.dynamodb()
+        for account, count in unsynced.items():
+            try:
+                client.update_item(
+                    TableName=self.table,
+                    Key={'account': {'S': account}},
+                    UpdateExpression="ADD posts_today :v",
+                    ExpressionAttributeValues={":v": {"N": str(count)}}
+                )
+            except Exception as e:
+                print('account state sync failed for {}: {}'.format(account, e))
+                with self._lock:
+                    self._unsynced[account] = self._unsynced.get(account, 0) + count
+
+
+class PostingQueue():
+    def __init__(self, path, quota=None):
+        self.path = path
+        self.quota = quota or AccountQuota()
+        self.posted = 0
+        self.failed = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # other processes' workers hold the write lock for a moment while claiming
+        self._db.execute('PRAGMA busy_timeout=5000')
+        self._db.execute(SCHEMA)
+        self._mine = set() # ids enqueued or claimed by this process, what drain() waits for
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._worker = None
+
+    def enqueue(self, image_id, account, caption, image_bytes):
+        """ Returns False if the image was already queued (or posted) """
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                'INSERT OR IGNORE INTO posts (id, account, caption, image, next_attempt, enqueued) VALUES (?, ?, ?, ?, ?, ?)',
+                (image_id, account, caption, image_bytes, now, now))
+        added = cursor.rowcount == 1
+        if added:
+            with self._lock:
+                self._mine.add(image_id)
+            metrics.incr('posts_enqueued_total', account=account)
+            self._wake.set()
+        return added
+
+    def pending(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM posts WHERE status = 'pending'").fetchone()[0]
+
+    def recover_stale_claims(self, timeout=CLAIM_TIMEOUT):
+        """ Hands rows claimed by a worker that died mid-post back to the queue, returns how many """
+        with self._lock:
+            cursor = self._db.execute("UPDATE posts SET status = 'pending', claimed_at = NULL WHERE status = 'sending' AND claimed_at < ?",
+                (time.time() - timeout,))
+        return cursor.rowcount
+
+    def _next_job(self):
+        """ Claims the oldest due row, or returns None. Another process may claim the same row first, then try the next one. """
+        while True:
+            with self._lock:
+                job = self._db.execute(
+                    "SELECT id, account, caption, image, attempts FROM posts WHERE status = 'pending' AND next_attempt <= ? "
+                    "ORDER BY enqueued LIMIT 1", (time.time(),)).fetchone()
+                if job is None:
+                    return None
+                claimed = self._db.execute("UPDATE posts SET status = 'sending', claimed_at = ? WHERE id = ? AND status = 'pending'",
+                    (time.time(), job[0])).rowcount == 1
+            if claimed:
+                with self._lock:
+                    # a leftover this worker picked up is this process's to finish
+                    self._mine.add(job[0])
+                return job
+
+    def _finish(self, image_id):
+        with self._lock:
+            # the image bytes aren't needed once it's posted
+            self._db.execute("UPDATE posts SET status = 'posted', image = NULL, error = NULL, claimed_at = NULL WHERE id = ?", (image_id,))
+            self._mine.discard(image_id)
+
+    def _retry(self, image_id, attempts, error):
+        status = 'failed' if attempts >= MAX_ATTEMPTS else 'pending'
+        with self._lock:
+            self._db.execute('UPDATE posts SET status = ?, attempts = ?, next_attempt = ?, error = ?, claimed_at = NULL WHERE id = ?',
+                (status, attempts, time.time() + backoff(attempts), str(error), image_id))
+            if status == 'failed':
+                self._mine.discard(image_id)
+        return status
+
+    def _post(self, image_id, account, caption, image_bytes):
+        main_feed = self.quota.use_main_feed(account)
+        payload = {
+            'caption': caption,
+            'username': account,
+            'password': account_password(account) # or just give user auth_token or something
+        }
+        with metrics.timer('post'):
+            # story posting isn't live yet, both go to /instant for now (was: secrets.API_URL + '/story')
+            response = clients.posting_session().post(secrets.API_URL + '/instant', files={'image': (image_id, image_bytes)}, data=payload,
+                timeout=POST_TIMEOUT)
+        response.raise_for_status()
+        if not main_feed:
+            print("would post this to story")
+        self.quota.record(account)
+
+    def run_once(self):
+        """ Posts the next due job, returns False if there wasn't one """
+        job = self._next_job()
+        if job is None:
+            return False
+        image_id, account, caption, image_bytes, attempts = job
+        print("posting image " + image_id)
+        try:
+            self._post(image_id, account, caption, image_bytes)
+        except Exception as e:
+            if self._retry(image_id, attempts + 1, e) == 'failed':
+                self.failed += 1
+                metrics.incr('errors_total', stage='post')
+                print('giving up on posting {} after {} attempts: {}'.format(image_id, attempts + 1, e))
+            else:
+                metrics.incr('retries_total', service='posting')
+            return True
+        self._finish(image_id)
+        self.posted += 1
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            if time.monotonic() - self.quota.synced_at >= SYNC_INTERVAL:
+                self.quota.sync()
+            if not self.run_once():
+                self._wake.wait(POLL_INTERVAL)
+                self._wake.clear()
+        self.quota.sync()
+
+    def running(self):
+        with self._lock:
+            return self._worker is not None and self._worker.is_alive()
+
+    def start(self):
+        """ Starts the worker if it isn't running. Call it when a run starts, not only on enqueue, so posts left due
+        (or claimed by a process that died) by earlier runs go out on every run. """
+        if self.running():
+            return
+        self.recover_stale_claims()
+        with self._lock:
+            # what's due now was left by earlier runs, drain() waits for it like for this run's posts
+            self._mine.update(row[0] for row in self._db.execute("SELECT id FROM posts WHERE status = 'pending' AND next_attempt <= ?",
+                (time.time(),)))
+            if self._worker is None or not self._worker.is_alive():
+                self._stop.clear()
+                self._worker = threading.Thread(target=self._run, name='posting-worker', daemon=True)
+                self._worker.start()
+
+    def _due_mine(self):
+        """ How many of this process's posts are being sent or due to be """
+        with self._lock:
+            if not self._mine:
+                return 0
+            rows = self._db.execute("SELECT id FROM posts WHERE status = 'sending' OR (status = 'pending' AND next_attempt <= ?)",
+                (time.time(),)).fetchall()
+            return sum(row[0] in self._mine for row in rows)
+
+    def drain(self, timeout=None):
+        """ Waits until none of the posts this process enqueued (or picked up) are due (retries backing off further than timeout,
+        and other processes' posts, are left for later) """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while deadline is None or time.monotonic() < deadline:
+            if not self._due_mine():
+                return True
+            self._wake.set()
+            time.sleep(0.1)
+        return False
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+
+    def report(self):
+        return '{} posted, {} failed, {} still queued'.format(self.posted, self.failed, self.pending())
+
+
+_shared_queues = {}
+_shared_lock = threading.Lock()
+
+def shared_queue(path):
+    """ One queue (and worker) per database per process """
+    with _shared_lock:
+        if path not in _shared_queues:
+            _shared_queues[path] = PostingQueue(path)
+        return _shared_queues[path]
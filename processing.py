@@ -0,0 +1,129 @@
+"""Normalizes downloaded images before they're uploaded and posted.
+
+Each image is decoded once, rotated upright from its EXIF orientation, centre cropped into the
+posting API's aspect ratio limits, scaled down to MAX_WIDTH and re-encoded as JPEG at the highest
+quality that fits TARGET_BYTES. Decoding and encoding are CPU bound, so they run in a process
+pool. The original is kept as it was downloaded, the processed copy gets its own S3 key."""
+import io
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+#pypi (optional) - without Pillow images are uploaded and posted as downloaded
+try:
+    from PIL import Image as PILImage
+    from PIL import ImageOps
+except ImportError:
+    PILImage = None
+#local modules
+import metrics
+
+# instagram's feed takes 4:5 portrait up to 1.91:1 landscape, 1080px wide
+MIN_ASPECT = 4 / 5
+MAX_ASPECT = 1.91
+MAX_WIDTH = 1080
+TARGET_BYTES = 1024 * 1024
+QUALITIES = (90, 85, 80, 75, 70, 60)
+ORIENTATION_TAG = 0x0112
+
+
+def available():
+    return PILImage is not None
+
+
+def process_pool(max_workers=None):
+    """ A pool whose workers don't fork the scraper: by the time it's used the scraper has download, write buffer and
+    posting threads holding locks (and open sockets), and a forked child would inherit them mid-operation """
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method))
+
+
+def crop_box(width, height, min_aspect=MIN_ASPECT, max_aspect=MAX_ASPECT):
+    """ Centred box that brings width/height inside [min_aspect, max_aspect] """
+    aspect = width / height
+    if aspect < min_aspect:
+        new_height = round(width / min_aspect)
+        top = (height - new_height) // 2
+        return (0, top, width, top + new_height)
+    if aspect > max_aspect:
+        new_width = round(height * max_aspect)
+        left = (width - new_width) // 2
+        return (left, 0, left + new_width, height)
+    return (0, 0, width, height)
+
+
+def normalize(data, max_width=MAX_WIDTH, target_bytes=TARGET_BYTES):
+    """ Processed JPEG bytes for an encoded image, or None if it can't be or doesn't need to be processed.
+    Runs in pool workers, so it only takes and returns plain bytes. """
+    if PILImage is None:
+        return None
+    with PILImage.open(io.BytesIO(data)) as image:
+        if getattr(image, 'is_animated', False):
+            # re-encoding would keep only the first frame
+            return None
+        upright = image.getexif().get(ORIENTATION_TAG, 1) == 1
+        if image.format == 'JPEG' and upright and crop_box(*image.size) == (0, 0) + image.size and \
+                image.width <= max_width and len(data) <= target_bytes:
+            return None
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # JPEG has no alpha, flatten onto white like the posting API would
+            rgba = image.convert('RGBA')
+            image = PILImage.new('RGB', rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.split()[-1])
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        image = image.crop(crop_box(*image.size))
+        if image.width > max_width:
+            image = image.resize((max_width, round(image.height * max_width / image.width)), PILImage.LANCZOS)
+        for quality in QUALITIES:
+            output = io.BytesIO()
+            image.save(output, 'JPEG', quality=quality, optimize=True, progressive=True)
+            if output.tell() <= target_bytes:
+                break
+    return output.getvalue()
+
+
+def try_normalize(data):
+    try:
+        return normalize(data)
+    except Exception as e:
+        # a broken or unusual file is uploaded as it was downloaded
+        print('image processing failed: {}'.format(e))
+        return None
+
+
+class Processor():
+    def __init__(self):
+        self.processed = 0
+        self.skipped = 0
+        self.original_bytes = 0
+        self.processed_bytes = 0
+        self._lock = threading.Lock()
+
+    def record(self, image, original_size):
+        with self._lock:
+            if image.processed is None:
+                self.skipped += 1
+                return
+            self.processed += 1
+            self.original_bytes += original_size
+            self.processed_bytes += len(image.processed)
+        saved = original_size - len(image.processed)
+        metrics.incr('bytes_saved_total', saved)
+        print('processed {}: {} -> {} bytes ({:.0%} saved)'.format(image.id, original_size, len(image.processed), saved / original_size))
+
+    def process(self, image, pool):
+        """ Processes one image on pool (a ProcessPoolExecutor), for callers that already run one image per thread """
+        with image.open_image() as image_file:
+            data = image_file.read()
+        image.processed = pool.submit(try_normalize, data).result()
+        self.record(image, len(data))
+        return image
+
+    @property
+    def bytes_saved(self):
+        return self.original_bytes - self.processed_bytes
+
+    def report(self):
+        return '{} processed, {} kept as downloaded, {} -> {} bytes ({} saved)'.format(
+            self.processed, self.skipped, self.original_bytes, self.processed_bytes, self.bytes_saved)
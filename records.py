@@ -0,0 +1,35 @@
+import sys
+#local modules
+from image import image_id_for_url
+
+
+class PostRecord():
+    """The handful of post fields the pipeline actually reads, without the rest of reddit's payload"""
+    __slots__ = ('id', 'title', 'url', 'created', 'votes', 'comments', 'subreddit', 'subreddit_size')
+
+    def __init__(self, title, url, created, votes, comments, subreddit, subreddit_size):
+        self.id = image_id_for_url(url)
+        self.title = title
+        self.url = url
+        self.created = created
+        self.votes = votes
+        self.comments = comments
+        # one shared string per subreddit no matter how many posts reference it
+        self.subreddit = sys.intern(subreddit)
+        self.subreddit_size = subreddit_size
+
+    @classmethod
+    def from_post(cls, post, subreddit):
+        return cls(
+            post["title"],
+            post["url"],
+            post["created_utc"],
+            post["score"],
+            post["num_comments"],
+            subreddit,
+            post["subreddit_subscribers"]
+        )
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
@@ -4,26 +4,118 @@ import itertools
 import json
 import os
 import re
+import threading
 import time
 #pypi
-import boto3
 import requests
-import wget
 #local modules
+import clients
+import content_filter
+import metrics
+import posting_queue
+import processing
 import secrets
-from image import Image
+import seen_index
+from clients import USER_AGENT_STR
+from downloader import Downloader
+from engagement_store import DynamoEngagementStore, LocalEngagementStore
+from image import Image, can_download_post, content_index
+from image_cache import DEFAULT_CACHE_BYTES, ImageCache
+from media import DEFAULT_MEMORY_CAP, MediaPool
+from metadata_cache import BATCH_GET_LIMIT, MetadataCache
+from phash import shared_index
+from pipeline import Pipeline, Stage
+from processing import Processor
+from records import PostRecord
+from scoring import score_batch
+from snapshot import EngagementSnapshot
+from write_buffer import WriteBuffer
 
 client_id = secrets.CLIENT_ID
 client_secret = secrets.CLIENT_SECRET
 
 client_auth = requests.auth.HTTPBasicAuth(client_id, client_secret)
 
-USER_AGENT_STR = 'request:from:meme:scraper:project:by:evan'
+# refresh the oauth token this many seconds before reddit says it expires
+TOKEN_EXPIRY_MARGIN = 60
+# threads per pipeline stage, the network bound ones get the most
+DEFAULT_STAGE_WORKERS = {
+    'filter': 1,
+    'metadata': 1,
+    'download': 8,
+    'process': os.cpu_count() or 2,
+    'upload': 8,
+    'post': 1,
+    'write': 4,
+}
+
+
+class AccessTokenCache():
+    """Process wide OAuth token, only re-authorized once reddit's expires_in has (nearly) run out"""
+    def __init__(self):
+        self.token = None
+        self.expires_at = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self.token is None or time.time() >= self.expires_at - TOKEN_EXPIRY_MARGIN:
+                self.token, expires_in = request_access_token()
+                self.expires_at = time.time() + expires_in
+            return self.token
+
+    def invalidate(self):
+        with self._lock:
+            self.token = None
+
+
+class RateLimitBudget():
+    """Shared reddit request budget driven by the X-Ratelimit-Remaining/Reset headers.
+
+    Requests are spread evenly over what's left of the current window and, once we are down
+    to `reserve` requests, held until the window resets."""
+    def __init__(self, reserve=5):
+        self.reserve = reserve
+        self.remaining = None # unknown until the first response
+        self.reset_at = 0
+        self.next_request_at = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            if self.remaining is not None and now < self.reset_at:
+                if self.remaining <= self.reserve:
+                    delay = self.reset_at - now
+                else:
+                    delay = max(0, self.next_request_at - now)
+                    self.next_request_at = max(now, self.next_request_at) + \
+                        (self.reset_at - now) / (self.remaining - self.reserve)
+                self.remaining -= 1
+            else:
+                delay = 0
+        if delay > 0:
+            print('reddit rate limit: waiting {:.1f}s'.format(delay))
+            time.sleep(delay)
 
+    def update(self, headers):
+        try:
+            remaining = float(headers['X-Ratelimit-Remaining'])
+            reset = float(headers['X-Ratelimit-Reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._lock:
+            self.remaining = remaining
+            self.reset_at = time.time() + reset
 
-def authorize_reddit():
+
+access_tokens = AccessTokenCache()
+rate_limit_budget = RateLimitBudget()
+
+
+def request_access_token():
     # Application-only authorization
-    r = requests.post(
+    r = clients.reddit_session().post(
         'https://www.reddit.com/api/v1/access_token', 
         auth=client_auth,
         data={
@@ -37,7 +129,12 @@ def authorize_reddit():
     )
 
     if r.ok:
-        return r.json()['access_token']
+        response_json = r.json()
+        return response_json['access_token'], response_json.get('expires_in', 3600)
+    return None, 0
+
+def authorize_reddit():
+    return access_tokens.get()
 
 def s3tagfilter(s):
     # filters out characters that cannot be put into an S3 tag
@@ -47,92 +144,156 @@ def get_current_dir():
     current_dir, executing_file = os.path.split(os.path.abspath(__file__))
     return current_dir
 
+# roughly one request every two seconds... at some point need to test the limits of this
+def get_listing_page(subreddit, listing='hot', params=None):
+    access_token = authorize_reddit()
+    if access_token is None:
+        raise ValueError("Access token was not present. Either include access token or authorize before calling")
+    authorized_header = {
+        "Authorization": "bearer {}".format(access_token),
+        "User-Agent": USER_AGENT_STR
+    }
+    rate_limit_budget.wait()
+    with metrics.timer('listing_fetch'):
+        response = clients.reddit_session().get(
+            "https://oauth.reddit.com/r/{}/{}".format(subreddit, listing),
+            headers=authorized_header,
+            params=params
+        )
+    rate_limit_budget.update(response.headers)
+    if response.status_code == 401:
+        access_tokens.invalidate()
+
+    if not response.ok:
+        raise RuntimeError("Request error :(\n{}".format(response.text))
+    json_response = json.loads(response.text)
+    return json_response
 
 
 class RedditScraper():
-    """Reddit Scraper object that scrapes and stores all hot images from its subreddit."""
-    def __init__(self, subreddit):
+    """Reddit Scraper object that scrapes and stores all hot images from its subreddit.
+
+    listing/time_filter pick the listing (hot, top, new, rising... with t=hour/day/week/...),
+    max_pages is how many `after` pages to follow and page_size the posts per page (max 100).
+    in_memory keeps images in memory from download to upload/post instead of in the disk cache,
+    spilling to disk past memory_cap bytes.
+    engagement_store is 'legacy' (lists inside the meme-metadata item), 'dynamo' (the bounded
+    meme-engagement table) or 'local' (files under <subreddit>/engagement), see engagement_store.py."""
+    def __init__(self, subreddit, listing='hot', time_filter=None, max_pages=1, page_size=25,
+            cache_bytes=DEFAULT_CACHE_BYTES, in_memory=False, memory_cap=DEFAULT_MEMORY_CAP, engagement_store='legacy',
+            significance=None, process_images=True, stage_workers=None, downloader=None):
         self.subreddit = subreddit
-        # Would we ever want to do multiple subreddit scrapes in this file? if so, make this global
-        self.access_token = authorize_reddit()
+        self.image_cache = ImageCache(os.path.join(get_current_dir(), subreddit, 'images'), cache_bytes)
+        self.in_memory = in_memory
+        self.memory_cap = memory_cap
+        self.engagement_store = engagement_store
+        self.significance = significance # SignificanceRule for re-polled posts, None for the default
+        self.process_images = process_images
+        self.stage_workers = stage_workers or {} # overrides for DEFAULT_STAGE_WORKERS
+        self.downloader = downloader # shared Downloader (e.g. with other host rates), a new one per run by default
+        self.phash_index = shared_index(os.path.join(get_current_dir(), 'phash_index.txt'))
+        self.listing = listing
+        self.time_filter = time_filter
+        self.max_pages = max_pages
+        self.page_size = page_size
+        self.posting_queue = posting_queue.shared_queue(os.path.join(get_current_dir(), 'posting.db'))
+        self.seen_index = seen_index.shared_index(os.path.join(get_current_dir(), 'seen_ids.idx'))
         self.existing_image_set = self.get_existing_image_set()
 
+    @property
+    def access_token(self):
+        # shared across every scraper in the process, see AccessTokenCache
+        return authorize_reddit()
+
     @staticmethod
     def get_source():
         return "reddit.com"
 
+    @metrics.timed('scrape')
     def scrape_and_store(self, n=None):
-        subreddit_json = self.get_hot_subreddit_response()
-        content = list(self.build_image_objects(subreddit_json))
-        images = self.filter_images_from_content(content)
-        '''
-        new_images, old_images = self.filter_new_images(images)
-        print('new images')
-        print([image.id for image in new_images])
-        print('old images')
-        print([image.id for image in old_images])
-        # Restrict number of new images for testing so it goes faster
-        if n:
-            new_images = new_images[0:n]
-        self.prepare_to_download_images() # currently removes image files - will want to change to keeping images only in memory
-        self.download_new_images(new_images)
-        self.upload_images_to_instagram(new_images, old_images) # should go before dynamo stuff
-        self.store_new_images(new_images)
-        self.update_old_images(old_images)
-        self.update_existing_image_set_file(images)
-        '''
-
-        self.prepare_to_download_images() # currently removes image files - will want to change to keeping images only in memory
-
-        for image in images:
-            try:
-                if image.in_db: # Seen image
-                    if image.should_post_to_instagram():
-                        image.ensure_image_downloaded()
-                        image.post_to_instagram()
-                    image.update_image()
-                else: # New image
-                    image.download_source()
-                    if image.should_post_to_instagram():
-                        image.post_to_instagram()
-                    image.upload_image() # Handles S3 and DynamoDB posting
-            except Exception as e:
-                print("Image processing failed")
-                print(image.id, image.url)
-                print(e)
-
+        """ Runs the listing through the pipeline stages (see stages()), n limits how many new images are stored """
+        run = ScrapeRun(self, n)
+        # posts still due from earlier runs go out even if this run queues nothing new
+        self.posting_queue.start()
+        self.prepare_to_download_images()
+        scrape = Pipeline(self.iter_listing(), self.stages(run), on_drop=run.drop)
+        try:
+            images = scrape.run()
+        finally:
+            if run.process_pool is not None:
+                run.process_pool.shutdown()
+            # dynamo puts/updates were queued by the write stage - wait for them here
+            run.write_buffer.close()
+            run.snapshot.save()
+            self.seen_index.flush()
+            content_index().flush()
+        for name, stats in scrape.report().items():
+            print('{:<10} {}'.format(name, stats))
+        run.report(images)
+        return images
+
+    def stages(self, run):
+        """ fetch (the listing, in the pipeline's source thread) -> filter -> metadata -> download -> process -> upload -> post -> write.
+        Posting comes before the DB write so the item is written with its posted flag once. """
+        workers = dict(DEFAULT_STAGE_WORKERS, **self.stage_workers)
+        return [
+            Stage('filter', run.filter_post, workers['filter']),
+            # full batches only, so a listing of N posts costs ceil(N/100) reads however slowly its pages arrive
+            Stage('metadata', run.lookup_metadata, workers['metadata'], batch_size=BATCH_GET_LIMIT, batch_wait=None),
+            Stage('download', run.download, workers['download']),
+            Stage('process', run.process, workers['process']),
+            Stage('upload', run.upload, workers['upload']),
+            Stage('post', run.post, workers['post']),
+            Stage('write', run.write, workers['write']),
+        ]
+
+    def build_engagement_store(self, write_buffer):
+        if self.engagement_store == 'dynamo':
+            return DynamoEngagementStore(write_buffer=write_buffer)
+        if self.engagement_store == 'local':
+            return LocalEngagementStore(os.path.join(get_current_dir(), self.subreddit, 'engagement'))
+        return None
+
+    def prefetch_metadata(self, records, metadata_cache):
+        """ Loads the dynamo items for a batch of posts up front (ceil(N/100) reads).
+        Once the seen index holds every stored id, posts it doesn't know are new without asking dynamo. """
+        ids = [record.id for record in records]
+        if self.seen_index.complete:
+            unseen = [image_id for image_id in ids if image_id not in self.seen_index]
+            for image_id in unseen:
+                metadata_cache.put(image_id, None)
+            metrics.incr('seen_index_skipped_reads_total', len(unseen))
+            ids = [image_id for image_id in ids if image_id not in metadata_cache]
+        metadata_cache.prefetch(ids)
+        return metadata_cache
 
     def get_existing_image_set(self):
-        current_dir = get_current_dir()
-        image_ids = set()
-        with open("{}/{}/last_files.txt".format(current_dir, self.subreddit), 'r+') as f:
-            for line in f:
-                if line not in image_ids:
-                    image_ids.add(line.rstrip())
-        return image_ids
+        """ The seen index, with this subreddit's old last_files.txt folded into it on first use """
+        self.seen_index.migrate(os.path.join(get_current_dir(), self.subreddit, 'last_files.txt'))
+        return self.seen_index
 
 
-    # roughly one request every two seconds... at some point need to test the limits of this
-    def get_hot_subreddit_response(self):
-        if self.access_token is None:
-            raise ValueError("Access token was not present. Either include access token or authorize before calling")
-        authorized_header = {
-            "Authorization": "bearer {}".format(self.access_token),
-            "User-Agent": USER_AGENT_STR
-        }
-        response = requests.get(
-            "https://oauth.reddit.com/r/{}/hot".format(self.subreddit), 
-            headers=authorized_header
-        )
+    def get_listing_page(self, listing='hot', params=None):
+        return get_listing_page(self.subreddit, listing, params)
 
-        if not response.ok:
-            raise RuntimeError("Request error :(\n{}".format(response.text))
-        json_response = json.loads(response.text)
-        return json_response
-
-    def filter_images_from_content(self, content_objects):
-        filtered_images = [image for image in content_objects if image.can_download()]
-        return filtered_images 
+    def get_hot_subreddit_response(self):
+        return self.get_listing_page('hot')
+
+    def iter_listing(self):
+        """ Yields raw post dicts from the configured listing, following `after` for up to max_pages pages """
+        after = None
+        for _ in range(self.max_pages):
+            params = {'limit': self.page_size}
+            if self.time_filter:
+                params['t'] = self.time_filter
+            if after:
+                params['after'] = after
+            json_response = self.get_listing_page(self.listing, params)
+            for child in json_response["data"]["children"]:
+                yield child["data"]
+            after = json_response["data"].get("after")
+            if not after:
+                return
 
     def filter_new_images(self, images):
         ''' Returns a tuple of two lists (new, old) where new is images that
@@ -159,45 +320,22 @@ class RedditScraper():
 
         return filtered_images[0:n] if n else filtered_images
 
-    # this step filters duplicates and non-images, and builds Image objects
-    def build_image_objects(self, subreddit_json):
-        posts = [child["data"] for child in subreddit_json["data"]["children"]]
-        for post in posts:
-            # we want to filter videos, gifs, and text posts
-            # so we get only images
-
-            # images seem to be the only form of media that uses the thumbnail tag
-            # so it's an image if thumbnail != ""
-            post_url = post["url"]
-            post_votes = post["score"]
-            post_title = post["title"]
-            post_timestamp_utc = post["created_utc"]
-            post_comments = post["num_comments"]
-            subreddit_size = post["subreddit_subscribers"]
-            # print(json.dumps(post, indent=2))
-            yield Image(
-                post_title,
-                post_url,
-                post_timestamp_utc,
-                post_votes,
-                post_comments,
-                self.subreddit,
-                subreddit_size,
-                post
+    # builds Image objects from PostRecords (posts that already passed can_download_post)
+    def build_image_objects(self, records, metadata_cache=None, write_buffer=None, image_cache=None, media_pool=None, engagement_store=None):
+        for record in records:
+            yield Image.from_record(
+                record,
+                metadata_cache=metadata_cache,
+                write_buffer=write_buffer,
+                image_cache=image_cache,
+                media_pool=media_pool,
+                engagement_store=engagement_store,
+                posting_queue=self.posting_queue
             )
 
-    # Wipes the current images
+    # Used to wipe the images directory, now it's a persistent cache that only trims itself to its byte budget
     def prepare_to_download_images(self):
-        current_dir = get_current_dir()
-        path = os.path.join(current_dir, os.path.join(self.subreddit, 'images'))
-        for f in os.listdir(path):
-            os.remove(os.path.join(path, f))
-
-    # Iteration 1: wget
-    #   having some throttling issues - t=5s seems to do the trick
-    def download_new_images(self, images):
-        for image in images:
-            image.download_source()
+        self.image_cache.evict()
 
     def store_new_images(self, new_images):
         for image in new_images:
@@ -219,9 +357,140 @@ class RedditScraper():
         for image in old_images:
             image.update_image() # can we get much simpler? yes -- with a lambda
 
-    def update_existing_image_set_file(self, images):
-        current_dir = get_current_dir()
 
-        with open("{}/{}/last_files.txt".format(current_dir, self.subreddit), 'w+') as f:
-            for image in images:
-                f.write(image.id + os.linesep)
+class ScrapeRun():
+    """Per-run state for RedditScraper.scrape_and_store, and the function each pipeline stage runs"""
+    def __init__(self, scraper, limit=None):
+        self.scraper = scraper
+        self.subreddit = scraper.subreddit
+        self.limit = limit # max new images, for testing
+        self.metadata_cache = MetadataCache()
+        self.write_buffer = WriteBuffer()
+        self.media_pool = MediaPool(scraper.memory_cap) if scraper.in_memory else None
+        self.engagement_store = scraper.build_engagement_store(self.write_buffer)
+        self.snapshot = EngagementSnapshot(os.path.join(get_current_dir(), self.subreddit, 'snapshot.txt'), scraper.significance)
+        self.downloader = scraper.downloader or Downloader()
+        self.processor = Processor()
+        self.process_pool = processing.process_pool() if scraper.process_images and processing.available() else None
+        self.to_post = set()
+        self.seen = 0
+        self.new = 0
+        self.reposts = 0
+        self._lock = threading.Lock()
+
+    def drop(self, item):
+        if isinstance(item, Image):
+            item.release_media()
+
+    def filter_post(self, post):
+        # text posts, videos etc. are dropped on the raw dicts so they never cost an Image or a DB read
+        if not can_download_post(post, self.subreddit):
+            return None
+        # keep only the fields we use, the raw post dict is dropped here
+        return PostRecord.from_post(post, self.subreddit)
+
+    def lookup_metadata(self, records):
+        """ One BatchGetItem per batch of up to 100 posts, then the batch's posting decisions in one pass """
+        self.scraper.prefetch_metadata(records, self.metadata_cache)
+        images = list(self.scraper.build_image_objects(records, self.metadata_cache, self.write_buffer,
+            self.scraper.image_cache, self.media_pool, self.engagement_store))
+        for image in images:
+            # the posting threshold goes by every poll of the post, written or not
+            image.skipped_polls = self.snapshot.skipped_polls(image.id)
+        with metrics.timer('scoring'):
+            posting = [image.id for image in score_batch(images)]
+        with self._lock:
+            self.to_post.update(posting)
+            self.seen += len(images)
+        return images
+
+    def _admit_new(self):
+        with self._lock:
+            if self.limit is not None and self.new >= self.limit:
+                return False
+            self.new += 1
+            return True
+
+    def download(self, image):
+        if image.in_db:
+            # seen images only need their file if they're about to be posted
+            if image.id in self.to_post and not image.ensure_image_downloaded():
+                return None
+            return image
+        phash_index = self.scraper.phash_index
+        # known reposts from earlier runs are skipped without downloading them again
+        if image.id in phash_index.duplicate_of or not self._admit_new():
+            return None
+        if self.media_pool is not None:
+            downloaded = image.download_source(self.downloader)
+        else:
+            # anything still cached from an earlier run (e.g. its dynamo write failed) isn't fetched again
+            cache = self.scraper.image_cache
+            downloaded = cache.get(image.id) is not None or image.download_source(self.downloader)
+        if not downloaded:
+            return None
+        with metrics.timer('dedup'):
+            image.compute_phash()
+            original_id = phash_index.claim(image.phash, image.id, image.caption_phash) if image.phash is not None else None
+        if original_id is not None:
+            print('dropping {} as a repost of {}'.format(image.id, original_id))
+            with self._lock:
+                self.reposts += 1
+            return None
+        return image
+
+    def process(self, image):
+        if self.process_pool is not None and not image.in_db:
+            self.processor.process(image, self.process_pool)
+        return image
+
+    def upload(self, image):
+        if not image.in_db and image.upload_to_s3() is None:
+            return None
+        return image
+
+    def post(self, image):
+        if image.id in self.to_post:
+            image.post_to_instagram()
+        return image
+
+    def write(self, image):
+        snapshot = self.snapshot
+        try:
+            if image.in_db:
+                self.scraper.seen_index.add(image.id)
+                # most re-polled posts have barely moved since the last poll, those don't get a write
+                if not snapshot.should_write(image.id, image.votes, image.comments, image.posted):
+                    return image
+                image.update_image()
+            else:
+                image._put_dynamodb(image.s3_object)
+                self.scraper.seen_index.add(image.id)
+            snapshot.record(image.id, image.votes, image.comments, image.posted)
+            return image
+        finally:
+            image.release_media()
+
+    def report(self, images):
+        write_buffer, snapshot = self.write_buffer, self.snapshot
+        print('{} posts seen, {} new, {} reposts dropped, {} stored'.format(self.seen, self.new, self.reposts, len(images)))
+        print('dynamo writes: {} batches, {} updates, {} retries, {} errors'.format(
+            write_buffer.batches_written, write_buffer.updates_written, write_buffer.retries, write_buffer.errors))
+        print('engagement updates: {}'.format(snapshot.report()))
+        metrics.incr('engagement_updates_total', snapshot.written, result='written')
+        metrics.incr('engagement_updates_total', snapshot.skipped, result='skipped')
+
+        saved_calls = sum(image.saved_calls for image in images)
+        print('metadata: {} batch reads for {} posts, {} get_item calls saved'.format(
+            self.metadata_cache.reads, self.seen, saved_calls))
+        seen_index = self.scraper.seen_index
+        print('seen index: {} ids{}, {} lookups answered by the bloom filter'.format(
+            len(seen_index), '' if seen_index.complete else ' (incomplete, run build-index)', seen_index.bloom_rejects))
+        for host, stats in self.downloader.report().items():
+            print(host, stats)
+        print('image cache: {}'.format(self.scraper.image_cache.report()))
+        print('filters: {}'.format(content_filter.get_filter(self.subreddit).report()))
+        print('processing: {}'.format(self.processor.report()))
+        print('posting queue: {}'.format(self.scraper.posting_queue.report()))
+        if self.media_pool is not None:
+            print('media pool: {} buffers spilled to disk'.format(self.media_pool.spilled))
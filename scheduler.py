@@ -0,0 +1,88 @@
+import heapq
+import threading
+import time
+#local modules
+from reddit_scraper import RedditScraper
+
+DEFAULT_INTERVAL = 15 * 60
+# how far a subreddit's interval can move away from its configured one
+MIN_INTERVAL_FACTOR = 0.25
+MAX_INTERVAL_FACTOR = 2.0
+# weight of the latest observation in the churn moving average
+CHURN_SMOOTHING = 0.3
+
+
+def parse_subreddit_spec(spec, default_interval=DEFAULT_INTERVAL):
+    """ 'memes' or 'memes:300' -> ('memes', 300) """
+    name, _, interval = spec.partition(':')
+    return name, float(interval) if interval else default_interval
+
+
+class SubredditSchedule():
+    def __init__(self, scraper, interval):
+        self.scraper = scraper
+        self.base_interval = interval
+        self.churn = 0.5 # no history yet, assume an average subreddit
+        self.last_ids = None
+        self.runs = 0
+
+    @property
+    def subreddit(self):
+        return self.scraper.subreddit
+
+    @property
+    def interval(self):
+        # hot pages that turn over quickly get polled more often than configured, stale ones less
+        factor = MAX_INTERVAL_FACTOR - (MAX_INTERVAL_FACTOR - MIN_INTERVAL_FACTOR) * self.churn
+        return self.base_interval * factor
+
+    def observe(self, ids):
+        """ churn = fraction of the listing we didn't see on the previous run """
+        if self.last_ids is not None and ids:
+            new = len(ids - self.last_ids) / len(ids)
+            self.churn = (1 - CHURN_SMOOTHING) * self.churn + CHURN_SMOOTHING * new
+        self.last_ids = ids
+
+
+class Scheduler():
+    """Scrapes many subreddits in one long-running process.
+
+    Every subreddit keeps its own RedditScraper (so local state is loaded once) and is run again
+    after its interval, which adapts to how fast its hot page changes. When several subreddits are
+    due at once the fastest changing one goes first. The oauth token and the reddit request budget
+    are shared process wide (see reddit_scraper.access_tokens / rate_limit_budget)."""
+    def __init__(self, subreddit_intervals, **scraper_kwargs):
+        self.schedules = [
+            SubredditSchedule(RedditScraper(subreddit, **scraper_kwargs), interval)
+            for subreddit, interval in subreddit_intervals
+        ]
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        now = time.time()
+        # (next run, -churn, tiebreak index) so the heap never has to compare schedules
+        queue = [(now, -schedule.churn, i) for i, schedule in enumerate(self.schedules)]
+        heapq.heapify(queue)
+        while queue and not self.stopped.is_set():
+            next_run, _, i = heapq.heappop(queue)
+            if self.stopped.wait(max(0, next_run - time.time())):
+                break
+            schedule = self.schedules[i]
+            self.run_once(schedule)
+            heapq.heappush(queue, (time.time() + schedule.interval, -schedule.churn, i))
+
+    def run_once(self, schedule):
+        start = time.time()
+        try:
+            images = schedule.scraper.scrape_and_store()
+        except Exception as e:
+            print('scrape of r/{} failed'.format(schedule.subreddit))
+            print(e)
+            return
+        schedule.runs += 1
+        schedule.observe({image.id for image in images})
+        print('r/{} done in {:.1f}s, churn {:.2f}, next run in {:.0f}s'.format(
+            schedule.subreddit, time.time() - start, schedule.churn, schedule.interval))
@@ -0,0 +1,38 @@
+"""Posting decisions for a listing: Image.should_post_to_instagram's rule, run over a batch of images.
+
+This is not vectorized, it's the per-image rule in a loop, reading each image's metadata from the
+prefetched cache instead of DynamoDB. numpy's random module does `from secrets import randbits`,
+which our own secrets.py shadows, so nothing on the scrape path imports numpy. The only vectorized
+version of the rule is analyze.score_arrays, used offline to replay millions of samples."""
+import time
+#local modules
+import secrets
+
+
+def score(votes, created, n, thresholds, now):
+    """ The math of Image.should_post_to_instagram: returns (passes, ups_ratio, threshold).
+    thresholds is the subreddit's VALUES_FOR_SUBREDDIT list, n the engagement length. """
+    ups_ratio = votes / max(now - created, 1e-9) # ups = upvotes per second
+    # first X hours of seeing this post (if n < X)
+    if not thresholds or n >= len(thresholds):
+        return False, ups_ratio, float('inf')
+    threshold = thresholds[min(max(n - 1, 0), len(thresholds) - 1)]
+    return ups_ratio > threshold, ups_ratio, threshold
+
+
+def score_batch(images, now=None):
+    """ Returns the images (any mix of subreddits) that should be posted, in listing order.
+
+    There's no ranking: each image is queued for posting as it leaves the pipeline, so an order
+    picked here wouldn't carry through."""
+    now = time.time() if now is None else now
+    posting = []
+    for image in images:
+        # posted/banned are per-image lookups that rule a candidate out before any math
+        if image._image_was_posted() or image.has_banned_words():
+            continue
+        passes, _, _ = score(image.votes, image.created, image.engagement_length(),
+            secrets.VALUES_FOR_SUBREDDIT[image.subreddit], now)
+        if passes:
+            posting.append(image)
+    return posting
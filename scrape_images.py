@@ -1,17 +1,147 @@
+import os
 #pypi
 import click
 #local modules
-from reddit_scraper import RedditScraper
+import backfill as backfill_module
+import metrics
+import posting_queue
+import seen_index
+from reddit_scraper import RedditScraper, get_current_dir
+from scheduler import DEFAULT_INTERVAL, Scheduler, parse_subreddit_spec
+from snapshot import SignificanceRule
 
-@click.command()
+listing_options = [
+    click.option('--listing', default='hot', type=click.Choice(['hot', 'new', 'top', 'rising', 'controversial'])),
+    click.option('--time-filter', default=None, type=click.Choice(['hour', 'day', 'week', 'month', 'year', 'all'])),
+    click.option('--pages', default=1, help='how many listing pages to follow'),
+    click.option('--page-size', default=25, help='posts per listing page (max 100)'),
+    click.option('--in-memory', is_flag=True, help='keep images in memory instead of the disk cache'),
+    click.option('--memory-cap', default=256, help='MB of images to hold in memory before spilling to disk'),
+    click.option('--workers', multiple=True, help='threads for a pipeline stage as stage=N, e.g. --workers download=16'),
+    click.option('--skip-processing', is_flag=True, help='upload and post images exactly as downloaded'),
+    click.option('--engagement-store', default='legacy', type=click.Choice(['legacy', 'dynamo', 'local']),
+        help='where engagement samples are written, see engagement_store.py'),
+    click.option('--min-score-delta', default=10, help='votes a seen post has to move by before it is written again'),
+    click.option('--min-relative-delta', default=0.05, help='...and as a fraction of its last recorded votes/comments'),
+    click.option('--min-comment-delta', default=5, help='comments a seen post has to move by before it is written again'),
+    click.option('--min-sample-interval', default=0, help='seconds between two writes of the same post'),
+    click.option('--max-sample-interval', default=6 * 60 * 60, help='seconds after which a post is written even if unchanged'),
+]
+
+def parse_stage_workers(specs):
+    """ ('download=16', 'upload=4') -> {'download': 16, 'upload': 4} """
+    workers = {}
+    for spec in specs:
+        stage, _, count = spec.partition('=')
+        workers[stage] = int(count)
+    return workers
+
+def significance_rule(min_score_delta, min_relative_delta, min_comment_delta, min_sample_interval, max_sample_interval):
+    return SignificanceRule(min_delta=min_score_delta, min_relative=min_relative_delta, min_comment_delta=min_comment_delta,
+        min_interval=min_sample_interval, max_interval=max_sample_interval)
+
+metrics_port_option = click.option('--metrics-port', default=None, type=int,
+    help='serve Prometheus metrics on this port (/metrics, /metrics.json)')
+
+def add_options(options):
+    def decorator(f):
+        for option in reversed(options):
+            f = option(f)
+        return f
+    return decorator
+
+class DefaultToController(click.Group):
+    """Anything that isn't a command goes to `controller`, so the existing
+    `scrape_images.py SUBREDDIT [--limit]` cron lines keep working"""
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and args[0] not in ctx.help_option_names:
+            args = ['controller'] + args
+        return super().parse_args(ctx, args)
+
+@click.group(cls=DefaultToController)
+def cli():
+    pass
+
+@cli.command()
 @click.argument('subreddit', nargs=1)
 @click.option('--limit', is_flag=True)
-def controller(subreddit, limit):
-    scraper = RedditScraper(subreddit)
-    if limit:
-        scraper.scrape_and_store(n=2)
-    else:
-        scraper.scrape_and_store()
+@click.option('--metrics-json', default=None, type=click.Path(), help='write a metrics snapshot here after the run')
+@click.option('--profile', default=None, type=click.Path(), help='run under cProfile and dump the stats here')
+@click.option('--post-timeout', default=300, help='seconds to wait for queued posts before exiting')
+@metrics_port_option
+@add_options(listing_options)
+def controller(subreddit, limit, metrics_json, profile, post_timeout, metrics_port, listing, time_filter, pages, page_size, in_memory,
+        memory_cap, workers, skip_processing, engagement_store, **significance):
+    if metrics_port:
+        metrics.registry.serve(metrics_port)
+    scraper = RedditScraper(subreddit, listing=listing, time_filter=time_filter, max_pages=pages, page_size=page_size,
+        in_memory=in_memory, memory_cap=memory_cap * 1024 * 1024, engagement_store=engagement_store,
+        significance=significance_rule(**significance), process_images=not skip_processing,
+        stage_workers=parse_stage_workers(workers))
+    run = lambda: scraper.scrape_and_store(n=2 if limit else None)
+    try:
+        if profile:
+            metrics.profile_run(run, profile)
+        else:
+            run()
+        # posting runs in the background, give it a chance to finish before exiting
+        if not scraper.posting_queue.drain(timeout=post_timeout):
+            print('posting queue not drained, the rest goes out on the next run')
+        scraper.posting_queue.stop()
+    finally:
+        if metrics_json:
+            metrics.registry.write_json(metrics_json)
+
+@cli.command()
+@click.argument('subreddits', nargs=-1, required=True)
+@click.option('--interval', default=DEFAULT_INTERVAL, help='default seconds between scrapes, override per subreddit with name:seconds')
+@metrics_port_option
+@add_options(listing_options)
+def daemon(subreddits, interval, metrics_port, listing, time_filter, pages, page_size, in_memory, memory_cap, workers,
+        skip_processing, engagement_store, **significance):
+    """ Scrape many subreddits in one process, e.g. `daemon memes:300 dankmemes` """
+    if metrics_port:
+        metrics.registry.serve(metrics_port)
+    scheduler = Scheduler(
+        [parse_subreddit_spec(spec, interval) for spec in subreddits],
+        listing=listing, time_filter=time_filter, max_pages=pages, page_size=page_size,
+        in_memory=in_memory, memory_cap=memory_cap * 1024 * 1024, engagement_store=engagement_store,
+        significance=significance_rule(**significance), process_images=not skip_processing,
+        stage_workers=parse_stage_workers(workers)
+    )
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        scheduler.stop()
+        posting_queue.shared_queue(os.path.join(get_current_dir(), 'posting.db')).stop()
+
+@cli.command('build-index')
+@click.option('--segments', default=4, help='parallel scan segments')
+def build_index(segments):
+    """ Fills the seen id index from the meme-metadata table, after which new posts skip their dynamo read """
+    index = seen_index.shared_index(os.path.join(get_current_dir(), 'seen_ids.idx'))
+    added = seen_index.build_from_table(index, segments=segments)
+    print('seen index: {} ids added, {} total'.format(added, len(index)))
+
+@cli.command()
+@click.argument('subreddits', nargs=-1, required=True)
+@click.option('--output', required=True, type=click.Path(file_okay=False), help='directory for chunks and the checkpoint')
+@click.option('--listing', 'listings', multiple=True, default=['top', 'new'], type=click.Choice(['top', 'new', 'controversial']))
+@click.option('--time-filter', 'time_filters', multiple=True, default=list(backfill_module.DEFAULT_TIME_FILTERS),
+    type=click.Choice(['hour', 'day', 'week', 'month', 'year', 'all']), help='windows walked for top/controversial')
+@click.option('--chunk-rows', default=backfill_module.DEFAULT_CHUNK_ROWS, help='posts per output chunk (and per checkpoint)')
+@click.option('--max-pages', default=None, type=int, help='pages per listing, defaults to all of them')
+@click.option('--format', 'fmt', default='jsonl', type=click.Choice(['jsonl', 'parquet']))
+def backfill(subreddits, output, listings, time_filters, chunk_rows, max_pages, fmt):
+    """ Writes historical posts to chunked files without touching S3/dynamo, rerun the same command to resume """
+    backfill_module.run_backfill(subreddits, output, listings, time_filters, chunk_rows, max_pages, fmt)
+
+@cli.command('backfill-media')
+@click.argument('output', type=click.Path(exists=True, file_okay=False))
+@click.argument('media_dir', type=click.Path(file_okay=False))
+def backfill_media(output, media_dir):
+    """ Downloads the images of a finished (or partial) backfill """
+    print('{} images downloaded'.format(backfill_module.download_media(output, media_dir)))
 
 if __name__ == '__main__':
-    controller()
+    cli()
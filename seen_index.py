@@ -0,0 +1,255 @@
+"""Every image id we've ever stored, in one memory-mapped file.
+
+Layout: a fixed header, a Bloom filter, then an open addressing (linear probing) hash table of
+16 byte md5 digests where an all-zero slot is empty. Opening is just an mmap, so start up cost
+doesn't grow with the number of ids, and lookups for ids we've never seen usually stop at the
+Bloom filter without touching the (much larger) table. Ids are only ever added; when the table
+gets half full it is rebuilt at twice the size into a new file and swapped in with os.replace.
+
+Several processes (one controller per subreddit, the daemon) share the file. Every read and write
+holds an flock on `<path>.lock`, which is never replaced, and first re-reads the header, reopening
+the file if another process swapped in a grown one, so nobody keeps writing to an unlinked table or
+works from a stale count.
+
+An index only knows about ids added through it. Until it has been filled from the whole
+meme-metadata table (build_from_table, `scrape_images.py build-index`) it isn't `complete`, and
+callers must not treat "not in the index" as "not in the table"."""
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+#local modules
+import clients
+import image
+
+MAGIC = b'SEENIDX1'
+HEADER = struct.Struct('<8sQQQQ') # magic, capacity, count, flags, bloom bytes
+FLAG_COMPLETE = 1
+SLOT_SIZE = 16
+EMPTY_SLOT = bytes(SLOT_SIZE)
+INITIAL_CAPACITY = 1 << 16
+MAX_LOAD = 0.5
+# ~10 bits per id at MAX_LOAD keeps Bloom false positives around 1% with 7 hashes
+BLOOM_BITS_PER_ID = 10
+BLOOM_HASHES = 7
+TMP_SUFFIX = '.part'
+
+
+def digest(image_id):
+    """ Image ids are md5 hex digests of the url already, anything else gets hashed """
+    if len(image_id) == 32:
+        try:
+            return bytes.fromhex(image_id)
+        except ValueError:
+            pass
+    return hashlib.md5(image_id.encode()).digest()
+
+
+def _bloom_bytes(capacity):
+    bits = int(capacity * MAX_LOAD) * BLOOM_BITS_PER_ID
+    return (bits + 63) // 64 * 8
+
+
+def _create(path, capacity, flags=0):
+    bloom_bytes = _bloom_bytes(capacity)
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, capacity, 0, flags, bloom_bytes))
+        f.truncate(HEADER.size + bloom_bytes + capacity * SLOT_SIZE)
+
+
+class SeenIndex():
+    def __init__(self, path, initial_capacity=INITIAL_CAPACITY):
+        self.path = path
+        self.bloom_rejects = 0 # lookups answered by the Bloom filter alone
+        self._lock = threading.Lock()
+        self._lock_file = open(path + '.lock', 'a+b')
+        with self._file_lock(fcntl.LOCK_EX):
+            if not os.path.exists(path):
+                _create(path, initial_capacity)
+            self._open()
+
+    @contextlib.contextmanager
+    def _file_lock(self, operation):
+        fcntl.flock(self._lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive=False):
+        """ This process's threads and other processes both, with the header as the other processes left it """
+        with self._lock, self._file_lock(fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH):
+            self._sync()
+            yield
+
+    def _open(self):
+        self._file = open(self.path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._read_header()
+        self._bloom_bits = self._bloom_size * 8
+        self._table_offset = HEADER.size + self._bloom_size
+
+    def _read_header(self):
+        magic, self.capacity, self.count, self.flags, self._bloom_size = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError('{} is not a seen id index'.format(self.path))
+
+    def _sync(self):
+        if os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino:
+            # another process grew the table
+            self._close()
+            self._open()
+        else:
+            self._read_header()
+
+    def _close(self):
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+    def _write_header(self):
+        HEADER.pack_into(self._map, 0, MAGIC, self.capacity, self.count, self.flags, self._bloom_size)
+
+    @property
+    def complete(self):
+        with self._locked():
+            return bool(self.flags & FLAG_COMPLETE)
+
+    def mark_complete(self):
+        with self._locked(exclusive=True):
+            self.flags |= FLAG_COMPLETE
+            self._write_header()
+            self._map.flush()
+
+    def _bloom_positions(self, key):
+        # double hashing over the two halves of the digest
+        h1 = int.from_bytes(key[:8], 'little')
+        h2 = int.from_bytes(key[8:], 'little') | 1
+        return [(h1 + i * h2) % self._bloom_bits for i in range(BLOOM_HASHES)]
+
+    def _slot(self, key):
+        """ Offset of key's slot, or of the empty slot where it would go """
+        mask = self.capacity - 1
+        index = int.from_bytes(key[4:12], 'little') & mask
+        while True:
+            offset = self._table_offset + index * SLOT_SIZE
+            stored = self._map[offset:offset + SLOT_SIZE]
+            if stored == key or stored == EMPTY_SLOT:
+                return offset, stored == key
+            index = (index + 1) & mask
+
+    def _contains(self, key):
+        for position in self._bloom_positions(key):
+            if not self._map[HEADER.size + (position >> 3)] & (1 << (position & 7)):
+                self.bloom_rejects += 1
+                return False
+        return self._slot(key)[1]
+
+    def __contains__(self, image_id):
+        with self._locked():
+            return self._contains(digest(image_id))
+
+    def __len__(self):
+        with self._locked():
+            return self.count
+
+    def _insert(self, key):
+        offset, present = self._slot(key)
+        if present:
+            return False
+        self._map[offset:offset + SLOT_SIZE] = key
+        for position in self._bloom_positions(key):
+            self._map[HEADER.size + (position >> 3)] |= 1 << (position & 7)
+        self.count += 1
+        return True
+
+    def add(self, image_id):
+        """ Returns True if the id wasn't in the index yet """
+        return self.update([image_id]) == 1
+
+    def update(self, image_ids, batch_size=10000):
+        """ Adds ids under one lock per batch_size of them, returns how many weren't in the index yet """
+        added = 0
+        keys = [digest(image_id) for image_id in image_ids]
+        for start in range(0, len(keys), batch_size):
+            with self._locked(exclusive=True):
+                for key in keys[start:start + batch_size]:
+                    if (self.count + 1) > self.capacity * MAX_LOAD:
+                        self._grow()
+                    added += self._insert(key)
+                self._write_header()
+        return added
+
+    def _keys(self):
+        table = memoryview(self._map)[self._table_offset:]
+        try:
+            for offset in range(0, self.capacity * SLOT_SIZE, SLOT_SIZE):
+                key = bytes(table[offset:offset + SLOT_SIZE])
+                if key != EMPTY_SLOT:
+                    yield key
+        finally:
+            table.release()
+
+    def _grow(self):
+        tmp_path = self.path + TMP_SUFFIX
+        _create(tmp_path, self.capacity * 2, self.flags)
+        grown = SeenIndex.__new__(SeenIndex)
+        grown.path = tmp_path
+        grown._open()
+        for key in self._keys():
+            grown._insert(key)
+        grown._write_header()
+        grown._close()
+        self._close()
+        os.replace(tmp_path, self.path)
+        self._open()
+
+    def flush(self):
+        with self._locked():
+            self._map.flush()
+
+    def migrate(self, id_file):
+        """ Adds the ids of an old one-id-per-line file (last_files.txt) and renames it out of the way """
+        if not os.path.exists(id_file):
+            return 0
+        with open(id_file) as f:
+            added = self.update(line.strip() for line in f if line.strip())
+        os.replace(id_file, id_file + '.migrated')
+        self.flush()
+        return added
+
+
+def build_from_table(index, client=None, table=None, segments=4):
+    """ Fills the index from a parallel scan of the metadata table's ids and marks it complete """
+    client = client or clients.dynamodb()
+    # looked up here, image.py imports this module for its content hash index
+    table = table or image.CURRENT_TABLE
+
+    def scan_segment(segment):
+        added = 0
+        paginator = client.get_paginator('scan')
+        pages = paginator.paginate(TableName=table, ProjectionExpression='id', Segment=segment, TotalSegments=segments)
+        for page in pages:
+            added += index.update(item['id']['S'] for item in page['Items'])
+        return added
+
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        added = sum(pool.map(scan_segment, range(segments)))
+    index.mark_complete()
+    return added
+
+
+_shared_indexes = {}
+_shared_lock = threading.Lock()
+
+def shared_index(path):
+    """ One index per file per process, so daemon scrapers share the same map """
+    with _shared_lock:
+        if path not in _shared_indexes:
+            _shared_indexes[path] = SeenIndex(path)
+        return _shared_indexes[path]
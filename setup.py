@@ -7,7 +7,16 @@ setup(
         'boto3',
         'click',
         'requests',
-        'wget'
     ],
+    extras_require={
+        # perceptual hashing for repost detection
+        'phash': ['Pillow'],
+        # normalizing/recompressing images before upload, see processing.py
+        'processing': ['Pillow'],
+        # parquet chunks for backfill.py
+        'parquet': ['pyarrow'],
+        # analyze.py - 1.x fails to import next to our secrets.py, and np.random must never be used (it imports the stdlib secrets)
+        'analyze': ['numpy>=2'],
+    },
 )
 
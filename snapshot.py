@@ -0,0 +1,122 @@
+"""Last recorded engagement per post, so polls that see no meaningful change skip their dynamo writes.
+
+The snapshot is a text file of `id timestamp score num_comments posted skipped` lines under the
+subreddit's directory, loaded at start up and rewritten (atomically) at the end of each run.
+
+`skipped` counts the polls of a post that weren't written since its last write. The posting
+threshold is picked by how many times a post has been polled (Image.engagement_length), so every
+write sets the item's num_polls to include the polls skipped before it, and `skipped` starts again
+from 0. Losing this file only loses the polls skipped since each post's last write."""
+import os
+import threading
+import time
+
+TMP_SUFFIX = '.part'
+# entries for posts we haven't recorded in this long have fallen off the listing
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+
+
+class SignificanceRule():
+    """When a new sample of a post is worth writing.
+
+    A change counts when it is at least min_delta and at least min_relative of the last recorded
+    value, so a 10 vote change matters at 100 votes but not at 50k. Nothing is written within
+    min_interval of the last write, and a sample is always written after max_interval so the
+    engagement series keeps getting points for posts that have stalled."""
+    def __init__(self, min_delta=10, min_relative=0.05, min_comment_delta=5, min_interval=0, max_interval=6 * 60 * 60):
+        self.min_delta = min_delta
+        self.min_relative = min_relative
+        self.min_comment_delta = min_comment_delta
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def _changed(self, current, last, min_delta):
+        return abs(current - last) >= max(min_delta, self.min_relative * abs(last))
+
+    def is_significant(self, last, now, score, num_comments, posted):
+        if last is None:
+            return True
+        last_ts, last_score, last_comments, last_posted = last
+        if posted != last_posted:
+            return True
+        elapsed = now - last_ts
+        if elapsed < self.min_interval:
+            return False
+        if self.max_interval is not None and elapsed >= self.max_interval:
+            return True
+        return self._changed(score, last_score, self.min_delta) or \
+            self._changed(num_comments, last_comments, self.min_comment_delta)
+
+
+class EngagementSnapshot():
+    def __init__(self, path, rule=None, max_age=DEFAULT_MAX_AGE):
+        self.path = path
+        self.rule = rule or SignificanceRule()
+        self.max_age = max_age
+        self.written = 0
+        self.skipped = 0
+        self._entries = {} # id -> (ts, score, num_comments, posted, skipped polls)
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) != 6:
+                    continue
+                image_id, ts, score, num_comments, posted, skipped = parts
+                self._entries[image_id] = (float(ts), int(score), int(num_comments), posted == '1', int(skipped))
+
+    def __contains__(self, image_id):
+        return image_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, image_id):
+        return self._entries.get(image_id)
+
+    def skipped_polls(self, image_id):
+        entry = self._entries.get(image_id)
+        return entry[4] if entry is not None else 0
+
+    def should_write(self, image_id, score, num_comments, posted, now=None):
+        """ Whether the post changed enough since its last recorded sample, counted into written/skipped """
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(image_id)
+            significant = self.rule.is_significant(entry[:4] if entry is not None else None, now, score, num_comments, posted)
+            if significant:
+                self.written += 1
+            else:
+                self.skipped += 1
+                self._entries[image_id] = entry[:4] + (entry[4] + 1,)
+        return significant
+
+    def record(self, image_id, score, num_comments, posted, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            # the write that was just made counted the skipped polls into the item's num_polls
+            self._entries[image_id] = (now, score, num_comments, bool(posted), 0)
+
+    def save(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            entries = {image_id: entry for image_id, entry in self._entries.items() if now - entry[0] < self.max_age}
+            self._entries = entries
+            tmp_path = self.path + TMP_SUFFIX
+            with open(tmp_path, 'w') as f:
+                for image_id, (ts, score, num_comments, posted, skipped) in entries.items():
+                    f.write('{} {:.0f} {} {} {} {}\n'.format(image_id, ts, score, num_comments, int(posted), skipped))
+            os.replace(tmp_path, self.path)
+
+    @property
+    def skip_ratio(self):
+        total = self.written + self.skipped
+        return self.skipped / total if total else 0.0
+
+    def report(self):
+        return '{} written, {} skipped ({:.0%} of seen posts unchanged)'.format(self.written, self.skipped, self.skip_ratio)
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('boto3')
+
+from analyze import load_export, simulate
+
+HOUR = 60 * 60
+
+
+def legacy_item(image_id, created, samples, polls=None):
+    engagement = {
+        'timestamps': {'L': [{'N': str(ts)} for ts, _ in samples]},
+        'scores': {'L': [{'N': str(score)} for _, score in samples]},
+        'num_comments': {'L': [{'N': '0'} for _ in samples]},
+    }
+    if polls is not None:
+        engagement['polls'] = {'L': [{'N': str(poll)} for poll in polls]}
+    return {'id': {'S': image_id}, 'community': {'S': 'memes'}, 'created': {'N': str(created)}, 'engagement': {'M': engagement}}
+
+
+def export(tmp_path, items):
+    path = tmp_path / 'history.jsonl'
+    path.write_text(''.join(json.dumps(item) + '\n' for item in items))
+    return load_export(str(path))
+
+
+def test_samples_keep_their_poll_number(tmp_path):
+    samples = [(HOUR, 10), (2 * HOUR, 20), (5 * HOUR, 50), (6 * HOUR, 60)]
+    columns = export(tmp_path, [
+        legacy_item('old', 0, samples[:2]),
+        # two samples from before polls were kept, then two written after skipped polls
+        legacy_item('mixed', 0, samples, polls=[2, 5]),
+    ])
+    assert columns.sample_number.tolist() == [0, 1, 0, 1, 2, 5]
+
+
+def test_simulate_picks_the_threshold_production_did(tmp_path):
+    # 4 upvotes at hour 5 is 2.2e-4/s, which only the sixth threshold lets through
+    thresholds = {'memes': [1.0, 1.0, 1.0, 1.0, 1.0, 1e-4, 1.0, 1.0]}
+    written_every_poll = legacy_item('a', 0, [(5 * HOUR, 4)], polls=[2])
+    after_skipped_polls = legacy_item('b', 0, [(5 * HOUR, 4)], polls=[6])
+    columns = export(tmp_path, [written_every_poll, after_skipped_polls])
+    triggered, first = simulate(columns, thresholds)
+    assert triggered.tolist() == [False, True]
+    assert first.tolist() == [-1, 1]
@@ -0,0 +1,105 @@
+import json
+import os
+import secrets
+
+import pytest
+
+pytest.importorskip('boto3')
+pytest.importorskip('requests')
+
+# reddit_scraper reads the app credentials when it's imported
+for name in ('CLIENT_ID', 'CLIENT_SECRET'):
+    if not hasattr(secrets, name):
+        setattr(secrets, name, 'test')
+
+import backfill
+import content_filter
+from backfill import CHECKPOINT_FILE, TMP_SUFFIX, read_chunks, run_backfill
+
+
+def post(n):
+    return {
+        'title': 'post {}'.format(n),
+        'url': 'https://i.redd.it/{}.jpg'.format(n),
+        'name': 't3_{}'.format(n),
+        'created_utc': 1700000000 + n,
+        'score': n,
+        'num_comments': 0,
+        'subreddit_subscribers': 1000,
+        'thumbnail': 'https://b.thumbs.redditmedia.com/{}.jpg'.format(n),
+        'preview': {},
+        'secure_media': None,
+    }
+
+
+class FakeListing():
+    """Pages of `page_size` posts per listing, `after` is the index of the next page"""
+    def __init__(self, num_posts, page_size=10, fail_after=None):
+        self.num_posts = num_posts
+        self.page_size = page_size
+        self.fail_after = fail_after
+        self.fetched = []
+
+    def __call__(self, subreddit, listing, params):
+        if self.fail_after is not None and len(self.fetched) >= self.fail_after:
+            raise IOError('reddit is down')
+        start = int(params.get('after') or 0)
+        self.fetched.append((subreddit, listing, start))
+        stop = min(start + self.page_size, self.num_posts)
+        children = [{'data': post(n)} for n in range(start, stop)]
+        return {'data': {'children': children, 'after': str(stop) if stop < self.num_posts else None}}
+
+
+@pytest.fixture(autouse=True)
+def posting_rules(monkeypatch):
+    # posting rules only exist for the subreddits that are posted from
+    monkeypatch.setattr(secrets, 'BANNED_PAGE_WORDS', {'memes': ['nsfw']}, raising=False)
+    monkeypatch.setattr(content_filter, '_filters', {})
+
+
+def urls(output_dir):
+    return [row['url'] for row in read_chunks(str(output_dir))]
+
+
+def test_backfills_subreddits_without_posting_rules(tmp_path):
+    fetch = FakeListing(25)
+    checkpoint = run_backfill(['aww'], str(tmp_path), listings=('new',), chunk_rows=10, fetch_page=fetch)
+    assert urls(tmp_path) == [post(n)['url'] for n in range(25)]
+    assert checkpoint.job('aww/new/-') == {'after': None, 'pages': 3, 'rows': 25, 'done': True}
+    assert sorted(os.listdir(str(tmp_path))) == [CHECKPOINT_FILE, 'part-00000.jsonl', 'part-00001.jsonl', 'part-00002.jsonl']
+
+
+def test_resume_continues_from_the_last_closed_chunk(tmp_path):
+    with pytest.raises(IOError):
+        run_backfill(['aww'], str(tmp_path), listings=('new',), chunk_rows=20, fetch_page=FakeListing(50, fail_after=3))
+    # the third page went into a chunk that was never closed
+    assert urls(tmp_path) == [post(n)['url'] for n in range(20)]
+    with open(os.path.join(str(tmp_path), CHECKPOINT_FILE)) as f:
+        assert json.load(f)['jobs']['aww/new/-']['after'] == '20'
+    fetch = FakeListing(50)
+    run_backfill(['aww'], str(tmp_path), listings=('new',), chunk_rows=20, fetch_page=fetch)
+    assert fetch.fetched[0] == ('aww', 'new', 20)
+    assert urls(tmp_path) == [post(n)['url'] for n in range(50)]
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith(TMP_SUFFIX)]
+
+
+def test_finished_jobs_are_skipped(tmp_path):
+    run_backfill(['aww', 'memes'], str(tmp_path), listings=('new',), fetch_page=FakeListing(15))
+    fetch = FakeListing(15)
+    checkpoint = run_backfill(['aww', 'memes'], str(tmp_path), listings=('new',), fetch_page=fetch)
+    assert fetch.fetched == []
+    assert checkpoint.chunks == 1
+    assert len(urls(tmp_path)) == 30
+
+
+def test_max_pages_leaves_the_job_open(tmp_path):
+    checkpoint = run_backfill(['aww'], str(tmp_path), listings=('new',), max_pages=2, fetch_page=FakeListing(50))
+    assert checkpoint.job('aww/new/-') == {'after': '20', 'pages': 2, 'rows': 20, 'done': False}
+    checkpoint = run_backfill(['aww'], str(tmp_path), listings=('new',), fetch_page=FakeListing(50))
+    assert checkpoint.job('aww/new/-')['done']
+    assert urls(tmp_path) == [post(n)['url'] for n in range(50)]
+
+
+def test_jobs_only_take_a_time_filter_for_top():
+    assert list(backfill.jobs_for(['aww'], ['top', 'new'], ['day', 'all'])) == \
+        [('aww', 'top', 'day'), ('aww', 'top', 'all'), ('aww', 'new', None)]
@@ -0,0 +1,91 @@
+import pytest
+
+pytest.importorskip('boto3')
+
+from engagement_store import BUCKET_SECONDS, DynamoEngagementStore, LocalEngagementStore, delta_decode, delta_encode, thin
+
+DAY = 1700006400 # a bucket start
+
+
+class RecordingClient():
+    """Applies the store's list_append updates to in-memory items"""
+    def __init__(self):
+        self.items = {}
+        self.puts = []
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues):
+        key = (Key['id']['S'], Key['bucket']['N'])
+        item = self.items.setdefault(key, {'id': Key['id'], 'bucket': Key['bucket']})
+        for name in ('o', 'v', 'n', 'p'):
+            item.setdefault(name, {'L': []})['L'].extend(ExpressionAttributeValues[':' + name]['L'])
+
+    def put_item(self, TableName, Item):
+        self.puts.append(Item)
+        self.items[(Item['id']['S'], Item['bucket']['N'])] = Item
+
+    def get_paginator(self, name):
+        client = self
+
+        class Paginator():
+            def paginate(self, ExpressionAttributeValues, **kwargs):
+                image_id = ExpressionAttributeValues[':id']['S']
+                yield {'Items': [item for (i, _), item in client.items.items() if i == image_id]}
+        return Paginator()
+
+
+def test_delta_round_trip():
+    values = [5, 7, 7, 20, 3]
+    assert delta_encode(values) == [0, 2, 0, 13, -17]
+    assert delta_decode(5, delta_encode(values)) == values
+
+
+def test_thin_keeps_recent_and_first_per_slot():
+    assert thin([0, 10, 3600, 3700, 9000], older_than=5000, resolution=3600) == [True, False, True, False, True]
+
+
+def test_dynamo_samples_decode_on_their_own():
+    client = RecordingClient()
+    store = DynamoEngagementStore(client=client)
+    # polls 2 and 3 weren't written
+    samples = [(DAY + 60, 10, 1, 0), (DAY + 120, 15, 2, 1), (DAY + 600, 40, 9, 4)]
+    for ts, score, comments, poll in samples:
+        store.append('a', ts, score, comments, poll)
+    assert store.read('a') == ([DAY + 60, DAY + 120, DAY + 600], [10, 15, 40], [1, 2, 9], [0, 1, 4])
+
+    # a lost write only loses that one sample
+    item = client.items[('a', str(DAY))]
+    for name in ('o', 'v', 'n', 'p'):
+        del item[name]['L'][1]
+    assert store.read('a') == ([DAY + 60, DAY + 600], [10, 40], [1, 9], [0, 4])
+
+
+def test_dynamo_buckets_are_read_in_order():
+    store = DynamoEngagementStore(client=RecordingClient())
+    store.append('a', DAY + BUCKET_SECONDS + 5, 50, 5, 1)
+    store.append('a', DAY + 5, 10, 1, 0)
+    assert store.read('a')[0] == [DAY + 5, DAY + BUCKET_SECONDS + 5]
+
+
+def test_dynamo_downsample_keeps_one_sample_per_slot():
+    client = RecordingClient()
+    store = DynamoEngagementStore(client=client)
+    for minute in range(0, 180, 10):
+        store.append('a', DAY + minute * 60, minute, 0, minute // 10)
+    store.downsample('a', older_than=DAY + BUCKET_SECONDS, resolution=3600)
+    assert len(client.puts) == 1
+    assert store.read('a') == ([DAY, DAY + 3600, DAY + 7200], [0, 60, 120], [0, 0, 0], [0, 6, 12])
+
+
+def test_local_round_trip_downsample_and_truncated_tail(tmp_path):
+    store = LocalEngagementStore(str(tmp_path))
+    for i, ts in enumerate([DAY, DAY + 60, DAY + 3600, DAY + 3660]):
+        store.append('a', ts, 10 * i, i, 2 * i)
+    assert store.read('a') == ([DAY, DAY + 60, DAY + 3600, DAY + 3660], [0, 10, 20, 30], [0, 1, 2, 3], [0, 2, 4, 6])
+
+    with open(store.path('a'), 'ab') as f:
+        f.write(b'\x01\x02') # a crash mid-append
+    assert LocalEngagementStore(str(tmp_path)).read('a')[1] == [0, 10, 20, 30]
+
+    store.downsample('a', older_than=DAY + BUCKET_SECONDS, resolution=3600)
+    assert store.read('a') == ([DAY, DAY + 3600], [0, 20], [0, 2], [0, 4])
+    assert store.read('missing') == ([], [], [], [])
@@ -0,0 +1,155 @@
+import hashlib
+import io
+from urllib.parse import parse_qsl
+
+import pytest
+
+pytest.importorskip('boto3')
+pytest.importorskip('requests')
+
+import clients
+import image as image_module
+import metrics
+from benchmarks.fakes import FakeS3
+from image import CURRENT_BUCKET, Image, content_key, engagement_length
+from metadata_cache import MetadataCache
+from seen_index import SeenIndex
+
+
+class RecordingWriteBuffer():
+    def __init__(self):
+        self.puts = []
+        self.updates = []
+
+    def put(self, item):
+        self.puts.append(item)
+
+    def update(self, **kwargs):
+        self.updates.append(kwargs)
+
+
+class RecordingEngagementStore():
+    def __init__(self):
+        self.samples = []
+
+    def append(self, image_id, ts, score, comments, poll):
+        self.samples.append((image_id, score, comments, poll))
+
+
+def make_image(item=None, **kwargs):
+    image = Image('title', 'https://i.redd.it/a.jpg', 1700000000, 100, 5, 'memes', 1000, None,
+        metadata_cache=MetadataCache(client=object()), write_buffer=RecordingWriteBuffer(), **kwargs)
+    if item is not None:
+        image.metadata_cache.put(image.id, dict(item, id={'S': image.id}))
+    return image
+
+
+def legacy_engagement(n):
+    return {'M': {name: {'L': [{'N': '1'}] * n} for name in ('timestamps', 'scores', 'num_comments')}}
+
+
+def test_engagement_length_prefers_the_poll_count():
+    assert engagement_length({'num_polls': {'N': '7'}, 'engagement': legacy_engagement(3)}) == 7
+    # items from before polls were counted had one sample per poll
+    assert engagement_length({'engagement': legacy_engagement(3)}) == 3
+    assert engagement_length({}) == 0
+
+
+def test_writes_count_the_skipped_polls_into_the_item():
+    image = make_image({'num_polls': {'N': '3'}, 'engagement': legacy_engagement(2)})
+    image.skipped_polls = 2
+    assert image.engagement_length() == 5
+    image.update_image()
+    values = image.write_buffer.updates[0]['ExpressionAttributeValues']
+    assert values[':n'] == {'N': '6'}
+    # the sample keeps the n its threshold was picked with
+    assert values[':pl'] == {'L': [{'N': '5'}]}
+
+
+def test_engagement_store_writes_count_the_skipped_polls_too():
+    store = RecordingEngagementStore()
+    image = make_image({'num_polls': {'N': '4'}}, engagement_store=store)
+    image.skipped_polls = 1
+    image.update_image()
+    assert store.samples == [(image.id, 100, 5, 5)]
+    update = image.write_buffer.updates[0]
+    assert 'num_polls = :n' in update['UpdateExpression']
+    assert update['ExpressionAttributeValues'][':n'] == {'N': '6'}
+
+
+def test_new_items_start_at_one_poll():
+    image = make_image(engagement_store=RecordingEngagementStore())
+    image._put_dynamodb('key')
+    assert image.write_buffer.puts[0]['num_polls'] == {'N': '1'}
+
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    client = FakeS3()
+    index = SeenIndex(str(tmp_path / 'content_hashes.idx'))
+    monkeypatch.setattr(clients, 's3', lambda: client)
+    monkeypatch.setattr(image_module, 'content_index', lambda: index)
+    return client
+
+
+def ingest(image, data, size=None, tags=(), **kwargs):
+    sha256 = hashlib.sha256(data).hexdigest()
+    return image._ingest(lambda: io.BytesIO(data), sha256, len(data) if size is None else size, list(tags), **kwargs)
+
+
+def test_ingest_uploads_once_per_content_hash(s3):
+    metrics.registry.reset()
+    image = make_image()
+    key = ingest(image, b'image bytes', tags=[('id', image.id)])
+    assert key == content_key(hashlib.sha256(b'image bytes').hexdigest())
+    # the same bytes under another url are found in the local index without asking S3
+    assert ingest(make_image(), b'image bytes') == key
+    assert s3.calls == {'upload_fileobj': 1}
+    assert s3.objects == {(CURRENT_BUCKET, key): b'image bytes'}
+    assert metrics.registry.counters['bytes_total'] == {(('direction', 'up'), ('service', 's3')): len(b'image bytes')}
+
+
+def test_ingest_only_heads_objects_big_enough_for_multipart(s3):
+    image = make_image()
+    threshold = clients.TRANSFER_CONFIG.multipart_threshold
+    ingest(image, b'small')
+    assert 'head_object' not in s3.calls
+    big = ingest(image, b'big', size=threshold)
+    assert s3.calls['head_object'] == 1 and s3.calls['upload_fileobj'] == 2
+    # stored by another process, the HEAD saves the upload
+    key = content_key(hashlib.sha256(b'stored elsewhere').hexdigest())
+    s3.objects[(CURRENT_BUCKET, key)] = b'stored elsewhere'
+    assert ingest(image, b'stored elsewhere', size=threshold) == key
+    assert s3.calls['head_object'] == 2 and s3.calls['upload_fileobj'] == 2
+    assert big != key
+
+
+def test_ingest_tags_and_content_type_go_with_the_put(s3):
+    uploads = []
+    upload_fileobj = s3.upload_fileobj
+    def recording_upload(Fileobj, Bucket, Key, ExtraArgs=None, **kwargs):
+        uploads.append(ExtraArgs)
+        upload_fileobj(Fileobj, Bucket, Key, ExtraArgs=ExtraArgs, **kwargs)
+    s3.upload_fileobj = recording_upload
+    image = make_image()
+    ingest(image, b'jpeg', tags=[('id', image.id), ('variant', 'processed')], content_type='image/jpeg')
+    assert parse_qsl(uploads[0]['Tagging']) == [('id', image.id), ('variant', 'processed')]
+    assert uploads[0]['ContentType'] == 'image/jpeg'
+    ingest(image, b'original')
+    assert 'ContentType' not in uploads[1]
+    assert 'put_object_tagging' not in s3.calls
+
+
+def test_processed_variant_is_stored_under_its_own_key(s3):
+    image = make_image()
+    image.ensure_image_downloaded = lambda: True
+    image.open_image = lambda: io.BytesIO(b'original')
+    image.sha256 = hashlib.sha256(b'original').hexdigest()
+    image.content_size = lambda: len(b'original')
+    image.processed = b'processed'
+    assert image.upload_to_s3() == content_key(image.sha256)
+    assert image.processed_s3_key == content_key(hashlib.sha256(b'processed').hexdigest())
+    assert s3.objects[(CURRENT_BUCKET, image.s3_object)] == b'original'
+    assert s3.objects[(CURRENT_BUCKET, image.processed_s3_key)] == b'processed'
+    assert dict(parse_qsl(s3.tags[(CURRENT_BUCKET, image.processed_s3_key)]))['variant'] == 'processed'
+    assert 'variant' not in dict(parse_qsl(s3.tags[(CURRENT_BUCKET, image.s3_object)]))
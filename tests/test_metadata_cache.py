@@ -0,0 +1,118 @@
+import secrets
+import types
+
+import pytest
+
+pytest.importorskip('boto3')
+pytest.importorskip('requests')
+
+# reddit_scraper reads the app credentials when it's imported
+for name in ('CLIENT_ID', 'CLIENT_SECRET'):
+    if not hasattr(secrets, name):
+        setattr(secrets, name, 'test')
+
+import clients
+import metadata_cache
+from image import CURRENT_TABLE, Image, image_id_for_url
+from metadata_cache import BATCH_GET_LIMIT, MAX_UNPROCESSED_RETRIES, MetadataCache
+from reddit_scraper import RedditScraper
+from seen_index import SeenIndex
+
+
+class FakeDynamo():
+    """batch_get_item over a dict of items, leaving `unprocessed` keys unprocessed for the first `rounds` calls (every call by default)"""
+    def __init__(self, stored, unprocessed=0, rounds=None):
+        self.stored = {image_id: {'id': {'S': image_id}, 'posted': {'BOOL': False}} for image_id in stored}
+        self.unprocessed = unprocessed
+        self.rounds = rounds
+        self.batch_gets = []
+        self.get_items = []
+
+    def batch_get_item(self, RequestItems):
+        keys = RequestItems[CURRENT_TABLE]['Keys']
+        assert len(keys) <= BATCH_GET_LIMIT
+        self.batch_gets.append(len(keys))
+        holding = self.unprocessed if self.rounds is None or len(self.batch_gets) <= self.rounds else 0
+        served, held = keys[holding:], keys[:holding]
+        response = {'Responses': {CURRENT_TABLE: [self.stored[key['id']['S']] for key in served if key['id']['S'] in self.stored]}}
+        if held:
+            response['UnprocessedKeys'] = {CURRENT_TABLE: {'Keys': held}}
+        return response
+
+    def get_item(self, TableName, Key, **kwargs):
+        self.get_items.append(Key['id']['S'])
+        item = self.stored.get(Key['id']['S'])
+        return {'Item': item} if item is not None else {}
+
+
+def ids(n):
+    return [image_id_for_url('https://i.redd.it/{}.jpg'.format(i)) for i in range(n)]
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(metadata_cache.time, 'sleep', lambda seconds: None)
+
+
+def test_prefetch_reads_in_chunks_of_100():
+    all_ids = ids(250)
+    client = FakeDynamo(all_ids[::2])
+    cache = MetadataCache(client=client)
+    cache.prefetch(all_ids + all_ids[:10])
+    assert client.batch_gets == [100, 100, 50]
+    assert cache.reads == 3
+    assert cache.get(all_ids[0])['id'] == {'S': all_ids[0]}
+    # missing ids are remembered as missing
+    assert all_ids[1] in cache and cache.get(all_ids[1]) is None
+    cache.prefetch(all_ids)
+    assert cache.reads == 3
+
+
+def test_unprocessed_keys_are_retried():
+    all_ids = ids(10)
+    client = FakeDynamo(all_ids, unprocessed=3, rounds=2)
+    cache = MetadataCache(client=client)
+    cache.prefetch(all_ids)
+    assert client.batch_gets == [10, 3, 3]
+    assert all(cache.get(image_id) is not None for image_id in all_ids)
+
+
+def test_keys_given_up_on_fall_back_to_get_item(monkeypatch):
+    all_ids = ids(5)
+    client = FakeDynamo(all_ids, unprocessed=2)
+    cache = MetadataCache(client=client)
+    cache.prefetch(all_ids)
+    assert len(client.batch_gets) == 1 + MAX_UNPROCESSED_RETRIES
+    held = all_ids[:2]
+    assert all(image_id not in cache for image_id in held)
+    assert all(cache.get(image_id) is not None for image_id in all_ids[2:])
+
+    monkeypatch.setattr(clients, 'dynamodb', lambda: client)
+    for i, image_id in enumerate(all_ids):
+        image = Image('title', 'https://i.redd.it/{}.jpg'.format(i), 0, 1, 0, 'memes', 1, None, metadata_cache=cache)
+        assert image.in_db
+    assert client.get_items == held
+
+
+def test_prefetch_metadata_skips_reads_for_ids_the_seen_index_does_not_have(tmp_path):
+    all_ids = ids(300)
+    index = SeenIndex(str(tmp_path / 'seen_ids.idx'))
+    index.update(all_ids[:50])
+    index.mark_complete()
+    client = FakeDynamo(all_ids[:50])
+    cache = MetadataCache(client=client)
+    records = [types.SimpleNamespace(id=image_id) for image_id in all_ids]
+    RedditScraper.prefetch_metadata(types.SimpleNamespace(seen_index=index), records, cache)
+    # the bloom filter can let a few unseen ids through, those still get read
+    assert sum(client.batch_gets) < 60 and len(client.batch_gets) == 1
+    assert all(cache.get(image_id) is not None for image_id in all_ids[:50])
+    assert all(image_id in cache and cache.get(image_id) is None for image_id in all_ids[50:])
+
+
+def test_prefetch_metadata_reads_everything_while_the_index_is_incomplete(tmp_path):
+    all_ids = ids(150)
+    index = SeenIndex(str(tmp_path / 'seen_ids.idx'))
+    client = FakeDynamo(all_ids[:10])
+    cache = MetadataCache(client=client)
+    RedditScraper.prefetch_metadata(types.SimpleNamespace(seen_index=index), [types.SimpleNamespace(id=i) for i in all_ids], cache)
+    assert client.batch_gets == [100, 50]
@@ -0,0 +1,67 @@
+import random
+
+from phash import HASH_BITS, MultiIndexHash, PhashIndex, caption_distance, hamming
+
+
+def flip(value, bits):
+    for bit in bits:
+        value ^= 1 << bit
+    return value
+
+
+def test_search_matches_brute_force():
+    rng = random.Random(7)
+    index = MultiIndexHash(radius=6)
+    stored = []
+    for i in range(2000):
+        # near-duplicates of a few bases, so there is something within radius to find
+        base = stored[rng.randrange(len(stored))][0] if stored and rng.random() < 0.3 else rng.getrandbits(HASH_BITS)
+        value = flip(base, rng.sample(range(HASH_BITS), rng.randrange(9)))
+        stored.append((value, str(i)))
+        index.add(value, str(i))
+    for _ in range(200):
+        query = flip(stored[rng.randrange(len(stored))][0], rng.sample(range(HASH_BITS), rng.randrange(8)))
+        for radius in (0, 3, 6):
+            expected = sorted((hamming(query, value), value, image_id) for value, image_id in stored if hamming(query, value) <= radius)
+            found = index.search(query, radius)
+            assert sorted(found) == expected
+            assert [match[0] for match in found] == sorted(match[0] for match in found)
+
+
+def test_search_radius_is_capped_by_the_index():
+    index = MultiIndexHash(radius=2)
+    index.add(0, 'a')
+    assert index.search(flip(0, range(3)), radius=10) == []
+    assert index.search(flip(0, range(2))) == [(2, 0, 'a')]
+
+
+def caption(top, bottom):
+    return (top << HASH_BITS) | bottom
+
+
+def test_caption_distance_is_the_worse_strip():
+    assert caption_distance(caption(0, 0), caption(flip(0, range(2)), flip(0, range(5)))) == 5
+
+
+def test_claim_catches_reposts_but_not_new_captions(tmp_path):
+    path = str(tmp_path / 'phash_index.txt')
+    index = PhashIndex(path)
+    template = 0x0123456789abcdef
+    assert index.claim(template, 'original', caption(1, 2)) is None
+    # re-encoded repost: a couple of bits off everywhere
+    assert index.claim(flip(template, [0, 9]), 'repost', caption(flip(1, [3]), 2)) == 'original'
+    # the same template with different text
+    assert index.claim(template, 'recaptioned', caption(flip(1, range(10, 20)), 2)) is None
+    assert index.claim(flip(template, range(20)), 'unrelated', caption(1, 2)) is None
+    assert index.duplicate_of == {'repost': 'original'}
+
+    reloaded = PhashIndex(path)
+    assert reloaded.duplicate_of == {'repost': 'original'}
+    assert len(reloaded) == 3
+    assert reloaded.claim(template, 'again', caption(1, 2)) == 'original'
+
+
+def test_claim_ignores_the_image_itself(tmp_path):
+    index = PhashIndex(str(tmp_path / 'phash_index.txt'))
+    assert index.claim(5, 'a', caption(0, 0)) is None
+    assert index.claim(5, 'a', caption(0, 0)) is None
@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+from pipeline import Pipeline, Stage
+
+
+def slow_source(items, every=10, pause=0.2):
+    """Yields items with a pause every `every` items, like listing pages arriving"""
+    for i, item in enumerate(items):
+        if i and i % every == 0:
+            time.sleep(pause)
+        yield item
+
+
+def test_full_batches_wait_for_the_source():
+    batches = []
+    def lookup(batch):
+        batches.append(len(batch))
+        return batch
+    stage = Stage('lookup', lookup, workers=3, batch_size=25, batch_wait=None)
+    results = Pipeline(slow_source(range(60)), [stage]).run()
+    assert sorted(results) == list(range(60))
+    assert sorted(batches) == [10, 25, 25]
+
+
+def test_batch_wait_sends_partial_batches():
+    batches = []
+    def lookup(batch):
+        batches.append(len(batch))
+        return batch
+    stage = Stage('lookup', lookup, batch_size=25, batch_wait=0.05)
+    assert len(Pipeline(slow_source(range(30)), [stage]).run()) == 30
+    assert batches == [10, 10, 10]
+
+
+def test_an_error_only_drops_its_item():
+    dropped = []
+    def check(item):
+        if item == 3:
+            raise ValueError('bad item')
+        return item
+    stages = [Stage('check', check, workers=2), Stage('double', lambda item: item * 2)]
+    pipeline = Pipeline(range(6), stages, on_drop=dropped.append)
+    assert sorted(pipeline.run()) == [0, 2, 4, 8, 10]
+    assert dropped == [3]
+    assert pipeline.report()['check']['errors'] == 1
+    assert pipeline.report()['check']['processed'] == 5
+    assert pipeline.report()['double']['processed'] == 5
+
+
+def test_filtered_items_are_dropped():
+    dropped = []
+    pipeline = Pipeline(range(6), [Stage('odd', lambda item: item if item % 2 else None)], on_drop=dropped.append)
+    assert sorted(pipeline.run()) == [1, 3, 5]
+    assert sorted(dropped) == [0, 2, 4]
+    assert pipeline.report()['odd']['dropped'] == 3
+
+
+def test_failed_batch_drops_every_item_in_it():
+    dropped = []
+    def lookup(batch):
+        raise IOError('lookup failed')
+    pipeline = Pipeline(range(5), [Stage('lookup', lookup, batch_size=10)], on_drop=dropped.append)
+    assert pipeline.run() == []
+    assert sorted(dropped) == [0, 1, 2, 3, 4]
+    assert pipeline.report()['lookup']['errors'] == 5
+
+
+def test_source_failure_stops_the_pipeline_and_is_raised():
+    def source():
+        yield 1
+        raise RuntimeError('listing failed')
+    pipeline = Pipeline(source(), [Stage('slow', lambda item: time.sleep(0.5) or item)])
+    with pytest.raises(RuntimeError, match='listing failed'):
+        pipeline.run()
+    assert pipeline.cancelled
+
+
+def test_cancel_stops_the_source_and_drops_what_is_queued():
+    dropped = []
+    seen = []
+    def source():
+        for i in range(1000):
+            yield i
+    def work(item):
+        seen.append(item)
+        if item == 5:
+            pipeline.cancel()
+        time.sleep(0.01)
+        return item
+    pipeline = Pipeline(source(), [Stage('work', work, queue_size=4)], on_drop=dropped.append)
+    results = pipeline.run()
+    assert pipeline.cancelled
+    assert len(seen) < 20
+    # nothing that was queued is lost without on_drop hearing about it
+    assert set(dropped).isdisjoint(results)
+    assert set(dropped) | set(results) | set(seen) >= set(range(max(seen) + 1))
@@ -0,0 +1,136 @@
+import pytest
+
+pytest.importorskip('boto3')
+pytest.importorskip('requests')
+
+import posting_queue
+from posting_queue import MAX_ATTEMPTS, PostingQueue
+
+
+class FakeQuota():
+    synced_at = float('inf')
+
+    def use_main_feed(self, account):
+        return True
+
+    def record(self, account):
+        pass
+
+    def sync(self):
+        pass
+
+
+class RecordingQueue(PostingQueue):
+    """Posts into a list, failing the first `fail` attempts of every post"""
+    def __init__(self, path, fail=0):
+        super().__init__(path, quota=FakeQuota())
+        self.fail = fail
+        self.sent = []
+        self.tries = {}
+
+    def _post(self, image_id, account, caption, image_bytes):
+        self.tries[image_id] = self.tries.get(image_id, 0) + 1
+        if self.tries[image_id] <= self.fail:
+            raise IOError('posting API is down')
+        self.sent.append(image_id)
+
+
+def status(queue, image_id):
+    return queue._db.execute('SELECT status, attempts FROM posts WHERE id = ?', (image_id,)).fetchone()
+
+
+def test_enqueue_is_idempotent_and_posts_once(tmp_path):
+    queue = RecordingQueue(str(tmp_path / 'posting.db'))
+    assert queue.enqueue('a', 'account', 'caption', b'image')
+    assert not queue.enqueue('a', 'account', 'caption', b'image')
+    assert queue.run_once()
+    assert not queue.run_once()
+    assert queue.sent == ['a']
+    assert status(queue, 'a') == ('posted', 0)
+    assert queue._db.execute("SELECT image FROM posts WHERE id = 'a'").fetchone()[0] is None
+
+
+def test_failed_posts_back_off_then_give_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(posting_queue, 'backoff', lambda attempt: 0)
+    queue = RecordingQueue(str(tmp_path / 'posting.db'), fail=MAX_ATTEMPTS)
+    queue.enqueue('a', 'account', 'caption', b'image')
+    for attempt in range(1, MAX_ATTEMPTS):
+        assert queue.run_once()
+        assert status(queue, 'a') == ('pending', attempt)
+    assert queue.run_once()
+    assert status(queue, 'a') == ('failed', MAX_ATTEMPTS)
+    assert queue.failed == 1 and queue.sent == []
+    assert not queue.run_once()
+
+
+def test_retry_waits_for_backoff(tmp_path, monkeypatch):
+    monkeypatch.setattr(posting_queue, 'backoff', lambda attempt: 3600)
+    queue = RecordingQueue(str(tmp_path / 'posting.db'), fail=1)
+    queue.enqueue('a', 'account', 'caption', b'image')
+    assert queue.run_once()
+    assert not queue.run_once()
+    # backing off past the timeout isn't something drain waits for
+    assert queue.drain(timeout=1)
+
+
+def test_a_row_is_claimed_by_one_queue(tmp_path):
+    path = str(tmp_path / 'posting.db')
+    first, second = RecordingQueue(path), RecordingQueue(path)
+    first.enqueue('a', 'account', 'caption', b'image')
+    job = first._next_job()
+    assert job[0] == 'a'
+    assert status(first, 'a') == ('sending', 0)
+    assert second._next_job() is None
+    assert not second.run_once()
+    assert second.sent == []
+
+
+def test_stale_claims_are_recovered(tmp_path):
+    path = str(tmp_path / 'posting.db')
+    dead = RecordingQueue(path)
+    dead.enqueue('a', 'account', 'caption', b'image')
+    dead._next_job() # claimed, then the process died
+    queue = RecordingQueue(path)
+    assert queue.recover_stale_claims() == 0 # still within CLAIM_TIMEOUT
+    assert queue.recover_stale_claims(timeout=-1) == 1
+    assert queue.run_once()
+    assert queue.sent == ['a']
+
+
+def test_drain_only_waits_for_its_own_posts(tmp_path):
+    path = str(tmp_path / 'posting.db')
+    other, queue = RecordingQueue(path), RecordingQueue(path)
+    other.enqueue('theirs', 'account', 'caption', b'image')
+    assert queue.drain(timeout=0.5)
+    queue.enqueue('mine', 'account', 'caption', b'image')
+    assert not queue.drain(timeout=0.2)
+    queue.start()
+    try:
+        assert queue.drain(timeout=5)
+    finally:
+        queue.stop()
+    assert set(queue.sent) <= {'mine', 'theirs'} and 'mine' in queue.sent
+
+
+def test_start_sends_what_earlier_runs_left(tmp_path):
+    path = str(tmp_path / 'posting.db')
+    crashed = RecordingQueue(path)
+    crashed.enqueue('left', 'account', 'caption', b'image')
+    crashed.enqueue('claimed', 'account', 'caption', b'image')
+    crashed._db.execute("UPDATE posts SET status = 'sending', claimed_at = 0 WHERE id = 'claimed'")
+    queue = RecordingQueue(path)
+    queue.start()
+    try:
+        assert queue.running()
+        assert queue.drain(timeout=5)
+    finally:
+        queue.stop()
+    assert sorted(queue.sent) == ['claimed', 'left']
+
+
+def test_password_is_looked_up_by_account(monkeypatch):
+    monkeypatch.setattr(posting_queue.secrets, 'ACCOUNT_NAME_FOR_SUBREDDIT', {'memes': 'memes_account'}, raising=False)
+    monkeypatch.setattr(posting_queue.secrets, 'ACCOUNT_PASSWORD_FOR_SUBREDDIT', {'memes': 'pw'}, raising=False)
+    assert posting_queue.account_password('memes_account') == 'pw'
+    with pytest.raises(KeyError):
+        posting_queue.account_password('someone_else')
@@ -0,0 +1,47 @@
+import secrets
+
+from scoring import score, score_batch
+
+HOUR = 60 * 60
+
+
+class Candidate():
+    def __init__(self, name, votes, n, posted=False, banned=False):
+        self.name = name
+        self.votes = votes
+        self.created = 0
+        self.subreddit = 'memes'
+        self._n = n
+        self._posted = posted
+        self._banned = banned
+
+    def _image_was_posted(self):
+        return self._posted
+
+    def has_banned_words(self):
+        return self._banned
+
+    def engagement_length(self):
+        return self._n
+
+
+def test_score_picks_the_threshold_by_polls():
+    thresholds = [1.0, 0.5, 0.1]
+    assert score(HOUR, 0, 1, thresholds, HOUR) == (False, 1.0, 1.0)
+    assert score(HOUR, 0, 2, thresholds, HOUR) == (True, 1.0, 0.5)
+    # past the window nothing is posted
+    assert score(HOUR, 0, 3, thresholds, HOUR)[0] is False
+    assert score(HOUR, 0, 1, [], HOUR)[0] is False
+
+
+def test_score_batch_keeps_listing_order(monkeypatch):
+    monkeypatch.setattr(secrets, 'VALUES_FOR_SUBREDDIT', {'memes': [0.5, 0.5]}, raising=False)
+    candidates = [
+        Candidate('slow', HOUR, 1),
+        Candidate('fast', 10 * HOUR, 1),
+        Candidate('too slow', HOUR // 4, 1),
+        Candidate('posted', 10 * HOUR, 1, posted=True),
+        Candidate('banned', 10 * HOUR, 1, banned=True),
+        Candidate('too late', 10 * HOUR, 2),
+    ]
+    assert [image.name for image in score_batch(candidates, now=HOUR)] == ['slow', 'fast']
@@ -0,0 +1,72 @@
+import hashlib
+import multiprocessing
+
+import pytest
+
+pytest.importorskip('boto3')
+pytest.importorskip('requests')
+
+from seen_index import SeenIndex, digest
+
+
+def ids(start, stop):
+    # image ids are md5 hex digests of urls
+    return [hashlib.md5(str(i).encode()).hexdigest() for i in range(start, stop)]
+
+
+def test_digest_uses_md5_hex_ids_as_they_are():
+    assert digest('0' * 31 + '1') == bytes(15) + b'\x01'
+    assert len(digest('not an md5')) == 16
+
+
+def test_add_contains_and_reopen(tmp_path):
+    path = str(tmp_path / 'seen.idx')
+    index = SeenIndex(path, initial_capacity=16)
+    assert index.add(ids(0, 1)[0])
+    assert not index.add(ids(0, 1)[0])
+    assert ids(0, 1)[0] in index and ids(1, 2)[0] not in index
+    assert not index.complete
+    index.mark_complete()
+    index.flush()
+
+    reopened = SeenIndex(path)
+    assert len(reopened) == 1 and reopened.complete
+    assert ids(0, 1)[0] in reopened
+
+
+def test_growth_keeps_every_id(tmp_path):
+    index = SeenIndex(str(tmp_path / 'seen.idx'), initial_capacity=16)
+    assert index.update(ids(0, 1000)) == 1000
+    assert index.capacity >= 2000
+    assert all(image_id in index for image_id in ids(0, 1000))
+    assert not any(image_id in index for image_id in ids(1000, 1100))
+
+
+def test_another_instance_follows_a_grown_file(tmp_path):
+    path = str(tmp_path / 'seen.idx')
+    first = SeenIndex(path, initial_capacity=16)
+    second = SeenIndex(path)
+    first.update(ids(0, 100)) # replaces the file second has open
+    assert second.add(ids(100, 101)[0])
+    assert len(first) == len(second) == 101
+    assert all(image_id in first for image_id in ids(0, 101))
+
+
+def _add_range(path, start, stop):
+    index = SeenIndex(path)
+    for image_id in ids(start, stop):
+        index.add(image_id)
+
+
+def test_concurrent_processes_lose_nothing(tmp_path):
+    path = str(tmp_path / 'seen.idx')
+    SeenIndex(path, initial_capacity=16)
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_add_range, args=(path, i * 2000, (i + 1) * 2000)) for i in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    index = SeenIndex(path)
+    assert len(index) == 6000
+    assert all(image_id in index for image_id in ids(0, 6000))
@@ -0,0 +1,55 @@
+from snapshot import EngagementSnapshot, SignificanceRule
+
+HOUR = 60 * 60
+
+
+def test_first_sample_and_posted_change_are_significant():
+    rule = SignificanceRule()
+    assert rule.is_significant(None, 0, 1, 0, False)
+    assert rule.is_significant((0, 100, 10, False), 60, 100, 10, True)
+
+
+def test_change_has_to_clear_absolute_and_relative_thresholds():
+    rule = SignificanceRule(min_delta=10, min_relative=0.05, min_comment_delta=5)
+    assert rule.is_significant((0, 100, 0, False), 60, 110, 0, False)
+    assert not rule.is_significant((0, 100, 0, False), 60, 109, 0, False)
+    # 10 votes doesn't matter at 50k
+    assert not rule.is_significant((0, 50000, 0, False), 60, 50010, 0, False)
+    assert rule.is_significant((0, 50000, 0, False), 60, 52500, 0, False)
+    assert rule.is_significant((0, 100, 10, False), 60, 100, 15, False)
+
+
+def test_intervals():
+    rule = SignificanceRule(min_interval=5 * 60, max_interval=6 * HOUR)
+    assert not rule.is_significant((0, 100, 0, False), 60, 1000, 0, False)
+    assert rule.is_significant((0, 100, 0, False), 6 * HOUR, 100, 0, False)
+
+
+def test_skipped_polls_are_counted_and_saved(tmp_path):
+    path = str(tmp_path / 'snapshot.txt')
+    snapshot = EngagementSnapshot(path)
+    assert snapshot.should_write('a', 100, 0, False, now=0)
+    snapshot.record('a', 100, 0, False, now=0)
+    assert not snapshot.should_write('a', 101, 0, False, now=60)
+    assert not snapshot.should_write('a', 102, 0, False, now=120)
+    assert snapshot.should_write('a', 200, 0, False, now=180)
+    assert snapshot.skipped_polls('a') == 2
+    assert (snapshot.written, snapshot.skipped) == (2, 2)
+    # the write counts them into the item's num_polls, the snapshot starts again
+    snapshot.record('a', 200, 0, False, now=180)
+    assert snapshot.skipped_polls('a') == 0
+    assert not snapshot.should_write('a', 201, 0, False, now=240)
+    snapshot.save(now=300)
+
+    reloaded = EngagementSnapshot(path)
+    assert reloaded.get('a') == (180, 200, 0, False, 1)
+    assert reloaded.skipped_polls('missing') == 0
+
+
+def test_old_entries_are_dropped(tmp_path):
+    path = tmp_path / 'snapshot.txt'
+    path.write_text('a 0 100 1 0 0\nb 1000000 5 0 1 3\n')
+    snapshot = EngagementSnapshot(str(path), max_age=HOUR)
+    assert snapshot.get('a') == (0, 100, 1, False, 0)
+    snapshot.save(now=1000000 + 60)
+    assert 'a' not in EngagementSnapshot(str(path)) and 'b' in EngagementSnapshot(str(path))
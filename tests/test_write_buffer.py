@@ -0,0 +1,112 @@
+import pytest
+
+pytest.importorskip('boto3')
+pytest.importorskip('requests')
+
+import write_buffer
+from image import CURRENT_TABLE
+from write_buffer import BATCH_WRITE_LIMIT, MAX_RETRIES, WriteBuffer
+
+
+class FakeDynamo():
+    """batch_write_item into a dict, leaving `unprocessed` items unprocessed for the first `rounds` calls (every call by default)"""
+    def __init__(self, unprocessed=0, rounds=None):
+        self.unprocessed = unprocessed
+        self.rounds = rounds
+        self.batches = []
+        self.stored = {}
+
+    def batch_write_item(self, RequestItems):
+        requests = RequestItems[CURRENT_TABLE]
+        assert len(requests) <= BATCH_WRITE_LIMIT
+        ids = [request['PutRequest']['Item']['id']['S'] for request in requests]
+        assert len(set(ids)) == len(ids), 'duplicate keys in one batch'
+        self.batches.append(ids)
+        holding = self.unprocessed if self.rounds is None or len(self.batches) <= self.rounds else 0
+        for request in requests[holding:]:
+            item = request['PutRequest']['Item']
+            self.stored[item['id']['S']] = item
+        if holding:
+            return {'UnprocessedItems': {CURRENT_TABLE: requests[:holding]}}
+        return {}
+
+
+class FakeAtexit():
+    def __init__(self):
+        self.registered = []
+
+    def register(self, func):
+        self.registered.append(func)
+
+    def unregister(self, func):
+        self.registered = [f for f in self.registered if f != func]
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(write_buffer, 'backoff', lambda attempt: 0)
+
+
+@pytest.fixture
+def exits(monkeypatch):
+    fake = FakeAtexit()
+    monkeypatch.setattr(write_buffer, 'atexit', fake)
+    return fake
+
+
+def item(image_id, value=0):
+    return {'id': {'S': image_id}, 'value': {'N': str(value)}}
+
+
+def test_puts_go_out_in_batches_of_25(exits):
+    client = FakeDynamo()
+    buffer = WriteBuffer(client=client)
+    for i in range(60):
+        buffer.put(item(str(i)))
+    buffer.close()
+    assert sorted(len(batch) for batch in client.batches) == [10, 25, 25]
+    assert len(client.stored) == 60
+    assert buffer.batches_written == 3 and buffer.errors == 0
+
+
+def test_duplicate_keys_in_a_batch_keep_the_last_write(exits):
+    client = FakeDynamo()
+    buffer = WriteBuffer(client=client)
+    buffer.put(item('a', 1))
+    buffer.put(item('b'))
+    buffer.put(item('a', 2))
+    buffer.close()
+    assert client.batches == [['a', 'b']]
+    assert client.stored['a']['value'] == {'N': '2'}
+
+
+def test_unprocessed_items_are_retried(exits):
+    client = FakeDynamo(unprocessed=4, rounds=2)
+    buffer = WriteBuffer(client=client)
+    for i in range(10):
+        buffer.put(item(str(i)))
+    buffer.close()
+    assert [len(batch) for batch in client.batches] == [10, 4, 4]
+    assert len(client.stored) == 10
+    assert buffer.retries == 2 and buffer.errors == 0
+
+
+def test_unprocessed_items_are_given_up_on(exits):
+    client = FakeDynamo(unprocessed=3)
+    buffer = WriteBuffer(client=client)
+    for i in range(5):
+        buffer.put(item(str(i)))
+    buffer.close()
+    assert len(client.batches) == 1 + MAX_RETRIES
+    assert sorted(client.stored) == ['3', '4']
+    assert buffer.errors == 1
+
+
+def test_close_flushes_and_unregisters(exits):
+    client = FakeDynamo()
+    buffer = WriteBuffer(client=client)
+    assert exits.registered == [buffer.flush]
+    buffer.put(item('a'))
+    buffer.close()
+    assert client.batches == [['a']]
+    assert exits.registered == []
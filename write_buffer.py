@@ -0,0 +1,106 @@
+import atexit
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+#local modules
+import clients
+import metrics
+from image import CURRENT_TABLE
+
+# BatchWriteItem hard limit on items per request
+BATCH_WRITE_LIMIT = 25
+MAX_RETRIES = 8
+
+
+def backoff(attempt):
+    # full jitter, capped at a few seconds
+    return random.uniform(0, min(0.05 * (2 ** attempt), 5))
+
+
+class WriteBuffer():
+    """Collects metadata puts and engagement updates during a run and writes them off the scrape loop.
+
+    Puts go out as BatchWriteItem requests of 25, updates (which need list_append and
+    can't be batched) as parallel update_item calls. Everything left is flushed by
+    flush(), which is also registered to run at interpreter shutdown."""
+    def __init__(self, client=None, table=CURRENT_TABLE, max_workers=8):
+        self.client = client or clients.dynamodb()
+        self.table = table
+        self._lock = threading.Lock()
+        self._puts = []
+        self._updates = []
+        self._futures = []
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.batches_written = 0
+        self.updates_written = 0
+        self.retries = 0
+        self.errors = 0
+        atexit.register(self.flush)
+
+    def put(self, item):
+        with self._lock:
+            self._puts.append(item)
+            if len(self._puts) < BATCH_WRITE_LIMIT:
+                return
+            batch, self._puts = self._puts, []
+            self._futures.append(self._executor.submit(self._write_batch, batch))
+
+    def update(self, **update_kwargs):
+        """ update_kwargs are passed straight to update_item, TableName defaults to the buffer's table """
+        update_kwargs.setdefault('TableName', self.table)
+        with self._lock:
+            self._futures.append(self._executor.submit(self._write_update, update_kwargs))
+
+    def flush(self):
+        with self._lock:
+            batch, self._puts = self._puts, []
+            if batch:
+                self._futures.append(self._executor.submit(self._write_batch, batch))
+            futures, self._futures = self._futures, []
+        wait(futures)
+        for future in futures:
+            if future.exception() is not None:
+                self.errors += 1
+                metrics.incr('errors_total', service='dynamodb', stage='dynamodb_write')
+                print('dynamo write failed: {}'.format(future.exception()))
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+        atexit.unregister(self.flush)
+
+    def _write_batch(self, items):
+        # batch_write_item rejects duplicate keys in one request, last write wins anyway
+        items = list({item['id']['S']: item for item in items}.values())
+        request = {self.table: [{'PutRequest': {'Item': item}} for item in items]}
+        attempt = 0
+        while request:
+            with metrics.timer('dynamodb_write'):
+                response = self.client.batch_write_item(RequestItems=request)
+            self.batches_written += 1
+            request = response.get('UnprocessedItems') or {}
+            if request:
+                attempt += 1
+                self.retries += 1
+                metrics.incr('retries_total', service='dynamodb', operation='BatchWriteItem')
+                if attempt > MAX_RETRIES:
+                    raise RuntimeError('{} items still unprocessed after {} retries'.format(
+                        len(request.get(self.table, [])), MAX_RETRIES))
+                time.sleep(backoff(attempt))
+
+    def _write_update(self, update_kwargs):
+        attempt = 0
+        while True:
+            try:
+                with metrics.timer('dynamodb_write'):
+                    self.client.update_item(**update_kwargs)
+                self.updates_written += 1
+                return
+            except self.client.exceptions.ProvisionedThroughputExceededException:
+                attempt += 1
+                self.retries += 1
+                metrics.incr('retries_total', service='dynamodb', operation='UpdateItem')
+                if attempt > MAX_RETRIES:
+                    raise
+                time.sleep(backoff(attempt))